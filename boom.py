@@ -9,8 +9,35 @@
 # 
 
 import math
-from collections import defaultdict
-import re
+from collections import defaultdict, deque
+import heapq
+import bisect
+import pickle
+import io
+import os
+import hashlib
+import glob
+import itertools
+import string
+import csv
+import array
+import json
+import struct
+import sys
+import multiprocessing
+import random
+import time
+import ast
+import types
+import gc
+import zlib
+import mmap
+import traceback
+import tracemalloc
+import builtins
+import signal
+import threading
+import argparse
 
 def distance(pos1, pos2):
     return ((pos1[0] - pos2[0])**2 + (pos1[1] - pos2[1])**2)**0.5
@@ -18,14 +45,9 @@ def distance(pos1, pos2):
 def posEqual(pos1, pos2):
     return pos1[0] == pos2[0] and pos1[1] == pos2[1]
 
-def entitiesAtPosition(actorList, pos):
-    return [a for a in actorList if posEqual(a.position, pos)]
-
-def anyEntityAtPosition(actorList, pos):
-    result = entitiesAtPosition(actorList, pos)
-    if len(result) > 0:
-        return result[0]
-    return None
+def place(kind, pos):
+    "Key for the position indexes: positions may be lists or tuples, of ints or floats."
+    return (kind, pos[0], pos[1])
 
 # example actions:
 # A worker building a building
@@ -34,15 +56,34 @@ def anyEntityAtPosition(actorList, pos):
 # A building training a batch
 # A building researching a tech
 class Action:
-    name = "action"
+    # There can be hundreds of units each with a queue of actions, so actions
+    # and actors keep their fields in __slots__ instead of a __dict__.
+    __slots__ = ("name", "settled", "lazy")
+
+    def __init__(self, name):
+        self.name = name
+        # Seconds before this one have been accounted for. Only used by the event engine.
+        self.settled = 0
+        # Event engine: set while a gatherer is skipped between dropoffs, and its
+        # share of a depletable resource is subtracted by the engine instead.
+        self.lazy = False
+
     def act(self, state, actor):
         pass
     def cancel(self, state, actor):
         actor.actionQueue.pop()
+    def nextWake(self, state, actor, earliest):
+        "Event engine: the first second >= earliest at which act() must be called."
+        return earliest
+    def settle(self, state, actor, time):
+        "Event engine: catch up on the seconds before time for which act() was skipped."
+        pass
 
 class Walk(Action):
+    __slots__ = ("position", "timeDone")
+
     def __init__(self, unit, position):
-        self.name = "walk"
+        super().__init__("walk")
         self.position = position
         self.timeDone = distance(position, unit.position)
 
@@ -51,17 +92,22 @@ class Walk(Action):
             unit.position = self.position
             unit.actionQueue.pop()
 
+    def nextWake(self, state, unit, earliest):
+        return max(earliest, math.ceil(self.timeDone))
+
 class Foundation:
+    __slots__ = ("kind", "position", "progress", "maxProgress", "builders", "lastTimestepBuilt", "convertedToBuilding", "maxFields", "fields", "farmers")
+
     def __init__(self, kind, position, state):
         self.kind = kind
         self.position = position
         self.progress = 0
-        self.maxProgress = costs[kind][4]
+        self.maxProgress = state.buildTime(kind)
         self.builders = 0
         self.lastTimestepBuilt = 0
         self.convertedToBuilding = False
-        state.addRes(costs[kind], -1)
-        state.foundationLists[kind].append(self)
+        state.addRes(state.civ.costs[kind], -1)
+        state.addFoundation(self)
         if kind == "farmstead":
             self.maxFields = 4
             self.fields = 0
@@ -71,9 +117,11 @@ class Foundation:
         return self.builders ** 0.7
 
 class Build(Action):
+    __slots__ = ("foundation", "kind", "startedYet", "repeating", "position")
+
     def __init__(self, kind, position, state, repeating = False):
-        self.name = "build " + kind
-        self.foundation = anyEntityAtPosition(state.foundationLists[kind], position) # if there's already a foundation don't start a new one
+        super().__init__("build " + kind)
+        self.foundation = state.foundationAt(kind, position) # if there's already a foundation don't start a new one
         self.kind = kind
         self.startedYet = False
         self.repeating = repeating
@@ -85,7 +133,7 @@ class Build(Action):
         if not self.startedYet:
             # current foundation to work on at this position?
             if self.foundation == None:
-                self.foundation = anyEntityAtPosition(state.foundationLists[self.kind], self.position)
+                self.foundation = state.foundationAt(self.kind, self.position)
             if self.foundation == None:
                 self.foundation = Foundation(self.kind, self.position, state)
             self.foundation.builders += 1
@@ -95,24 +143,30 @@ class Build(Action):
             self.foundation.progress += self.foundation.rate()
         if self.foundation.progress >= self.foundation.maxProgress:
             if not self.foundation.convertedToBuilding:
-                state.buildingLists[self.foundation.kind].append(Building(self.foundation.kind, self.foundation.position))
+                state.addBuilding(Building(self.foundation.kind, self.foundation.position))
                 self.foundation.convertedToBuilding = True
-                state.foundationLists[self.foundation.kind].remove(self.foundation)
+                state.removeFoundation(self.foundation)
                 if self.foundation.kind == "house":
-                    state.maxPop += HOUSEPOP
-                print(unit.kind, "finished", self.foundation.kind)
+                    state.maxPop += state.civ.housePop
+                state.event("finished", self.foundation.kind, unit.kind)
+                state.say(unit.kind, "finished", self.foundation.kind)
             if self.repeating:
                 self.startedYet = False
                 # first see if another worker already started the same kind of foundation here
-                foundations = [f for f in state.foundationLists[self.foundation.kind] if posEqual(f.position, self.foundation.position)]
-                if len(foundations) > 0:
-                    self.foundation = foundations[0]
+                foundation = state.foundationAt(self.foundation.kind, self.foundation.position)
+                if foundation != None:
+                    self.foundation = foundation
                 else:
                     self.foundation = Foundation(self.foundation.kind, self.foundation.position, state)
                 # and we'll continue on the new foundation
             else:
                 unit.actionQueue.pop()
 
+    def nextWake(self, state, unit, earliest):
+        if not self.startedYet or self.foundation.convertedToBuilding:
+            return earliest
+        return max(earliest, state.eventEngine.finishTime(self.foundation))
+
 def setSimpleAction(state, unit, pos, actionName):
     "Used when a building has set a waypoint for trained units."
     if actionName == "walk":
@@ -154,83 +208,118 @@ def findMaxBatch(resources, cost, availablePop):
     return int(limit)
 
 class Train(Action):
-    def __init__(self, unitkind, count=1, waypoint = ((0, 0), None), repeating=False, maxBatching=False):
-        self.name = "train " + unitkind
+    __slots__ = ("unitkind", "count", "maxCount", "repeating", "timer", "maxTimer", "waypoint", "maxBatching")
+
+    def __init__(self, unitkind, state, count=1, waypoint = ((0, 0), None), repeating=False, maxBatching=False):
+        super().__init__("train " + unitkind)
         self.unitkind = unitkind
         self.count = count
         self.maxCount = count
         self.repeating = repeating
         self.timer = 0
-        self.maxTimer = math.ceil(costs[unitkind][4] * count**0.8)
+        self.maxTimer = math.ceil(state.civ.costs[unitkind][4] * count**0.8)
         self.waypoint = waypoint
         self.maxBatching = maxBatching
 
     def act(self, state, building):
         if self.timer == 0:
             if self.maxBatching:
-                self.count = min(findMaxBatch(state.resources, costs[self.unitkind], state.maxPop - state.pop), self.maxCount)
-                self.maxTimer = math.ceil(costs[self.unitkind][4] * self.count**0.8)
-            state.addRes(costs[self.unitkind], -self.count)
+                self.count = min(findMaxBatch(state.resources, state.civ.costs[self.unitkind], state.maxPop - state.pop), self.maxCount)
+                self.maxTimer = math.ceil(state.civ.costs[self.unitkind][4] * self.count**0.8)
+            state.addRes(state.civ.costs[self.unitkind], -self.count)
             state.pop += self.count
         self.timer += 1
         if self.timer > self.maxTimer:
             for i in range(self.count):
                 unit = Actor(self.unitkind, building.position)
-                state.workers.append(unit)
+                state.addWorker(unit)
                 waypoint = self.waypoint
                 if waypoint[1] == None and building.waypointSchedule != None:
                     waypoint = building.waypointSchedule.getWaypoint(len(state.workers))
                 if waypoint[1] == None:
                     waypoint = building.waypoint
                 if waypoint[1] != None:
-                    print("Using waypoint " + waypoint[1] + " for unit " + str(len(state.workers)))
+                    state.say("Using waypoint " + waypoint[1] + " for unit " + str(len(state.workers)))
                     setSimpleAction(state, unit, waypoint[0], waypoint[1])
+            state.event("trained", self.unitkind, building.kind, self.count)
             self.timer = 0
             if not self.repeating:
                 building.actionQueue.pop()
 
     def cancel(self, state, building):
         if self.timer != 0: # currently making a batch we can reimburse
-            state.addRes(costs[self.unitkind], self.count)
+            state.addRes(state.civ.costs[self.unitkind], self.count)
             state.pop -= self.count
         building.actionQueue.pop()
 
+    def nextWake(self, state, building, earliest):
+        if self.timer == 0:
+            return earliest
+        # the batch pops out on the second when the timer goes past maxTimer
+        return max(earliest, self.settled + self.maxTimer - self.timer)
+
+    def settle(self, state, building, time):
+        if self.timer != 0:
+            self.timer += time - self.settled
+            self.settled = time
+
 class Research(Action):
-    def __init__(self, techName):
-        self.name = "research " + techName
+    __slots__ = ("timer", "techName", "maxTimer")
+
+    def __init__(self, techName, state):
+        super().__init__("research " + techName)
         self.timer = 0
         self.techName = techName
-        self.maxTimer = costs[techName][4]
+        self.maxTimer = state.civ.costs[techName][4]
 
     def act(self, state, building):
         if self.timer == 0:
-            state.addRes(costs[self.techName], -1)
+            state.addRes(state.civ.costs[self.techName], -1)
         self.timer += 1
         if self.timer > self.maxTimer:
-            state.upgrades.append(self.techName)
+            state.addUpgrade(self.techName)
+            state.event("researched", self.techName, building.kind)
             building.actionQueue.pop()
 
     def cancel(self, state, building):
         if self.timer != 0:
-            state.addRes(costs[self.techName])
+            state.addRes(state.civ.costs[self.techName])
         building.actionQueue.pop()
+
+    def nextWake(self, state, building, earliest):
+        if self.timer == 0:
+            return earliest
+        return max(earliest, self.settled + self.maxTimer - self.timer)
+
+    def settle(self, state, building, time):
+        if self.timer != 0:
+            self.timer += time - self.settled
+            self.settled = time
     
 
 class Gather(Action):
+    __slots__ = ("position", "resourceIndex", "resource", "gatherType", "joined", "rate", "capacity", "phase", "cycle")
+
     def __init__(self, pos, resourceIndex, gatherType):
+        super().__init__(gatherType)
         self.position = pos
         self.resourceIndex = resourceIndex
         self.resource = 0
         self.gatherType = gatherType
-        self.name = gatherType
+        # event engine: whether the unit has started gathering, and its cached rate/capacity
+        self.joined = False
+        self.rate = 0
+        self.capacity = 0
+        # event engine: seconds gathered since the carried resource was last empty, if known
+        self.phase = None
+        self.cycle = None
 
     def takeResource(self, state, amount):
         return amount
 
     def act(self, state, unit):
         assert(posEqual(unit.position, self.position))
-        rate = state.gatherRate(self.gatherType, unit)
-        carryCapacity = state.carryCapacity(unit)
+        rate, carryCapacity = state.gatherStats(self.gatherType, unit)
         qty = self.takeResource(state, rate)
         if qty == 0: # resource depleted
             state.resources[self.resourceIndex] += self.resource
@@ -246,42 +335,98 @@ class Gather(Action):
         state.resources[self.resourceIndex] += self.resource
         unit.actionQueue.pop()
 
+    def nextWake(self, state, unit, earliest):
+        if not self.lazy:
+            return earliest
+        # wake up for the next dropoff
+        if self.phase != None:
+            return max(earliest, self.settled + len(self.cycle) - 1 - self.phase)
+        resource = self.resource
+        time = self.settled
+        while True:
+            resource += self.rate
+            if resource >= self.capacity:
+                return max(earliest, time)
+            time += 1
+
+    def settle(self, state, unit, time):
+        if self.lazy and time > self.settled:
+            if self.phase != None:
+                self.phase += time - self.settled
+                self.resource = self.cycle[self.phase - 1]
+            else:
+                for i in range(time - self.settled):
+                    self.resource += self.rate
+            self.settled = time
+
+# (rate, carry capacity) -> what a gatherer carries after each second, starting empty.
+# The last entry is what gets dropped off.
+carryCycles = {}
+
+def carryCycle(rate, capacity):
+    cycle = carryCycles.get((rate, capacity))
+    if cycle == None:
+        cycle = []
+        resource = 0
+        while resource < capacity:
+            resource += rate
+            cycle.append(resource)
+        carryCycles[(rate, capacity)] = cycle
+    return cycle
+
 class DepletableGather(Gather):
-    def __init__(self, gatherableList, pos, resourceIndex, gatherType):
+    __slots__ = ("gatherable", "shortfall", "shortAmount")
+
+    def __init__(self, gatherableIndex, pos, resourceIndex, gatherType):
         super().__init__(pos, resourceIndex, gatherType)
-        fs = [f for f in gatherableList if posEqual((f[0], f[1]), pos)]
+        fs = gatherableIndex.get((pos[0], pos[1]), [])
         assert(len(fs) > 0)
         self.gatherable = fs[0]
+        self.shortfall = None # last second on which the resource couldn't give a full rate
         
     def takeResource(self, state, amount):
+        if self.lazy: # the event engine subtracts it for us
+            return amount
         if self.gatherable[2] >= amount:
             self.gatherable[2] -= amount
             return amount
+        # remember the short second so the event engine can total the income
+        self.shortfall = state.time
         if self.gatherable[2] > 0:
             tmp = self.gatherable[2]
             self.gatherable[2] = 0
+            self.shortAmount = tmp
             return tmp
+        self.shortAmount = 0
         return 0
 
 class Chop(DepletableGather):
+    __slots__ = ()
+
     def __init__(self, state, pos):
-        super().__init__(state.forestList, pos, WOOD, "chop")
+        super().__init__(state.forestIndex, pos, WOOD, "chop")
         
 class Berries(DepletableGather):
+    __slots__ = ()
+
     def __init__(self, state, pos):
-        super().__init__(state.berriesList, pos, FOOD, "berries")
+        super().__init__(state.berriesIndex, pos, FOOD, "berries")
 
 class Chicken(DepletableGather):
+    __slots__ = ()
+
     def __init__(self, state, pos):
-        super().__init__(state.chickenList, pos, FOOD, "chicken")
+        super().__init__(state.chickenIndex, pos, FOOD, "chicken")
         
 # Build some number of fields around a cc or farmstead
 # (also building the farmstead if necessary)
 # until there are enough fields for us to take a spot
 # and begin farming
 class BuildFields(Action):
+    __slots__ = ("position", "rank", "buildAction")
+
     def __init__(self, pos):
-        self.name = "build fields"
+        super().__init__("build fields")
         self.position = pos
         self.rank = None
         self.buildAction = None
@@ -291,12 +436,11 @@ class BuildFields(Action):
             state.farmerRanks[self.position] += 1
             self.rank = state.farmerRanks[self.position]
         if self.position != (0,0):
-            farmstead = anyEntityAtPosition(state.buildingLists["farmstead"], self.position)
-            if farmstead == None:
+            if state.buildingsAt("farmstead", self.position) == []:
                 unit.actionQueue.append(Build("farmstead", self.position, state))
                 return
                 
-        num_fields = len(entitiesAtPosition(state.buildingLists["field"], self.position))
+        num_fields = len(state.buildingsAt("field", self.position))
         if num_fields * 5 >= self.rank:
             unit.actionQueue.pop()
             assert(unit.actionQueue[-1].name == "farm")
@@ -304,6 +448,8 @@ class BuildFields(Action):
         unit.actionQueue.append(Build("field", self.position, state))
         
 class Farm(Gather):
+    __slots__ = ("started",)
+
     def __init__(self, position):
         super().__init__(position, FOOD, "farm")
         self.position = tuple(position)
@@ -314,15 +460,111 @@ class Farm(Gather):
         self.farmers[self.position] -= 1
         super().cancel(state, actor)
 
+# What summaries count an action as, by the start of its name
+def activityOf(name):
+    if name == None:
+        return "idle"
+    if name[:5] == "build":
+        return "build"
+    if name[:4] == "farm":
+        return "farm"
+    if name[:4] == "chop":
+        return "chop"
+    return None
+
+class Activity:
+    """What a group of actors is doing: the actors whose current action has each
+    name, and how many are idle, farming, etc. Kept up to date by their ActionQueues."""
+    def __init__(self):
+        self.members = defaultdict(dict) # action name, or None for idle -> actors, as dict keys
+        self.counts = defaultdict(int) # activityOf(action name) -> number of actors
+        self.idleKinds = defaultdict(int) # actor kind -> number of idle actors of that kind
+        self.kinds = defaultdict(int) # actor kind -> number of actors of that kind
+
+    def add(self, actor):
+        actor.actionQueue.activity = self
+        self.kinds[actor.kind] += 1
+        self.enter(actor, actor.actionQueue.current())
+
+    def enter(self, actor, name):
+        self.members[name][actor] = True
+        self.counts[activityOf(name)] += 1
+        if name == None:
+            self.idleKinds[actor.kind] += 1
+
+    def move(self, actor, before, after):
+        del self.members[before][actor]
+        self.counts[activityOf(before)] -= 1
+        if before == None:
+            self.idleKinds[actor.kind] -= 1
+        self.enter(actor, after)
+
+class ActionQueue(list):
+    """An actor's actions, the current one last, so queued orders are inserted at 0.
+    Tells its Activity, if any, when the current action changes. A list rather
+    than a deque: queues are a few actions long, and an empty deque is 760 bytes."""
+    __slots__ = ("actor", "activity")
+
+    def __init__(self, actor):
+        super().__init__()
+        self.actor = actor
+        self.activity = None
+
+    def __reduce__(self):
+        # list's own pickling would call ActionQueue() without the actor
+        return (ActionQueue, (self.actor,), (None, {"activity": self.activity}), iter(self))
+
+    def current(self):
+        "name of the current action, None if idle"
+        if len(self) == 0:
+            return None
+        return self[-1].name
+
+    def changed(self, before):
+        after = self.current()
+        if after != before:
+            self.activity.move(self.actor, before, after)
+
+    def append(self, action):
+        if self.activity == None:
+            return super().append(action)
+        before = self.current()
+        super().append(action)
+        self.changed(before)
+
+    def insert(self, index, action):
+        if self.activity == None:
+            return super().insert(index, action)
+        before = self.current()
+        super().insert(index, action)
+        self.changed(before)
+
+    def pop(self, index=-1):
+        if self.activity == None:
+            return super().pop(index)
+        before = self.current()
+        action = super().pop(index)
+        self.changed(before)
+        return action
+
+    def clear(self):
+        if self.activity == None:
+            return super().clear()
+        before = self.current()
+        super().clear()
+        self.changed(before)
+
 # A unit or building.
 class Actor:
+    __slots__ = ("kind", "position", "actionQueue", "index")
+
     def __init__(self, kind, position = None):
         self.kind = kind # a string, "male" "female" "horse" "elephant" for units. Could also be building.
         if position == None:
             self.position = [0, 0] # Scaled so that distance = male or female walking time
         else:
             self.position = position
-        self.actionQueue = []
+        self.actionQueue = ActionQueue(self)
 
     def clearActionQueue(self, state):
         if self.actionQueue == []:
@@ -331,6 +573,9 @@ class Actor:
         self.actionQueue.clear()
 
 class Building(Actor):
+    # a cc also has the fields of a farmstead
+    __slots__ = ("waypoint", "waypointSchedule", "maxFields", "fields", "farmers")
+
     def __init__(self, kind, position = None):
         super().__init__(kind, position)
         self.waypoint = self.position, None
@@ -343,17 +588,422 @@ METAL = 3
 
 resourceNames = ["food", "wood", "stone", "metal"]
 
+# State methods that can be called from the command file without writing self.
+selfCommands = set("setCiv setSummaryPeriod addForest addBerries addChicken debugEnd reportSurplus reportBudget selectWorkers previousWorkerSelection selectBuilding build walk chop berries chicken farm train research setWaypoint setWaypointSchedule".split())
+
+def addSelf(tree):
+    "Turns calls like build(...) into self.build(...) so the user doesn't have to put self. everywhere in the command file."
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in selfCommands:
+            name = node.func
+            node.func = ast.copy_location(ast.Attribute(value=ast.copy_location(ast.Name(id="self", ctx=ast.Load()), name), attr=name.id, ctx=ast.Load()), name)
+    return tree
+
+class BuildError(Exception):
+    """An exception from the build itself, raised while reading its commands or running
+    them, which goes the same way every time the build is run. error is the exception
+    it wraps, and its text is how a run tells what went wrong, like "NameError: ..."."""
+    def __init__(self, error):
+        super().__init__(type(error).__name__ + ": " + str(error))
+        self.error = error
+
+class RunFinished(Exception):
+    "Raised at the end of a run after debugEnd(), and never a BuildError."
+    def __init__(self):
+        super().__init__("Run finished.")
+
+def errorText(e):
+    "What went wrong, for an exception a run ended with: its type and message, or a BuildError's."
+    return str(e) if isinstance(e, BuildError) else type(e).__name__ + ": " + str(e)
+
+# what reading a line of a command file raises if it isn't one
+readErrors = (SyntaxError, ValueError, IndexError)
+
+def parseCommand(command, filename, lineno, mode="exec"):
+    try:
+        # the blank lines put the command on its line of the file without walking the tree
+        tree = ast.parse("\n" * (lineno - 1) + command, filename, mode)
+    except SyntaxError as e:
+        e.text = command
+        raise
+    return addSelf(tree)
+
+class CommandBlock:
+    "The commands to run at one second, after which the simulation runs until stopTime."
+    def __init__(self, code, stopTime, stopwhen, text):
+        self.code = code # None if there are no commands
+        self.stopTime = stopTime # None means run for 5 more minutes
+        self.stopwhen = stopwhen # (text, code) of a stopwhen line before this block, or None
+        self.text = text # the block's lines without comments or blank lines, for telling whether it changed
+
+def compileCommands(lines, filename="<commands>"):
+    """Parse the lines of a command file once into a list of CommandBlocks, the same
+    as BuildOrder.program() makes. The lines are Python, so each block's are
+    compiled together instead of being made into Commands. A line that can't be
+    read raises a BuildError."""
+    blocks = []
+    body = []
+    text = []
+    stopwhen = None
+    def code():
+        if body == []:
+            return None
+        return compile(ast.Module(body, []), filename, "exec")
+    try:
+        for lineno, command in enumerate(lines, 1):
+            command = command.split("#")[0]
+            if command.strip() != "":
+                text.append(command.strip())
+            if command[:5] == "time ":
+                nums = command.split(" ")[1].split(":")
+                blocks.append(CommandBlock(code(), int(nums[0]) * 60 + int(nums[1]), stopwhen, "\n".join(text)))
+                body = []
+                text = []
+                stopwhen = None
+            elif command[:9] == "stopwhen ":
+                stopwhen = command[9:].strip(), compile(parseCommand(command[9:].strip(), filename, lineno, "eval"), filename, "eval")
+            elif command.strip() != "":
+                body += parseCommand(command.strip(), filename, lineno).body
+        # if we weren't given an end time, run for 5 minutes
+        if body != [] or stopwhen != None:
+            blocks.append(CommandBlock(code(), None, stopwhen, "\n".join(text)))
+    except readErrors as e:
+        raise BuildError(e) from e
+    return blocks
+
+class Selector:
+    """What a command of a BuildOrder gives an order to, like selectWorkers(...)
+    in a command file. Which units or building that is is worked out when the
+    command is given."""
+    def select(self, state):
+        pass
+
+    def __repr__(self):
+        return type(self).__name__ + "(" + ", ".join(repr(value) for value in vars(self).values()) + ")"
+
+class Workers(Selector):
+    "The units selectWorkers(kinds, action, num, pos) picks."
+    def __init__(self, kinds, action=None, num=None, pos=None):
+        self.kinds = kinds
+        self.action = action
+        self.num = num
+        self.pos = pos
+
+    def select(self, state):
+        return state.selectWorkers(self.kinds, self.action, self.num, self.pos)
+
+class PreviousWorkers(Selector):
+    "The units the last Workers picked, like previousWorkerSelection()."
+    def select(self, state):
+        return state.previousWorkerSelection()
+
+class OneBuilding(Selector):
+    "The building selectBuilding(kind, pos, index) picks, or the cc for kind \"cc\"."
+    def __init__(self, kind, pos=None, index=None):
+        self.kind = kind
+        self.pos = pos
+        self.index = index
+
+    def select(self, state):
+        if self.kind == "cc":
+            return state.cc
+        return state.selectBuilding(self.kind, self.pos, self.index)
+
+def selected(value, state):
+    return value.select(state) if isinstance(value, Selector) else value
+
+class Commands:
+    "The commands of a block of a BuildOrder, each (name of the State method, args, kwargs). Called with the State to give them."
+    def __init__(self, commands):
+        self.commands = commands
+
+    def __call__(self, state):
+        for name, args, kwargs in self.commands:
+            getattr(state, name)(*[selected(arg, state) for arg in args], **{key: selected(value, state) for key, value in kwargs.items()})
+
+class BuildOrder:
+    """A build order made in Python instead of read from a command file. Every command
+    of a command file is a method with the same name and arguments, with a Selector,
+    like Workers("male", "chop", num=3) or OneBuilding("cc"), where a command file
+    would have selectWorkers(...), selectBuilding(...) or cc. at("00:28") is the
+    time line. The methods return the BuildOrder, so they can be chained:
+        BuildOrder().addForest(10, 0, 5000).chop(Workers("male")).at("00:28").train(OneBuilding("cc"), "female", 5).run()
+    """
+    def __init__(self):
+        self.blocks = []
+        self.commands = [] # of the block not ended by at() yet
+        self.stopwhen = None
+
+    def block(self, stopTime):
+        text = "\n".join(repr(command) for command in self.commands)
+        if self.stopwhen != None:
+            text += "\nstopwhen " + self.stopwhen[0]
+        if stopTime != None:
+            text += "\n" + timeLine(stopTime)
+        return CommandBlock(Commands(self.commands) if self.commands != [] else None, stopTime, self.stopwhen, text)
+
+    def at(self, time):
+        "Run until time, like \"05:30\" or a number of seconds, and then give the commands after this."
+        if isinstance(time, str):
+            time = int(time.split(":")[0]) * 60 + int(time.split(":")[1])
+        self.blocks.append(self.block(time))
+        self.commands = []
+        self.stopwhen = None
+        return self
+
+    def stopWhen(self, condition, description="stop condition"):
+        "Like a stopwhen line: end the run if condition(state) is True, from the next at() on."
+        self.stopwhen = (description, condition)
+        return self
+
+    def program(self):
+        "The CommandBlocks a State runs. Commands after the last at() run for 5 minutes, as in a command file."
+        if self.commands == [] and self.stopwhen == None:
+            return list(self.blocks)
+        return self.blocks + [self.block(None)]
+
+    def __getattr__(self, name):
+        if name not in orderCommands:
+            raise AttributeError("BuildOrder has no command " + name)
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return command
+
+    def run(self, civ=None, map=None, engine="cohort", timeline=True):
+        """Simulate the build order, for civ, a name like "mau", on map, a dict like
+        {"forest": [(10, 0, 5000)], "berries": [(-5, 0, 200)], "chicken": [(0, 0, 400)]}
+        of (x, y, amount) to add before the commands. Returns the RunResult, which
+        has the Timeline of the summaries and events unless timeline is False."""
+        state = None
+        error = None
+        try:
+            state = State(None, engine, quiet=True, record=timeline, order=self)
+            if civ != None:
+                state.setCiv(civ)
+            for kind, places in (map or {}).items():
+                add = {"forest": state.addForest, "berries": state.addBerries, "chicken": state.addChicken}[kind]
+                for x, y, amount in places:
+                    add(x, y, amount)
+            state.doCommands()
+        except Exception as e:
+            if state == None or not (state._debugEnd and str(e) == "Run finished."):
+                error = errorText(e)
+        return RunResult(state, error, timeline)
+
+# the commands a BuildOrder has methods for, the rest of selfCommands being Selectors
+orderCommands = selfCommands - set(["selectWorkers", "previousWorkerSelection", "selectBuilding"])
+
+class Recorder:
+    """Keeps the rows State.summary() shows, and events like a building being
+    finished, in typed arrays, one per column, to write out for other programs."""
+    columns = [("time", "l"), ("food", "d"), ("wood", "d"), ("stone", "d"), ("metal", "d"),
+               ("foodIncome", "d"), ("woodIncome", "d"), ("stoneIncome", "d"), ("metalIncome", "d"),
+               ("pop", "l"), ("maxPop", "l"), ("women", "l"), ("idle", "l"), ("farm", "l"), ("chop", "l"),
+               ("build", "l"), ("barracks", "l"), ("idleBuildings", "l")]
+    # kind, subject and actor are indexes into strings
+    eventColumns = [("time", "l"), ("kind", "l"), ("subject", "l"), ("actor", "l"), ("count", "l")]
+
+    def __init__(self):
+        self.rows = [array.array(typecode) for name, typecode in self.columns]
+        self.events = [array.array(typecode) for name, typecode in self.eventColumns]
+        self.strings = []
+        self.stringIndex = {}
+
+    def addRow(self, values):
+        for column, value in zip(self.rows, values):
+            column.append(value)
+
+    def intern(self, s):
+        i = self.stringIndex.get(s)
+        if i == None:
+            i = self.stringIndex[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+    def addEvent(self, time, kind, subject, actor, count):
+        for column, value in zip(self.events, [time, self.intern(kind), self.intern(subject), self.intern(actor), count]):
+            column.append(value)
+
+    def table(self, events=False):
+        "(names, columns) of the summaries, or of the events with their strings filled in"
+        if not events:
+            return [name for name, typecode in self.columns], self.rows
+        names = [name for name, typecode in self.eventColumns]
+        return names, [[self.strings[i] for i in column] if name in ("kind", "subject", "actor") else column for name, column in zip(names, self.events)]
+
+    def write(self, filename, events=False):
+        "Write the summaries or the events to filename, as CSV, JSONL or binary columns (.bin) depending on its extension."
+        ext = os.path.splitext(filename)[1]
+        if ext == ".bin":
+            if events:
+                writeColumns(filename, [name for name, typecode in self.eventColumns], self.events, self.strings)
+            else:
+                writeColumns(filename, [name for name, typecode in self.columns], self.rows)
+            return
+        names, columns = self.table(events)
+        with open(filename, "w", newline="") as f:
+            if ext == ".jsonl":
+                for row in zip(*columns):
+                    f.write(json.dumps(dict(zip(names, row))) + "\n")
+            elif ext == ".csv":
+                writer = csv.writer(f)
+                writer.writerow(names)
+                writer.writerows(zip(*columns))
+            else:
+                raise Exception("Don't know how to write a " + ext + " file, use .csv, .jsonl or .bin")
+
+# Binary columns: this magic, then a little-endian 4 byte length, then that many bytes of
+# JSON header, then each column's array in turn, in the byte order given in the header.
+COLUMNS_MAGIC = b"BOOMCOL1"
+
+def writeColumns(filename, names, columns, strings=None):
+    header = {"byteorder": sys.byteorder, "columns": [[name, column.typecode, len(column)] for name, column in zip(names, columns)]}
+    if strings != None:
+        header["strings"] = strings
+    header = json.dumps(header).encode()
+    with open(filename, "wb") as f:
+        f.write(COLUMNS_MAGIC + struct.pack("<I", len(header)) + header)
+        for column in columns:
+            column.tofile(f)
+
+def readColumns(filename):
+    "Read a file from writeColumns. Returns (map from column name to array, strings or None)."
+    with open(filename, "rb") as f:
+        if f.read(len(COLUMNS_MAGIC)) != COLUMNS_MAGIC:
+            raise Exception(filename + " is not a columns file")
+        header = json.loads(f.read(struct.unpack("<I", f.read(4))[0]))
+        columns = {}
+        for name, typecode, length in header["columns"]:
+            column = array.array(typecode)
+            column.fromfile(f, length)
+            if header["byteorder"] != sys.byteorder:
+                column.byteswap()
+            columns[name] = column
+    return columns, header.get("strings")
+
+class Budget:
+    """The resources at the start of every second since reportBudget(), to work out
+    afterwards how much could have been spent when without running out later."""
+    def __init__(self, start):
+        self.start = start # first second recorded
+        self.levels = [array.array("d") for i in range(4)] # levels[i][t] is resource i at start + t
+
+    def record(self, time, resources):
+        for i in range(4):
+            levels = self.levels[i]
+            # the event engine skips seconds in which resources don't change
+            while self.start + len(levels) < time:
+                levels.append(levels[-1])
+            if self.start + len(levels) == time:
+                levels.append(resources[i])
+            else:
+                levels[time - self.start] = resources[i]
+
+    def spendable(self, final, end):
+        """For each resource, the most of it that could have been spent at each second
+        without it going below 0 then or later, given final, the resources at the end
+        time. This is the lowest level from that second on, so it never goes down."""
+        curves = []
+        for i in range(4):
+            curve = array.array("d", self.levels[i])
+            # the event engine may have skipped the last seconds
+            while self.start + len(curve) < end:
+                curve.append(curve[-1])
+            curve.append(final[i])
+            lowest = curve[-1]
+            for t in reversed(range(len(curve))):
+                if curve[t] < lowest:
+                    lowest = curve[t]
+                curve[t] = lowest
+            curves.append(curve)
+        return curves
+
+    def earliest(self, curves, cost):
+        "The first second at which cost, [food, wood, stone, metal, ...], could have been spent, or None if never."
+        t = 0
+        for i in range(4):
+            if cost[i] > 0:
+                first = bisect.bisect_left(curves[i], cost[i])
+                if first == len(curves[i]):
+                    return None
+                t = max(t, first)
+        return self.start + t
+
+class Sampler:
+    """The resources, how much of each has been gathered in all and the population at
+    the start of every second, for boom.py diff. Rows are handed to send in chunks
+    as they come, so a long run doesn't pile them up."""
+    columns = ["time", "food", "wood", "stone", "metal", "food gathered", "wood gathered", "stone gathered", "metal gathered", "units", "pop", "max pop"]
+
+    def __init__(self, send, chunk=60):
+        self.send = send
+        self.chunk = chunk
+        self.rows = [] # not sent yet
+        self.time = None # last second recorded
+        self.gathered = [0, 0, 0, 0]
+        self.last = None # (resources, units, pop, maxPop) when time was recorded
+
+    def record(self, state):
+        "Called at the start of every second the engine doesn't skip, and once at the end."
+        now = (list(state.resources), len(state.workers), state.pop, state.maxPop)
+        if self.time == None:
+            self.time = state.time - 1
+            self.last = now
+        # the event engine only skips seconds in which nothing happens, so each of
+        # them gathered what the last one did, and resources and population stayed put
+        while self.time < state.time:
+            self.time += 1
+            for i in range(4):
+                self.gathered[i] += state.income[i]
+            resources, units, pop, maxPop = now if self.time == state.time else self.last
+            self.rows.append(tuple([self.time] + resources + self.gathered + [units, pop, maxPop]))
+            if len(self.rows) >= self.chunk:
+                self.flush()
+        self.last = now
+
+    def flush(self):
+        if self.rows != []:
+            self.send(self.rows)
+            self.rows = []
+
+class Noise:
+    """How one replica of a run in boom.py robust differs from the plan: factors on
+    the gather rate of each kind of gathering and on building times, each drawn once
+    for the replica from a normal distribution around 1, and each block of commands
+    given up to lateness seconds late. Walking times aren't varied, as a Walk ends at
+    a second of the game rather than some time after it starts, so a factor on it
+    would hardly change anything."""
+    def __init__(self, rng, gather=0.1, build=0.1, lateness=3):
+        factor = lambda spread: max(0.1, rng.gauss(1, spread))
+        self.gather = {gatherType: factor(gather) for gatherType in ("chop", "farm", "berries", "chicken")}
+        self.build = factor(build)
+        self.rng = rng
+        self.lateness = lateness
+
+    def late(self):
+        "Seconds late the next block of commands is given."
+        return self.rng.randint(0, self.lateness)
+
 state = None
 
+# the units every run starts with
+startingUnits = "horse male male male male female female female female elephant".split()
+
 class State:
-    def __init__(self, commandFile):
+    def __init__(self, commandFile, engine="tick", commands=None, quiet=False, record=False, order=None):
         # food, wood, stone, metal
         self.resources = [300, 300, 300, 300]
 
         # for reporting purposes
         self.income = [0, 0, 0, 0]
         
-        self.workers = [Actor(w) for w in "horse male male male male female female female female elephant".split()]
+        # what the workers and buildings are doing
+        self.activity = Activity()
+        self.buildingActivity = Activity()
+        self.workers = []
+        for w in startingUnits:
+            self.addWorker(Actor(w))
         self.previousUnitSelection = []
         self.pop = len(self.workers)
         self.maxPop = 20
@@ -369,67 +1019,161 @@ class State:
 
         # map from building kind to list of buildings with that kind
         self.buildingLists = defaultdict(list)
-        self.buildingLists["cc"] = [self.cc]
         # map from foundation kind to list of foundations with that kind
         self.foundationLists = defaultdict(list)
+        # map from place(kind, position) to the buildings or foundations there, in the order they were placed
+        self.buildingIndex = defaultdict(list)
+        self.foundationIndex = defaultdict(list)
+        self.addBuilding(self.cc)
+        # The first summary used to create this, and the order of the kinds is the order buildings act in,
+        # so barracks act right after the cc even when summaries aren't made
+        self.buildingLists["barracks"] = []
 
         # x, y, amount of wood
         self.forestList = []
         # x, y, amount of food
         self.berriesList = []
         self.chickenList = []
+        # map from (x, y) to the entries of the list above at that position
+        self.forestIndex = defaultdict(list)
+        self.berriesIndex = defaultdict(list)
+        self.chickenIndex = defaultdict(list)
 
+        self.civ = civTable() # costs and such, replaced by setCiv
         self.upgrades = []
+        # map from (gatherType, unit kind) to (gather rate, carry capacity), emptied when an upgrade finishes
+        self.gatherTable = {}
         self.time = 0 # seconds
 
         # Directives for automatic actions
         self.desiredFoodRatio = 0.5
 
-        self.commands = open(commandFile).read().split("\n")
+        if order != None: # a BuildOrder instead of a command file
+            self.commands = None
+            self.program = order.program()
+        else:
+            if commands == None:
+                commands = open(commandFile).read().split("\n")
+            self.commands = commands # lines of the command file
+            self.program = compileCommands(self.commands, commandFile)
+        self.nextBlock = 0 # index in program of the next block to run
+        self.finished = False # whether the run has ended
+        self.failure = None # why checkOK ended the run
+        # called with the State at the end of every second, if not None; once it returns True
+        # the run stops there, without having ended, like runCached's until
+        self.until = None
+        self.stoppedEarly = False # whether until stopped it
+        self.quiet = quiet # whether to skip printing anything
+        self.recorder = Recorder() if record else None # keeps the summaries and events in tables
+        # popTimes[n] is the time at which n units were first out (trained, not just queued)
+        self.popTimes = [0] * (len(self.workers) + 1)
+        # what the commands are run with
+        self.namespace = dict(globals())
+        self.namespace["self"] = self
+        self.namespace["cc"] = self.cc
 
         self.summaryPeriod = 10
         self._debugEnd = False
         self._reportSurplus = None
         self.surplusStep = 0
+        self.budget = None # a Budget once reportBudget() is called
+        self.sampler = None # a Sampler, for boom.py diff
         self.stopwhen = "False"
+        self.stopCode = None # compiled stopwhen, None if there is none
+
+        # "tick" runs every unit every second, "event" only wakes units when something happens to them,
+        # "cohort" is "event" that also wakes gatherers dropping off together as one
+        self.engine = engine
+        if engine in ("event", "cohort"):
+            self.eventEngine = EventEngine(self, cohorts = engine == "cohort")
 
     def tellAboutSurplus(self):
         if self._reportSurplus != None:
             f, w, s, m = self._reportSurplus
             if self.surplusStep != 0:
-                print("Surplus of", "{0:.0f}f {1:.0f}w {2:.0f}s {3:.0f}m".format(f, w, s, m), "occurred first at", "{0:03d}:{1:02d}".format(self.surplusStep // 60, self.surplusStep % 60), "and continued until the end.")
+                self.say("Surplus of", "{0:.0f}f {1:.0f}w {2:.0f}s {3:.0f}m".format(f, w, s, m), "occurred first at", "{0:03d}:{1:02d}".format(self.surplusStep // 60, self.surplusStep % 60), "and continued until the end.")
             else:
-                print("No sustained surplus of", "{0:.0f}f {1:.0f}w {2:.0f}s {3:.0f}m".format(f, w, s, m))
-        
+                self.say("No sustained surplus of", "{0:.0f}f {1:.0f}w {2:.0f}s {3:.0f}m".format(f, w, s, m))
+
+    def spendable(self):
+        "Budget.spendable for this run so far, or None without reportBudget()."
+        if self.budget == None:
+            return None
+        return self.budget.spendable(self.resources, self.time)
+
+    def earliestAffordable(self, kind, curves=None):
+        "The first second at which the cost of kind, a unit, building or tech, could have been spent without running out later."
+        return self.budget.earliest(curves if curves != None else self.spendable(), self.civ.costs[kind])
+
+    def tellAboutBudget(self):
+        if self.budget == None:
+            return
+        curves = self.spendable()
+        self.say("Could have spent without running out later:")
+        for t in range(0, len(curves[0]), 60):
+            self.say(" ", formatTime(self.budget.start + t), "{0:.0f}f {1:.0f}w {2:.0f}s {3:.0f}m".format(*[curve[t] for curve in curves]))
+        self.say("Earliest time each could have been afforded:")
+        for kind in self.civ.costs:
+            when = self.earliestAffordable(kind, curves)
+            self.say(" ", kind, formatTime(when) if when != None else "never")
 
-    def checkOK(self, stopwhen):
+    def checkOK(self):
         result = True, ""
         for i in range(4):
             if self.resources[i] < 0:
                 f, w, s, m = self.resources
-                print("Resources went below 0: {0:.0f}f {1:.0f}w {2:.0f}s {3:.0f}m".format(f, w, s, m))
+                self.say("Resources went below 0: {0:.0f}f {1:.0f}w {2:.0f}s {3:.0f}m".format(f, w, s, m))
+                self.failure = "resources went below 0"
                 result = False
         if self.pop > self.maxPop:
-            print("Not enough houses.")
+            self.say("Not enough houses.")
+            self.failure = "not enough houses"
             result = False
-        if eval(stopwhen) == True:
-            print("Hit stop condition: " + stopwhen)
+        if self.stopCode != None and (eval(self.stopCode, self.namespace) if isinstance(self.stopCode, types.CodeType) else self.stopCode(self)) == True:
+            self.say("Hit stop condition: " + self.stopwhen)
+            self.failure = "hit stop condition: " + self.stopwhen
             result = False
         if result == False:
             self.summary()
             self.tellAboutSurplus()
+            self.tellAboutBudget()
             if self._debugEnd:
-                raise Exception("Run finished.")
+                raise RunFinished()
         return result
 
     def addRes(self, resources, multiplier=1):
         for i in range(4):
             self.resources[i] += resources[i] * multiplier
 
+    def addUpgrade(self, techName):
+        self.upgrades.append(techName)
+        self.gatherTable.clear()
+
+    def gatherStats(self, gatherType, unit):
+        "(gather rate, carry capacity) of a unit, looked up in gatherTable"
+        stats = self.gatherTable.get((gatherType, unit.kind))
+        if stats == None:
+            rate = self.computeGatherRate(gatherType, unit.kind)
+            stats = (rate, self.computeCarryCapacity(unit.kind))
+            self.gatherTable[(gatherType, unit.kind)] = stats
+        return stats
+
     def gatherRate(self, gatherType, unit):
+        return self.gatherStats(gatherType, unit)[0]
+
+    def carryCapacity(self, unit):
+        return self.gatherStats(None, unit)[1]
+
+    def buildTime(self, kind):
+        "Seconds it takes one builder to build a building of a kind."
+        return self.civ.costs[kind][4]
+
+    # Gather rates and carry capacities are only computed when gatherTable lacks them,
+    # so every bonus (upgrades, or later civ bonuses) should be applied in these two.
+    def computeGatherRate(self, gatherType, kind):
         "per second gather rate, including walk time etc"
         if gatherType == "chop":
-            if unit.kind == "male":
+            if kind == "male":
                 w = 0.63
             else:
                 w = 0.53
@@ -456,45 +1200,46 @@ class State:
             return 0.86
         return 0.5
 
-    def carryCapacity(self, unit):
-        if unit.kind == "horse":
+    def computeCarryCapacity(self, kind):
+        if kind == "horse":
             return 20
         return 10
 
+    def say(self, *args):
+        "print, unless quiet"
+        if not self.quiet:
+            print(*args)
+
+    def event(self, kind, subject, actor, count=1):
+        if self.recorder != None:
+            self.recorder.addEvent(self.time, kind, subject, actor, count)
+
     def summary(self):
-        idle, farmers, choppers, builders, women = 0, 0, 0, 0, 0
-        for w in self.workers:
-            if w.kind == "female":
-                women += 1
-            if len(w.actionQueue) == 0:
-                idle += 1
-                continue
-            actionName = w.actionQueue[-1].name
-            if actionName[:5] == "build":
-                builders += 1
-            elif actionName[:4] == "farm":
-                farmers += 1
-            elif actionName[:4] == "chop":
-                choppers += 1
-        idleBuildings = 0
-        for b in [self.cc] + self.buildingLists["barracks"]:
-            if b.actionQueue == []:
-                idleBuildings+=1
-                
-        print("{12:03d}:{13:02d} {0:.0f}f+{15:.0f} {1:.0f}w+{16:.0f} {2:.0f}s+{17:.0f} {3:.0f}m+{18:.0f} {4}/{5}pop {11}women {6}idle {7}farm {8}chop {9}build {10}barracks {14}idlebarracks/cc".format(self.resources[0], self.resources[1], self.resources[2], self.resources[3], self.pop, self.maxPop, idle, farmers, choppers, builders, len(self.buildingLists["barracks"]), women, self.time // 60, self.time % 60, idleBuildings, self.income[0]*60, self.income[1]*60, self.income[2]*60, self.income[3]*60))
-
-    def preprocessCommand(self, command):
-        "Add self. so the user doesn't have to put that everywhere in the command file."
-        selfcommands = "setSummaryPeriod addForest addBerries addChicken debugEnd reportSurplus selectWorkers previousWorkerSelection selectBuilding build walk chop berries chicken farm train research setWaypoint setWaypointSchedule".split()
-        for c in selfcommands:
-            pattern = r"\b" + c + r"\s*\("
-            command = re.subn(pattern, "self." + c + "(", command)[0]
-        return command
+        if self.quiet and self.recorder == None:
+            return
+        if self.recorder != None:
+            idle, farmers, choppers, builders, women, idleBuildings = self.summaryCounts()
+            self.recorder.addRow([self.time] + self.resources + [i * 60 for i in self.income] + [self.pop, self.maxPop, women, idle, farmers, choppers, builders, len(self.buildingLists["barracks"]), idleBuildings])
+        if self.quiet:
+            return
+        print(self.summaryLine())
 
-    def step(self, stepCommands):
-        "Advance game time by one second. Returns False if done."
-        if self.time % self.summaryPeriod == 0:
-            self.summary()
+    def summaryCounts(self):
+        "(idle, farmers, choppers, builders, women, idle barracks and cc) for the summary"
+        counts = self.activity.counts
+        women = self.activity.kinds["female"]
+        # the cc and barracks
+        idleBuildings = self.buildingActivity.idleKinds["barracks"]
+        if self.cc.actionQueue == []:
+            idleBuildings += 1
+        return counts["idle"], counts["farm"], counts["chop"], counts["build"], women, idleBuildings
+
+    def summaryLine(self):
+        "The line summary() prints for this second."
+        idle, farmers, choppers, builders, women, idleBuildings = self.summaryCounts()
+        return "{12:03d}:{13:02d} {0:.0f}f+{15:.0f} {1:.0f}w+{16:.0f} {2:.0f}s+{17:.0f} {3:.0f}m+{18:.0f} {4}/{5}pop {11}women {6}idle {7}farm {8}chop {9}build {10}barracks {14}idlebarracks/cc".format(self.resources[0], self.resources[1], self.resources[2], self.resources[3], self.pop, self.maxPop, idle, farmers, choppers, builders, len(self.buildingLists["barracks"]), women, self.time // 60, self.time % 60, idleBuildings, self.income[0]*60, self.income[1]*60, self.income[2]*60, self.income[3]*60)
+
+    def checkSurplus(self):
         if self._reportSurplus != None:
             isAboveLevel = True
             for i in range(4):
@@ -506,73 +1251,199 @@ class State:
             else:
                 if not isAboveLevel:
                     self.surplusStep = 0
-                
+        if self.budget != None:
+            self.budget.record(self.time, self.resources)
+        if self.sampler != None:
+            self.sampler.record(self)
+
+    def beginStep(self):
+        if self.time % self.summaryPeriod == 0:
+            self.summary()
+        self.checkSurplus()
         self.income = [0, 0, 0, 0]
-        for command in stepCommands:
-            exec(self.preprocessCommand(command))
+
+    def execCommands(self, code):
+        if code == None:
+            return
+        if isinstance(code, types.CodeType):
+            exec(code, self.namespace)
+        else: # Commands of a BuildOrder
+            code(self)
+
+    def endStep(self):
+        self.time += 1
+        while len(self.popTimes) <= len(self.workers):
+            self.popTimes.append(self.time)
+        for i, amount in enumerate(self.civ.trickle): # trickle income
+            if amount != 0:
+                self.income[i] += amount
+                self.resources[i] += amount
+        if not self.checkOK():
+            return False
+        if self.until != None and self.until(self):
+            self.stoppedEarly = True
+            return False
+        return True
+
+    def step(self, code=None):
+        "Advance game time by one second, running the compiled commands first. Returns False if done."
+        self.beginStep()
+        self.execCommands(code)
+        self.actWorkers()
+        self.actBuildings()
+        return self.endStep()
+
+    def actWorkers(self):
         for worker in self.workers:
             if worker.actionQueue != []:
                 worker.actionQueue[-1].act(self, worker)
+
+    def actBuildings(self):
         for buildingKind in self.buildingLists:
             for building in self.buildingLists[buildingKind]:
                 if building.actionQueue != []:
                     building.actionQueue[-1].act(self, building)
-        self.time += 1
-        if CIV == "pto": # trickle income
-            self.income[0] += 30
-            self.resources[0] += 1
-        return self.checkOK(self.stopwhen)
+
+    def runSteps(self, code, stopTime):
+        "Run the compiled commands this second, then keep going until stopTime. Returns False if done."
+        if self.engine != "tick":
+            return self.eventEngine.run(code, stopTime)
+        if not self.step(code):
+            return False
+        while self.time < stopTime:
+            if not self.step():
+                return False
+        return True
+
+    def setCiv(self, civ):
+        c = resolveCiv(civ)
+        if c == None:
+            raise Exception("What civ is " + civ + "?")
+        self.civ = civTable(c)
 
     def setSummaryPeriod(self, period):
         self.summaryPeriod = period
 
     def addForest(self, x, y, qty):
         self.forestList.append([x, y, qty])
+        self.forestIndex[(x, y)].append(self.forestList[-1])
 
     def addBerries(self, x, y, qty):
         self.berriesList.append([x, y, qty])
+        self.berriesIndex[(x, y)].append(self.berriesList[-1])
 
     def addChicken(self, x, y, qty):
         self.chickenList.append([x, y, qty])
+        self.chickenIndex[(x, y)].append(self.chickenList[-1])
+
+    def addWorker(self, unit):
+        unit.index = len(self.workers)
+        self.workers.append(unit)
+        self.activity.add(unit)
+
+    def addBuilding(self, building):
+        self.buildingActivity.add(building)
+        self.buildingLists[building.kind].append(building)
+        self.buildingIndex[place(building.kind, building.position)].append(building)
+
+    def buildingsAt(self, kind, pos):
+        # looking a kind up creates its list, as it always has; that fixes the order kinds of building act in
+        self.buildingLists[kind]
+        return self.buildingIndex.get(place(kind, pos), [])
+
+    def addFoundation(self, foundation):
+        self.foundationLists[foundation.kind].append(foundation)
+        self.foundationIndex[place(foundation.kind, foundation.position)].append(foundation)
+
+    def removeFoundation(self, foundation):
+        self.foundationLists[foundation.kind].remove(foundation)
+        self.foundationIndex[place(foundation.kind, foundation.position)].remove(foundation)
+
+    def foundationsAt(self, kind, pos):
+        return self.foundationIndex.get(place(kind, pos), [])
+
+    def foundationAt(self, kind, pos):
+        "The first foundation of a kind at a position, or None."
+        foundations = self.foundationsAt(kind, pos)
+        if foundations != []:
+            return foundations[0]
+        return None
 
     def debugEnd(self, debug=True):
         self._debugEnd = debug
 
     def reportSurplus(self, f, w, s, m):
         self._reportSurplus = [f, w, s, m]
+
+    def reportBudget(self):
+        "At the end, say how much could have been spent at each minute from now on, and when each thing could have been afforded."
+        self.budget = Budget(self.time)
+        self.budget.record(self.time, self.resources) # this second's checkSurplus has been and gone
         
-    def doCommands(self):
-        "execute all commands in the command file"
-        stopTime = 0
-        stepCommands = []
-        for command in self.commands:
-            command = command.split("#")[0]
-            if command[:5] == "time ":
-                nums = command.split(" ")[1].split(":")
-                stopTime = int(nums[0]) * 60 + int(nums[1])
-                if not self.step(stepCommands):
-                    return
-                while self.time < stopTime:
-                    if not self.step([]):
-                        return
-                stepCommands.clear()
-            elif command[:9] == "stopwhen ":
-                stopwhen = command[9:]
-            else:
-                if command.strip() != "" and command.strip()[0] != "#":
-                    stepCommands.append(command)
-        # if we weren't given an end time, run for 5 minutes
-        if stepCommands != []:
-            startTime = self.time
-            if not self.step(stepCommands):
+    def doCommands(self, untilTime=None):
+        """execute all commands in the command file, carrying on from wherever a previous call stopped.
+        With untilTime, stop instead before the first block that would run past untilTime."""
+        while self.nextBlock < len(self.program) and not self.finished and not self.stoppedEarly:
+            block = self.program[self.nextBlock]
+            # a block runs for at least a second, even if its time line goes back in time
+            if untilTime != None and (block.stopTime == None or max(block.stopTime, self.time + 1) > untilTime):
                 return
-            while self.time - startTime < 300:
-                if not self.step([]):
-                    return
+            self.doBlock()
+        if self.finished or self.stoppedEarly or untilTime != None:
+            return
+        self.finished = True
         self.tellAboutSurplus()
+        self.tellAboutBudget()
         if self._debugEnd:
-            raise Exception("Run finished.")
+            raise RunFinished()
+
+
+    def doBlock(self):
+        """Run the next block of commands. Returns False if there are none left or the run has ended or been stopped.
+        Whatever the commands, or what they set going, raise comes out as a BuildError."""
+        if self.finished or self.stoppedEarly or self.nextBlock >= len(self.program):
+            return False
+        block = self.program[self.nextBlock]
+        self.nextBlock += 1
+        if block.stopwhen != None:
+            self.stopwhen, self.stopCode = block.stopwhen
+        stopTime = block.stopTime
+        if stopTime == None:
+            stopTime = self.time + 300
+        try:
+            if not self.giveCommands(block, stopTime):
+                self.finished = not self.stoppedEarly
+                return False
+        except (BuildError, RunFinished, MemoryError):
+            raise
+        except Exception as e:
+            raise BuildError(e) from e
+        return True
+
+    def giveCommands(self, block, stopTime):
+        "Give a block's commands, and run until stopTime. Returns False if done."
+        return self.runSteps(block.code, stopTime)
+
+    def setCommands(self, lines, filename="<commands>"):
+        """Replace the command file, e.g. in a fork. The blocks that already ran are
+        not run again, so the new commands should agree with the old ones up to there."""
+        self.commands = lines
+        self.program = compileCommands(lines, filename)
+
+    def checkpoint(self):
+        "A snapshot of the simulation as it is now, that any number of States can be forked from."
+        if self.engine != "tick":
+            # catch up on everything the event engine left lazy, and have it start afresh from here
+            self.eventEngine.settleAll(self.time)
+            self.eventEngine.upgrades = None
+        data = io.BytesIO()
+        pickler = CheckpointPickler(data, self)
+        pickler.dump({k: v for k, v in vars(self).items() if k not in unpickledFields})
+        return Checkpoint(data.getvalue(), self.program, self.commands, self.engine)
 
+    def fork(self):
+        "An independent copy of this State, that can be run on with different commands."
+        return self.checkpoint().fork()
 
     # commands that the user may issue and we will exec()
     def selectWorkers(self, kinds, action=None, num=None, pos=None):
@@ -591,7 +1462,12 @@ class State:
                 elif w.actionQueue[-1].name != action:
                     return False
             return True
-        result = [w for w in self.workers if filter(w)]
+        if action != None:
+            # only look at the workers doing that
+            doing = self.activity.members.get(None if action == "idle" else action, {})
+            result = sorted([w for w in doing if filter(w)], key=lambda w: w.index)
+        else:
+            result = [w for w in self.workers if filter(w)]
         if num == None:
             self.previousSelection = result
             return result
@@ -604,7 +1480,7 @@ class State:
     def selectBuilding(self, kind, pos=None, index=None):
         if index != None:
             return self.buildingLists[kind][index-1]
-        buildings = [b for b in self.buildingLists[kind] if pos == None or posEqual(b.position, pos)]
+        buildings = self.buildingLists[kind] if pos == None else self.buildingsAt(kind, pos)
         # give priority to idle buildings
         idleBuildings = [b for b in buildings if b.actionQueue == []]
         if idleBuildings != []:
@@ -678,12 +1554,14 @@ class State:
 
     def train(self, building, unitKind, numUnits, repeating=False, queued=False, waypoint=((0,0), None), maxBatching = False):
         if not queued: building.clearActionQueue(self)
-        building.actionQueue.insert(0, Train(unitKind, numUnits, waypoint, repeating, maxBatching))
+        building.actionQueue.insert(0, Train(unitKind, self, numUnits, waypoint, repeating, maxBatching))
 
     def research(self, building, techName, queued=False):
-        assert(costs[techName][5] == building.kind)
+        assert(self.civ.costs[techName][5] == building.kind)
+        for before in self.civ.requires.get(techName, ()):
+            assert before in self.upgrades, techName + " needs " + before + " researched first"
         if not queued: building.clearActionQueue(self)
-        building.actionQueue.insert(0, Research(techName))
+        building.actionQueue.insert(0, Research(techName, self))
 
     def setWaypoint(self, building, pos, command="walk"):
         "Supported: walk berries chicken chop farm"
@@ -698,115 +1576,2679 @@ class State:
         else:
             building.waypointSchedule = WaypointSchedule(schedule)
 
-# maps an unit or building to the resources needed to train/build it.  [food, wood, stone, metal, time]
-costs = {}
-
-HOUSEPOP = 5
-CIV="mau"
-
-def setMauryas():
-    global CIV, HOUSEPOP
-    costs["horse"] = [100,50,0,0,15]
-    costs["sheep"] = [50,0,0,0,40]
-    costs["male"] = [50,50,0,0,10]
-    costs["female"] = [50,0,0,0,8]
-    costs["trader"] = [100,0,0,80,15]
-    costs["champ"] = [150,80,0,100,25]
-    costs["elephant"] = [100,0,0,0,11]
-    units = "horse sheep male female trader champ".split()
-
-    costs["house"] = [0, 75, 0, 0, 30]
-    HOUSEPOP = 5
-    costs["storehouse"] = [0, 100, 0, 0, 40]
-    costs["farmstead"] = [0, 100, 0, 0, 45]
-    costs["field"] = [0, 100, 0, 0, 50]
-    costs["dock"] = [0, 200, 0, 0, 150]
-    costs["cc"] = [0, 300, 300, 250, 500]
-    costs["corral"] = [0, 100, 0, 0, 50]
-    costs["barracks"] = [0, 300, 0, 0, 150]
-    costs["temple"] = [0, 0, 150, 0, 100]
-    costs["market"] = [0, 300, 0, 0, 150]
-    costs["blacksmith"] = [0, 200, 0, 0, 120]
-    costs["tower"] = [0, 100, 100, 0, 150]
-    costs["elephantstable"] = [0, 200, 200, 0, 180]
-    costs["arsenal"] = [0, 300, 0, 0, 180]
-    costs["palace"] = [0, 0, 200, 200, 200]
-    costs["castle"] = [0, 300, 600, 0, 450]
-
-    costs["up_chop1"] = [ 0, 200, 0, 100, 40, "storehouse"]
-    costs["up_chop2"] = [ 0, 400, 0, 200, 50, "storehouse"]
-    costs["up_chop3"] = [ 0, 600, 0, 300, 60, "storehouse"]
-    costs["up_stone1"] = [ 200, 0, 100, 0, 40, "storehouse"]
-    costs["up_stone2"] = [ 300, 0, 200, 0, 50, "storehouse"]
-    costs["up_stone3"] = [ 400, 0, 300, 0, 60, "storehouse"]
-    costs["up_metal1"] = [ 200, 0, 0, 100, 40, "storehouse"]
-    costs["up_metal2"] = [ 300, 0, 0, 200, 50, "storehouse"]
-    costs["up_metal3"] = [ 400, 0, 0, 300, 60, "storehouse"]
-    costs["up_gather"] = [ 0, 100, 0, 0, 40, "farmstead"]
-    costs["up_farm1"] = [ 0, 200, 0, 100, 40, "farmstead"]
-    costs["up_farm2"] = [ 0, 300, 0, 100, 50, "farmstead"]
-    costs["up_farm3"] = [ 0, 400, 0, 100, 60, "farmstead"]
-    costs["up_trade1"] = [ 0, 150, 0, 150, 40, "market"]
-    costs["up_trade2"] = [ 0, 300, 0, 300, 40, "market"]
-
-    costs["II"] = [500, 500, 0, 0, 30]
-    costs["III"] = [0, 0, 750, 750, 60]
-
-    CIV = "mau"
-    
-setMauryas()
+# State fields that a Checkpoint doesn't copy, and gets back some other way
+unpickledFields = set(["program", "commands", "eventEngine", "until"])
+
+class CheckpointPickler(pickle.Pickler):
+    """Pickles the fields of a State, leaving out what is shared by all its
+    forks and never changes: module globals, the compiled commands and the
+    carry cycles. Those are saved as references instead."""
+    def __init__(self, file, state):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.shared = {id(state): ("state",)}
+        for name, value in globals().items():
+            # plain values in globals may be equal to, but aren't, the ones in the State,
+            # and main puts the State and its cc in globals, which the copy needs its own of
+            if not isinstance(value, (int, float, str, tuple, type(None), State, Actor)):
+                self.shared[id(value)] = ("global", name)
+        for key, cycle in carryCycles.items():
+            self.shared[id(cycle)] = ("cycle",) + key
+        for i, block in enumerate(state.program):
+            if block.stopwhen != None:
+                self.shared[id(block.stopwhen[1])] = ("stopwhen", i)
+
+    def persistent_id(self, obj):
+        return self.shared.get(id(obj))
+
+class CheckpointUnpickler(pickle.Unpickler):
+    def __init__(self, file, state):
+        super().__init__(file)
+        self.state = state
+
+    def persistent_load(self, pid):
+        if pid[0] == "state":
+            return self.state
+        if pid[0] == "global":
+            # the main program's own variables, like its parser, aren't there in a
+            # subcommand reading a checkpoint it wrote, and commands don't use them
+            return globals().get(pid[1])
+        if pid[0] == "cycle":
+            return carryCycle(pid[1], pid[2])
+        if pid[0] == "stopwhen":
+            return self.state.program[pid[1]].stopwhen[1]
+        raise pickle.UnpicklingError("unknown reference " + repr(pid))
+
+class Checkpoint:
+    "What State.checkpoint() returns: the changing parts of a State, pickled."
+    def __init__(self, data, program, commands, engine):
+        self.data = data
+        self.program = program
+        self.commands = commands
+        self.engine = engine
+
+    def fork(self):
+        "A new State that carries on from the checkpoint."
+        state = State.__new__(State)
+        state.program = self.program
+        state.commands = self.commands
+        state.until = None
+        state.__dict__.update(CheckpointUnpickler(io.BytesIO(self.data), state).load())
+        if self.engine != "tick":
+            state.eventEngine = EventEngine(state, cohorts = self.engine == "cohort")
+        return state
+
+class Patch:
+    "Event engine bookkeeping for one forest, berry bush or chicken entry."
+    def __init__(self, gatherable, time):
+        self.gatherable = gatherable
+        self.members = {} # unit -> Gather action
+        self.rates = None # member rates in State.step order, or None if members changed
+        self.settled = time
+        # Set when the resource may run out soon. Then every member acts every
+        # second and takes its own share, exactly like the tick engine.
+        self.ticking = False
+
+    def settle(self, time, engine):
+        "Subtract what the lazy members gathered in the seconds before time."
+        if not self.ticking and self.members and time > self.settled:
+            if self.rates == None:
+                self.rates = [a.rate for u, a in sorted(self.members.items(), key=lambda m: engine.order(m[0]))]
+            amount = self.gatherable[2]
+            for i in range(time - self.settled):
+                for rate in self.rates:
+                    amount -= rate
+            assert(amount >= 0)
+            self.gatherable[2] = amount
+        self.settled = time
+
+class Cohort:
+    """Event engine bookkeeping for lazy gatherers that drop off the same
+    resource in the same amount on the same second. They are woken as one
+    actor instead of one by one."""
+    def __init__(self, key):
+        self.key = key # (resourceIndex, carry cycle, dropoff second)
+        self.members = [] # (order, unit, Gather action), sorted by order
+        self.next = 0 # index of the first member that hasn't dropped off yet this second
+
+# Sort keys of buildings start here, so workers act first like in State.step
+BUILDING_ORDER = 2**40
+
+class EventEngine:
+    """Runs a State without calling act() on every unit every second.
+
+    Each unit is woken up only at the seconds where its action does something:
+    arriving from a walk, dropping off resources, finishing a foundation, a
+    batch or a tech, or running out of resource. In between, gathering and
+    building progress are caught up lazily with the same sequence of additions
+    that State.step would have done, so the output is identical to the tick
+    engine's. Seconds where nothing happens are jumped over, and so are the
+    empty batches of Trains waiting for pop room. After commands, only the
+    actors they gave something else to do are scheduled again."""
+
+    def __init__(self, state, cohorts=False):
+        self.state = state
+        self.cohorts = cohorts # whether to group gatherers into Cohorts
+        self.cohortAt = {} # Cohort.key -> Cohort
+        self.cohortOf = {} # unit -> Cohort it belongs to
+        self.wakes = {} # actor -> second at which it next acts
+        self.agenda = defaultdict(set) # second -> actors to wake then
+        self.checks = defaultdict(set) # second -> patches that might run out soon after
+        self.seconds = [] # heap of the seconds in agenda and checks
+        self.orders = {} # actor -> int sort key matching the order State.step acts in
+        self.knownWorkers = 0
+        self.patches = {} # id(gatherable) -> Patch
+        self.builders = defaultdict(set) # foundation -> units currently building it
+        self.gatherers = {} # order -> (unit, joined Gather action)
+        self.quiet = None # income of a second where nobody runs out, or None if gatherers changed
+        self.fold = [] # the (unit, Gather action) pairs quiet was added up from, in order
+        self.upgrades = None # len(state.upgrades) when gather rates were last computed
+        self.current = None # heap of actors still to act in the second being processed
+        self.queued = set() # actors that have been put in current
+        self.currentKey = None
+        self.shortSecond = False # whether a resource ran short during the second being processed
+        self.waiting = set() # Trains' buildings left asleep while they can only make empty batches
+
+    def order(self, actor):
+        key = self.orders.get(actor)
+        if key == None:
+            if isinstance(actor, Cohort):
+                return actor.members[actor.next][0]
+            workers = self.state.workers
+            for i in range(self.knownWorkers, len(workers)):
+                self.orders[workers[i]] = i
+            self.knownWorkers = len(workers)
+            key = self.orders.get(actor)
+        if key == None:
+            for k, kind in enumerate(self.state.buildingLists):
+                for i, building in enumerate(self.state.buildingLists[kind]):
+                    self.orders[building] = BUILDING_ORDER + (k << 20) + i
+            key = self.orders[actor]
+        return key
+
+    def wakeAt(self, actor, when):
+        self.wakes[actor] = when
+        if self.current != None and when == self.state.time:
+            if actor not in self.queued:
+                self.queued.add(actor)
+                heapq.heappush(self.current, (self.order(actor), actor))
+            return
+        if when not in self.agenda and when not in self.checks:
+            heapq.heappush(self.seconds, when)
+        self.agenda[when].add(actor)
+
+    def schedule(self, actor, earliest):
+        self.waiting.discard(actor)
+        if actor.actionQueue == []:
+            self.wakes.pop(actor, None)
+            return
+        a = actor.actionQueue[-1]
+        if self.cohorts and a.lazy and a.phase != None:
+            dropoff = a.settled + len(a.cycle) - 1 - a.phase
+            if dropoff >= earliest and dropoff > self.state.time:
+                self.addToCohort(actor, a, dropoff)
+                return
+        self.wakeAt(actor, a.nextWake(self.state, actor, earliest))
+
+    def addToCohort(self, unit, a, dropoff):
+        self.wakes.pop(unit, None)
+        key = (a.resourceIndex, id(a.cycle), dropoff)
+        cohort = self.cohortAt.get(key)
+        if cohort == None:
+            cohort = self.cohortAt[key] = Cohort(key)
+            self.wakeAt(cohort, dropoff)
+        member = (self.order(unit), unit, a)
+        if cohort.members == [] or member[0] > cohort.members[-1][0]:
+            cohort.members.append(member)
+        else:
+            cohort.members.insert(bisect.bisect(cohort.members, (member[0],)), member)
+        self.cohortOf[unit] = cohort
+
+    def removeCohort(self, cohort):
+        del self.cohortAt[cohort.key]
+        self.wakes.pop(cohort, None)
+
+    def split(self, unit):
+        "Take a unit out of its cohort, so it can be woken on its own."
+        cohort = self.cohortOf.pop(unit, None)
+        if cohort != None:
+            cohort.members = [m for m in cohort.members if m[1] is not unit]
+            if cohort.members == []:
+                self.removeCohort(cohort)
+
+    def dropOff(self, cohort, time):
+        """Do the dropoffs of a cohort's members, in order, until it is some
+        other actor's turn. Each member does what actOnce would do for it."""
+        s = self.state
+        resourceIndex = cohort.key[0]
+        amount = cohort.members[0][2].cycle[-1]
+        nextKey = self.current[0][0] if self.current != [] else None
+        members = cohort.members
+        i = cohort.next
+        while i < len(members) and (nextKey == None or members[i][0] < nextKey):
+            a = members[i][2]
+            s.resources[resourceIndex] += amount
+            a.resource = 0
+            a.phase = 0
+            a.settled = time + 1
+            i += 1
+        if i < len(members):
+            cohort.next = i
+            heapq.heappush(self.current, (members[i][0], cohort))
+            return
+        cohort.next = 0
+        # everyone drops off again together, along with anyone already waiting for that second
+        self.removeCohort(cohort)
+        key = (resourceIndex, cohort.key[1], time + len(members[0][2].cycle))
+        other = self.cohortAt.get(key)
+        if other == None:
+            cohort.key = key
+            self.cohortAt[key] = cohort
+            self.wakeAt(cohort, key[2])
+        else:
+            other.members = list(heapq.merge(other.members, members, key=lambda m: m[0]))
+            for m in members:
+                self.cohortOf[m[1]] = other
+
+    def earliest(self, actor):
+        "First second an actor can still act in, given how far the current second has got."
+        time = self.state.time
+        if self.current != None and self.order(actor) > self.currentKey:
+            return time
+        return time + 1
+
+    def finishTime(self, foundation):
+        "Second at which the current builders of a (settled) foundation complete it."
+        progress = foundation.progress
+        time = foundation.lastTimestepBuilt
+        rate = foundation.rate()
+        while progress < foundation.maxProgress:
+            time += 1
+            progress += rate
+        return time
+
+    def settleFoundation(self, foundation, time):
+        if self.builders.get(foundation) and not foundation.convertedToBuilding:
+            rate = foundation.rate()
+            for i in range(time - 1 - foundation.lastTimestepBuilt):
+                foundation.progress += rate
+            foundation.lastTimestepBuilt = max(foundation.lastTimestepBuilt, time - 1)
+
+    def patch(self, gatherable):
+        patch = self.patches.get(id(gatherable))
+        if patch == None:
+            patch = self.patches[id(gatherable)] = Patch(gatherable, self.state.time)
+        return patch
+
+    def checkPatch(self, patch, time):
+        "Switch a patch to ticking if it might run out in the next couple of seconds."
+        if patch.ticking or not patch.members:
+            return
+        patch.settle(time, self)
+        total = sum(a.rate for a in patch.members.values())
+        safe = int(patch.gatherable[2] // total) - 2
+        if safe > 0:
+            if time + safe not in self.agenda and time + safe not in self.checks:
+                heapq.heappush(self.seconds, time + safe)
+            self.checks[time + safe].add(patch)
+            return
+        patch.ticking = True
+        for unit, a in patch.members.items():
+            self.split(unit)
+            a.settle(self.state, unit, time)
+            a.lazy = False
+            self.wakeAt(unit, time)
+
+    def join(self, unit, a, time):
+        "A unit starts gathering this second."
+        s = self.state
+        a.joined = True
+        a.rate, a.capacity = s.gatherStats(a.gatherType, unit)
+        a.cycle = carryCycle(a.rate, a.capacity)
+        if a.resource == 0:
+            a.phase = 0
+        elif a.resource in a.cycle[:-1]:
+            # carrying exactly what it would after some seconds from empty, so it goes on the same way
+            a.phase = a.cycle.index(a.resource) + 1
+        else:
+            a.phase = None
+        a.settled = time
+        key = self.order(unit)
+        self.gatherers[key] = (unit, a)
+        if self.quiet != None and (self.fold == [] or key > self.order(self.fold[-1][0])):
+            # the newcomer comes last in State.step's order, so its rate is simply added on
+            self.fold.append((unit, a))
+            self.quiet[a.resourceIndex] += a.rate
+        else:
+            self.quiet = None
+        a.lazy = True
+        if isinstance(a, DepletableGather):
+            patch = self.patch(a.gatherable)
+            patch.settle(time, self)
+            patch.members[unit] = a
+            patch.rates = None
+            a.lazy = not patch.ticking
+
+    def leave(self, unit, a):
+        del self.gatherers[self.order(unit)]
+        self.quiet = None
+        if isinstance(a, DepletableGather):
+            patch = self.patch(a.gatherable)
+            del patch.members[unit]
+            patch.rates = None
+
+    def allActors(self):
+        yield from self.state.workers
+        for kind in self.state.buildingLists:
+            yield from self.state.buildingLists[kind]
+
+    def settleAll(self, time):
+        "Bring every lazily tracked number up to date, e.g. before commands look at them."
+        if self.upgrades == None:
+            return
+        for actor in self.allActors():
+            if actor.actionQueue != []:
+                actor.actionQueue[-1].settle(self.state, actor, time)
+        for patch in self.patches.values():
+            patch.settle(time, self)
+        for foundation in self.builders:
+            self.settleFoundation(foundation, time)
+
+    def resync(self, time):
+        "Rebuild the schedule from scratch, after commands or an upgrade changed things."
+        s = self.state
+        self.wakes.clear()
+        self.agenda.clear()
+        self.checks.clear()
+        self.seconds = []
+        self.patches.clear()
+        self.builders.clear()
+        self.gatherers.clear()
+        self.cohortAt.clear()
+        self.cohortOf.clear()
+        self.waiting.clear()
+        self.quiet = None
+        self.upgrades = len(s.upgrades)
+        for unit in s.workers:
+            if unit.actionQueue == []:
+                continue
+            a = unit.actionQueue[-1]
+            if isinstance(a, Gather) and a.joined:
+                self.join(unit, a, time)
+            elif isinstance(a, Build) and a.startedYet and not a.foundation.convertedToBuilding:
+                self.builders[a.foundation].add(unit)
+        for patch in list(self.patches.values()):
+            self.checkPatch(patch, time)
+        for actor in self.allActors():
+            self.schedule(actor, time)
+
+    def doing(self):
+        "Each actor with the action it is doing, or None, to see afterwards which ones commands changed."
+        return [(actor, actor.actionQueue[-1] if actor.actionQueue != [] else None) for actor in self.allActors()]
+
+    def update(self, time, before):
+        """Reschedule the actors that commands gave something else to do, leaving the
+        rest of the schedule as it was. before is what doing() returned before the commands."""
+        s = self.state
+        if len(before) != len(s.workers) + sum(len(buildings) for buildings in s.buildingLists.values()):
+            self.resync(time)
+            return
+        joined = []
+        for actor, old in before:
+            a = actor.actionQueue[-1] if actor.actionQueue != [] else None
+            if a is old:
+                continue
+            self.split(actor)
+            if isinstance(old, Gather) and old.joined and self.gatherers.get(self.order(actor), (None,))[0] is actor:
+                self.leave(actor, old)
+            elif isinstance(old, Build) and actor in self.builders.get(old.foundation, ()):
+                self.builders[old.foundation].discard(actor)
+                for builder in self.builders[old.foundation]:
+                    self.schedule(builder, time)
+                if not self.builders[old.foundation]:
+                    del self.builders[old.foundation]
+            if isinstance(a, Gather) and a.joined:
+                self.join(actor, a, time)
+                joined.append(a)
+            elif isinstance(a, Build) and a.startedYet and not a.foundation.convertedToBuilding:
+                self.builders[a.foundation].add(actor)
+            self.schedule(actor, time)
+        for a in joined:
+            if isinstance(a, DepletableGather):
+                self.checkPatch(self.patch(a.gatherable), time)
+
+    def prepare(self, time):
+        "Things that must happen before anyone acts this second. Returns the actors to wake."
+        for actor in self.agenda.pop(time, ()):
+            if self.wakes.get(actor) != time:
+                continue
+            if isinstance(actor, Cohort):
+                self.wakeAt(actor, time)
+                continue
+            a = actor.actionQueue[-1]
+            if isinstance(a, Gather) and not a.joined:
+                self.join(actor, a, time)
+                if isinstance(a, DepletableGather):
+                    self.checkPatch(self.patch(a.gatherable), time)
+                self.schedule(actor, time)
+            elif isinstance(a, Build) and not a.startedYet:
+                # the foundation is about to get another builder, which changes
+                # its rate, so everyone already building it acts this second too
+                for foundation in self.candidates(a):
+                    for builder in self.builders.get(foundation, ()):
+                        self.wakeAt(builder, time)
+                self.wakeAt(actor, time)
+            else:
+                self.wakeAt(actor, time)
+        for patch in self.checks.pop(time, ()):
+            self.checkPatch(patch, time)
+        return [actor for actor in self.agenda.pop(time, ()) if self.wakes.get(actor) == time]
+
+    def candidates(self, build):
+        "Foundations a Build that hasn't started may join."
+        if build.foundation != None:
+            return [build.foundation]
+        return self.state.foundationsAt(build.kind, build.position)
+
+    def actOnce(self, actor, time):
+        s = self.state
+        a = actor.actionQueue[-1]
+        if a.lazy and a.phase != None and time == a.settled + len(a.cycle) - 1 - a.phase:
+            # A gatherer's dropoff. This is what Gather.act would do on this second.
+            s.resources[a.resourceIndex] += a.cycle[-1]
+            a.resource = 0
+            a.phase = 0
+            a.settled = time + 1
+            self.schedule(actor, time + 1)
+            return
+        a.settle(s, actor, time)
+        before = None
+        if isinstance(a, Build):
+            if a.startedYet:
+                before = a.foundation
+                self.settleFoundation(before, time)
+            else:
+                for foundation in self.candidates(a):
+                    self.settleFoundation(foundation, time)
+        numWorkers = len(s.workers)
+        a.act(s, actor)
+        a.settled = time + 1
+        if isinstance(a, Train) and a.maxBatching and a.repeating and a.count == 0 and s.recorder == None and self.noPopRoom():
+            # it makes an empty batch every second, which changes nothing, until there is pop room
+            self.wakes.pop(actor, None)
+            self.waiting.add(actor)
+            return
+        if isinstance(a, DepletableGather) and a.shortfall == time:
+            self.shortSecond = True
+        stillActing = actor.actionQueue != [] and actor.actionQueue[-1] is a
+        if isinstance(a, Gather) and a.joined:
+            if not stillActing:
+                self.leave(actor, a)
+            elif a.resource == 0:
+                a.phase = 0
+            elif a.phase != None:
+                a.phase += 1
+        if isinstance(a, Build):
+            after = a.foundation if stillActing and a.startedYet else None
+            if before != None and before is not after:
+                self.builders[before].discard(actor)
+            if after != None and not after.convertedToBuilding:
+                self.builders[after].add(actor)
+            for foundation in set([before, after]) - set([None]):
+                for builder in list(self.builders.get(foundation, ())):
+                    if builder is not actor:
+                        self.schedule(builder, self.earliest(builder))
+                if not self.builders.get(foundation):
+                    self.builders.pop(foundation, None)
+        self.schedule(actor, time + 1)
+        for i in range(numWorkers, len(s.workers)):
+            self.schedule(s.workers[i], time + 1)
+
+    def noPopRoom(self):
+        """Whether a Train with maxBatching can only make empty batches: the pop is at
+        maxPop, and no resource is below 0, which would make findMaxBatch negative."""
+        s = self.state
+        return s.pop == s.maxPop and min(s.resources) >= 0
+
+    def wakeWaiting(self, time=None):
+        """Wake the Trains left asleep by actOnce, once there may be pop room: at time,
+        or if not given, at the first second each can still act in."""
+        for building in list(self.waiting):
+            self.schedule(building, time if time != None else self.earliest(building))
+
+    def quietIncome(self):
+        "Income of a second in which every gatherer takes its full rate."
+        if self.quiet == None:
+            self.fold = [self.gatherers[key] for key in sorted(self.gatherers)]
+            self.quiet = [0, 0, 0, 0]
+            for unit, a in self.fold:
+                self.quiet[a.resourceIndex] += a.rate
+        return self.quiet
+
+    def income(self, fold, quiet, time):
+        "Income of this second, added up in the same order as State.step does."
+        if not self.shortSecond:
+            return quiet
+        income = [0, 0, 0, 0]
+        for unit, a in fold:
+            qty = a.rate
+            if isinstance(a, DepletableGather) and a.shortfall == time:
+                qty = a.shortAmount
+            if qty != 0:
+                income[a.resourceIndex] += qty
+        return income
+
+    def tick(self, code=None):
+        "Same as State.step, but only waking the actors that have something to do."
+        s = self.state
+        time = s.time
+        s.beginStep()
+        if code != None and self.upgrades == len(s.upgrades):
+            self.settleAll(time)
+            before = self.doing()
+            s.execCommands(code)
+            if self.upgrades == len(s.upgrades):
+                self.update(time, before)
+            else:
+                self.resync(time)
+        elif code != None or self.upgrades != len(s.upgrades):
+            self.settleAll(time)
+            s.execCommands(code)
+            self.resync(time)
+        if self.waiting and not self.noPopRoom():
+            self.wakeWaiting(time)
+        due = self.prepare(time)
+        quiet = list(self.quietIncome())
+        fold = self.fold
+        self.current = [(self.order(actor), actor) for actor in due]
+        heapq.heapify(self.current)
+        self.queued = set(due)
+        self.shortSecond = False
+        while self.current != []:
+            key, actor = heapq.heappop(self.current)
+            if self.wakes.get(actor) != time:
+                continue
+            self.currentKey = key
+            if isinstance(actor, Cohort):
+                self.dropOff(actor, time)
+            else:
+                self.actOnce(actor, time)
+            if self.waiting and not self.noPopRoom():
+                self.wakeWaiting()
+        self.current = None
+        s.income = self.income(fold, quiet, time)
+        return s.endStep()
+
+    def nextSecond(self):
+        "The next second at which some actor or patch needs attention."
+        while self.seconds != []:
+            second = self.seconds[0]
+            if second >= self.state.time and (self.checks.get(second) or any(self.wakes.get(a) == second for a in self.agenda.get(second, ()))):
+                return second
+            # nothing left to do then
+            heapq.heappop(self.seconds)
+            self.agenda.pop(second, None)
+            self.checks.pop(second, None)
+        return None
+
+    def skipQuiet(self, stopTime):
+        """Jump over the seconds in which nothing happens. Summaries that fall in them
+        are printed on the way, the same as a tick of that second would. Returns False
+        if the State's until stops the run in one of them."""
+        s = self.state
+        if s.stopCode != None or self.upgrades != len(s.upgrades):
+            return True
+        target = stopTime
+        second = self.nextSecond()
+        if second != None and second < target:
+            target = second
+        if target <= s.time:
+            return True
+        income = self.quietIncome()
+        summaries = not (s.quiet and s.recorder == None)
+        while s.time < target:
+            summary = summaries and s.time % s.summaryPeriod == 0
+            if summary:
+                s.summary()
+            s.checkSurplus()
+            s.income = list(income)
+            if summary or any(s.civ.trickle) or s.until != None:
+                if not s.endStep():
+                    return False
+            elif summaries:
+                s.time = min(target, s.time + s.summaryPeriod - s.time % s.summaryPeriod)
+            else:
+                s.time = target
+        return True
+
+    def run(self, code, stopTime):
+        "Same contract as State.runSteps."
+        s = self.state
+        if not self.tick(code):
+            return False
+        while s.time < stopTime:
+            if not self.skipQuiet(stopTime):
+                return False
+            if s.time < stopTime and not self.tick():
+                return False
+        return True
+
+class CivTable:
+    """What a civ's units, buildings and techs cost, and the other numbers about
+    the civ that the simulation needs. Loaded once from civs.json and never
+    changed afterwards, so every State, and every fork of one, can share it."""
+    def __init__(self, name, costs, housePop, trickle, requires):
+        self.name = name
+        # maps an unit, building or tech to the resources needed to train/build/research it.
+        # [food, wood, stone, metal, time], then for techs the building that researches them
+        self.costs = types.MappingProxyType({kind: tuple(cost) for kind, cost in costs.items()})
+        self.housePop = housePop # pop room each house gives
+        self.trickle = tuple(trickle) # resources gained every second without gathering
+        # maps a tech to the techs that have to be researched before it
+        self.requires = types.MappingProxyType({tech: tuple(before) for tech, before in requires.items()})
+
+    def __reduce__(self):
+        # pickle as a reference to the loaded table, so a checkpoint doesn't copy it
+        return (civTable, (self.name,))
+
+civsFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "civs.json")
+civTables = None # map from civ abbreviation to CivTable, filled by civTable
+defaultCiv = None # abbreviation of the civ a run starts as
+civsDigest = None # hash of civs.json as loaded, for cache keys
+
+def loadCivs(filename):
+    """Read the civ tables from a file like civs.json, which has the numbers of
+    the default civ under "base" and what each civ changes under "civs"."""
+    data = open(filename, "rb").read()
+    tables = json.loads(data)
+    base = tables["base"]
+    civs = {}
+    for name, changes in tables["civs"].items():
+        costs = dict(base["costs"])
+        costs.update(changes.get("costs", {}))
+        requires = dict(base["requires"])
+        requires.update(changes.get("requires", {}))
+        civs[name] = CivTable(name, costs, changes.get("housePop", base["housePop"]), changes.get("trickle", base["trickle"]), requires)
+    return civs, tables["default"], hashlib.sha256(data).hexdigest()
+
+def civTable(civ=None):
+    "The CivTable for a civ abbreviation like \"mau\", or the default civ's."
+    global civTables, defaultCiv, civsDigest
+    if civTables == None:
+        civTables, defaultCiv, civsDigest = loadCivs(civsFile)
+    return civTables[civ if civ != None else defaultCiv]
 
 # use abbreviations so the user can say "carth" or "carthage" or "carthaginians" and it will be understood
-civs = "ath bri car gau han ibe kus mac mau per pto rom sel spa".split()
 def resolveCiv(civ):
-    for c in civs:
+    civTable()
+    for c in civTables:
         if c == civ.strip().lower()[:3]:
             return c
     return None
 
-def setCiv(civ):
-    global CIV, HOUSEPOP
-    civ = resolveCiv(civ)
-    if civ == None:
-        raise Exception("What civ is " + civ + "?")
-    CIV = civ
-    setMauryas()
-    if civ == "mau":
-        return
-    if civ in "bri gau".split():
-        costs["temple"] = [0, 0, 300, 0, 200]
+class DiskCache:
+    """Files in a directory named after their key. Once they add up to more
+    than maxBytes, the least recently used ones are deleted, down to 90% of it."""
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        os.makedirs(directory, exist_ok=True)
+        self.total = None # bytes in the directory when it was last looked at, plus what was put since
+        self.puts = 0 # puts since then
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        "The data stored under key, or None."
+        try:
+            with open(self.path(key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(self.path(key)) # mark it as recently used
+        return data
+
+    def put(self, key, data):
+        temp = self.path(key) + ".tmp" + str(os.getpid())
+        with open(temp, "wb") as f:
+            f.write(data)
+        os.replace(temp, self.path(key))
+        self.puts += 1
+        if self.total != None:
+            self.total += len(data)
+        # other processes may be putting files in the directory too, so it's looked at again every so often
+        if self.total == None or self.total > self.maxBytes or self.puts >= 100:
+            self.evict()
+
+    def evict(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for mtime, size, path in files)
+        if total > self.maxBytes:
+            for mtime, size, path in sorted(files):
+                if total <= self.maxBytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError: # another run got there first
+                    pass
+                total -= size
+        self.total = total
+        self.puts = 0
+
+def engineVersion():
+    "Changes whenever the simulator's code does."
+    global _engineVersion
+    if _engineVersion == None:
+        _engineVersion = hashlib.sha256(open(__file__, "rb").read()).hexdigest()
+    return _engineVersion
+_engineVersion = None
+
+def prefixKeys(state):
+    """Cache key for the checkpoint after each block of the state's commands.
+    The key of a block covers every block up to it, the engine and its code,
+    and the civ tables."""
+    civTable()
+    keys = []
+    h = hashlib.sha256(repr((engineVersion(), civsDigest, state.engine, state.recorder != None)).encode())
+    for block in state.program:
+        h.update(b"\0" + block.text.encode())
+        keys.append(h.copy().hexdigest())
+    return keys
+
+def resumeCached(commandFile, engine, cache, full=False, commands=None, quiet=False, record=False):
+    """A State for a command file, forked from the latest checkpoint in cache whose
+    commands haven't changed since, unless full. Returns it with its prefixKeys."""
+    state = State(commandFile, engine, commands, quiet, record)
+    keys = prefixKeys(state)
+    for i in reversed(range(len(keys)) if cache != None and not full else []):
+        entry = cache.get(keys[i])
+        if entry == None:
+            continue
+        state = Checkpoint(entry, state.program, state.commands, engine).fork()
+        state.quiet = quiet
+        state.say("Resuming from {0:03d}:{1:02d}, as the commands up to there are the same as in an earlier run. Use --full to replay everything.".format(state.time // 60, state.time % 60))
+        break
+    return state, keys
+
+# Seconds of game time between checkpoints runCached saves. Making one takes about
+# as long as simulating that much, so saving one for every block of a busy build
+# would cost more than resuming from it could ever save.
+checkpointGap = 30
+
+def runCached(state, keys, cache, until=None, after=None):
+    """Run the rest of a State's commands, saving a checkpoint in cache after each block
+    that ends at least checkpointGap seconds after the last one saved, for later runs.
+    until, if given, is called with the State at the end of every second, and the run
+    stops early, there, if it returns True. after, if given, is called with the State
+    after each block."""
+    saved = state.time
+    state.until = until
+    try:
+        while state.doBlock():
+            if after != None:
+                after(state)
+            if cache == None or state.time - saved < checkpointGap:
+                continue
+            try:
+                checkpoint = state.checkpoint()
+            except (pickle.PicklingError, TypeError, AttributeError):
+                # the commands keep something around that can't be pickled, like a lambda
+                cache = None
+                continue
+            cache.put(keys[state.nextBlock - 1], checkpoint.data)
+            saved = state.time
+        if not state.stoppedEarly:
+            state.doCommands()
+    finally:
+        state.until = None
+
+TRACE_MAGIC = b"BOOMTRC1"
+
+class TraceWriter:
+    """Writes a trace file: the command lines, and a keyframe, a compressed Checkpoint,
+    at the start and after every block of them. The lines have a time line every
+    so many seconds, so Trace can rebuild the State at any second from the keyframe
+    before it by simulating at most that many seconds. Keyframes go into the file
+    as they come, and the index of where they are goes at the end."""
+    def __init__(self, filename, commandFile, lines, engine):
+        self.file = open(filename, "wb")
+        self.file.write(TRACE_MAGIC)
+        self.header = {"commandFile": commandFile, "lines": lines, "engine": engine, "engineVersion": engineVersion(), "keyframes": []}
+
+    def keyframe(self, state):
+        # what only grows, and would make every keyframe bigger than the last, is left out
+        left = {name: getattr(state, name) for name in ("recorder", "budget", "sampler")}
+        for name in left:
+            setattr(state, name, None)
+        try:
+            data = zlib.compress(state.checkpoint().data, 1)
+        finally:
+            for name, value in left.items():
+                setattr(state, name, value)
+        self.header["keyframes"].append([state.time, self.file.tell(), len(data)])
+        self.file.write(data)
+
+    def close(self):
+        index = self.file.tell()
+        self.file.write(json.dumps(self.header).encode())
+        self.file.write(struct.pack("<Q", index))
+        self.file.close()
+
+def traceLines(lines, every=10):
+    "The lines of a command file with a time line every so many seconds, for a trace to have keyframes at."
+    return withOrder(lines, None, 0, range(every, 24 * 3600, every))
+
+def runTraced(state, commandFile, filename):
+    """Run a new State, made from traceLines of commandFile, writing a trace of it to filename."""
+    trace = TraceWriter(filename, commandFile, state.commands, state.engine)
+    try:
+        trace.keyframe(state)
+        while state.doBlock():
+            trace.keyframe(state)
+        if state.finished: # the last block failed
+            trace.keyframe(state)
+        state.doCommands()
+    finally:
+        trace.close()
+
+class Trace:
+    """A trace file from TraceWriter, memory-mapped, for looking at the State at any
+    second of the run without running it again from the start."""
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(TRACE_MAGIC)] != TRACE_MAGIC:
+            raise Exception(filename + " is not a trace file")
+        index = struct.unpack("<Q", self.data[-8:])[0]
+        header = json.loads(self.data[index:-8])
+        if header["engineVersion"] != engineVersion():
+            print("Warning: " + filename + " was written by another version of boom.py", file=sys.stderr)
+        self.commandFile = header["commandFile"]
+        self.lines = header["lines"]
+        self.engine = header["engine"]
+        self.keyframes = header["keyframes"] # [time, offset, length]
+        self.times = [time for time, offset, length in self.keyframes]
+        self.program = compileCommands(self.lines, self.commandFile)
+        self.end = self.times[-1]
+
+    def state(self, time):
+        """The State at the start of second time, before that second's commands, or
+        at the end if the run ended before then."""
+        time = min(max(time, 0), self.end)
+        keyframe, offset, length = self.keyframes[bisect.bisect_right(self.times, time) - 1]
+        state = Checkpoint(zlib.decompress(self.data[offset:offset + length]), self.program, self.lines, self.engine).fork()
+        state.quiet = True
+        if state.time < time: # part of the way through the next block
+            block = self.program[state.nextBlock]
+            state.nextBlock += 1
+            if block.stopwhen != None:
+                state.stopwhen, state.stopCode = block.stopwhen
+            state.runSteps(block.code, time)
+        if state.engine != "tick":
+            state.eventEngine.settleAll(state.time) # so every actor and resource is up to date
+        return state
+
+# fields only the event engine keeps up, which describeFields leaves out
+engineFields = set(["name", "settled", "lazy", "joined", "rate", "capacity", "phase", "cycle", "shortfall", "shortAmount"])
+
+def describeFields(obj):
+    "name=value for the fields of an object with __slots__ that are numbers, strings or positions."
+    parts = []
+    for cls in type(obj).__mro__:
+        for name in getattr(cls, "__slots__", ()):
+            if name in engineFields or not hasattr(obj, name):
+                continue
+            value = getattr(obj, name)
+            if isinstance(value, float):
+                value = "{0:.4g}".format(value)
+            elif isinstance(value, (list, tuple)) and all(isinstance(v, (int, float)) for v in value) and not isinstance(value, ActionQueue):
+                value = "(" + ", ".join("{0:.4g}".format(v) for v in value) + ")"
+            elif not isinstance(value, (int, str, type(None))):
+                continue
+            parts.append("{0}={1}".format(name, value))
+    return " ".join(parts)
+
+def describeState(state):
+    "Lines describing everything about a State, for boom.py inspect."
+    lines = [formatTime(state.time) + " " + "{0:.0f}f {1:.0f}w {2:.0f}s {3:.0f}m".format(*state.resources) + " {0}/{1}pop".format(state.pop, state.maxPop) + (", failed: " + state.failure if state.failure != None else "")]
+    if state.upgrades != []:
+        lines.append("upgrades: " + ", ".join(state.upgrades))
+    def describeQueue(actor):
+        # the current action is last
+        return " | ".join(a.name + (" (" + describeFields(a) + ")" if describeFields(a) else "") for a in reversed(actor.actionQueue)) or "idle"
+    lines.append("units:")
+    for i, w in enumerate(state.workers):
+        lines.append("  {0} {1} at ({2:.4g}, {3:.4g}): {4}".format(i, w.kind, w.position[0], w.position[1], describeQueue(w)))
+    lines.append("buildings:")
+    for kind in sorted(state.buildingLists):
+        for b in state.buildingLists[kind]:
+            lines.append("  {0} at {1}: {2}".format(kind, tuple(b.position), describeQueue(b)))
+    lines.append("foundations:")
+    for kind in sorted(state.foundationLists):
+        for f in state.foundationLists[kind]:
+            lines.append("  {0} at {1}: {2:.4g}/{3:.4g} built by {4}".format(kind, tuple(f.position), f.progress, f.maxProgress, f.builders))
+    for name, gatherables in (("forests", state.forestList), ("berries", state.berriesList), ("chickens", state.chickenList)):
+        if gatherables != []:
+            lines.append(name + ": " + ", ".join("{0:.0f} at ({1}, {2})".format(g[2], g[0], g[1]) for g in gatherables))
+    return lines
+
+def inspectMain(argv):
+    parser = argparse.ArgumentParser(prog="boom.py inspect", description="Show everything about a run at some second, from a trace written with --trace.")
+    parser.add_argument("trace", help="trace file")
+    parser.add_argument("--at", action="append", required=True, help="time like 09:40, can be given several times")
+    parser.add_argument("--pdb", action="store_true", help="then stop in pdb with the State of the last --at in state")
+    args = parser.parse_args(argv)
+    trace = Trace(args.trace)
+    for at in args.at:
+        minutes, seconds = at.split(":")
+        state = trace.state(int(minutes) * 60 + int(seconds))
+        print("\n".join(describeState(state)))
+    if args.pdb:
+        import pdb
+        pdb.set_trace()
+
+def formatTime(seconds):
+    return "{0:03d}:{1:02d}".format(seconds // 60, seconds % 60)
+
+class Timeline:
+    "What --watch compares between runs of a command file."
+    def __init__(self, state, error):
+        self.error = error # the exception the run ended with, as text, or None
+        if state == None:
+            self.rows, self.events, self.failure, self.surplus, self.end = [], [], None, 0, 0
+            return
+        self.rows = list(zip(*state.recorder.table()[1]))
+        self.events = list(zip(*state.recorder.table(events=True)[1]))
+        self.failure = state.failure
+        self.surplus = state.surplusStep
+        self.end = state.time
+
+    def changes(self, before):
+        "Lines describing how this run differs from before, an earlier Timeline of the same file."
+        lines = []
+        divergence = None
+        for rows, describe in ((self.rows, describeRow), (self.events, describeEvent)):
+            old = before.rows if rows is self.rows else before.events
+            for i in range(max(len(rows), len(old))):
+                a = old[i] if i < len(old) else None
+                b = rows[i] if i < len(rows) else None
+                if a != b:
+                    time = min(row[0] for row in (a, b) if row != None)
+                    if divergence == None or time < divergence[0]:
+                        divergence = (time, describe(a, b))
+                    break
+        if divergence != None:
+            lines.append("First difference at " + formatTime(divergence[0]) + ": " + divergence[1])
+        if self.failure != before.failure:
+            lines.append("Failure: {0}, was {1}".format(self.failure or "none", before.failure or "none"))
+        if self.surplus != before.surplus:
+            lines.append("Surplus from: {0}, was {1}".format(formatTime(self.surplus) if self.surplus != 0 else "none", formatTime(before.surplus) if before.surplus != 0 else "none"))
+        if self.end != before.end:
+            lines.append("Ends at {0}, was {1}".format(formatTime(self.end), formatTime(before.end)))
+        if self.error != before.error:
+            lines.append("Error: {0}, was {1}".format(self.error or "none", before.error or "none"))
+        return lines
+
+def describeRow(before, after):
+    "How two summary rows of a Recorder differ, either of which may be None."
+    if before == None or after == None:
+        return "summary {0}".format("added" if before == None else "gone")
+    names = [name for name, typecode in Recorder.columns]
+    return ", ".join("{0} {1:.0f} -> {2:.0f}".format(name, a, b) for name, a, b in zip(names, before, after) if a != b)
+
+def describeEvent(before, after):
+    "How two events of a Recorder differ, either of which may be None."
+    describe = lambda e: "{1} {2}{4} by {3} at {0}".format(formatTime(e[0]), e[1], e[2], e[3], " x" + str(e[4]) if e[4] != 1 else "")
+    if before == None:
+        return describe(after) + ", which didn't happen before"
+    if after == None:
+        return describe(before) + " no longer happens"
+    return describe(after) + ", was " + describe(before)
+
+def normalizedCommands(lines, filename="<commands>"):
+    """The commands of a command file as compileCommands reads them, without comments,
+    blank lines or spacing that doesn't change what they do, so that two files
+    that only differ in those have the same resultKey. A line that can't be read
+    raises a BuildError, as in compileCommands."""
+    normal = []
+    try:
+        for lineno, command in enumerate(lines, 1):
+            command = command.split("#")[0]
+            if command[:5] == "time ":
+                nums = command.split(" ")[1].split(":")
+                normal.append("time " + str(int(nums[0]) * 60 + int(nums[1])))
+            elif command[:9] == "stopwhen ":
+                normal.append("stopwhen " + ast.dump(parseCommand(command[9:].strip(), filename, lineno, "eval")))
+            elif command.strip() != "":
+                normal.append(ast.dump(parseCommand(command.strip(), filename, lineno)))
+    except readErrors as e:
+        raise BuildError(e) from e
+    return normal
+
+def resultKey(lines, filename="<commands>"):
+    """ResultCache key for a whole run of a command file: its normalized commands,
+    the civ tables and the simulator's code. Not the engine, as they all give the same result."""
+    civTable()
+    h = hashlib.sha256(repr((engineVersion(), civsDigest)).encode())
+    for command in normalizedCommands(lines, filename):
+        h.update(b"\0" + command.encode())
+    return h.hexdigest()
+
+class RunResult:
+    """How a whole run came out, small enough to keep in a ResultCache: when and why it
+    ended, its last summary line, its resources then, when it reached each population,
+    when the surplus started, and with a Recorder, its Timeline."""
+    def __init__(self, state, error, timeline=False):
+        self.error = error # the exception the run ended with, as text, or None
+        self.timeline = Timeline(state, error) if timeline else None
+        if state == None:
+            self.end, self.summary, self.resources, self.popTimes, self.surplusStep, self.failure = 0, None, None, [], 0, None
+            return
+        self.end = state.time
+        self.summary = state.summaryLine()
+        self.resources = list(state.resources)
+        self.popTimes = list(state.popTimes)
+        self.surplusStep = state.surplusStep
+        self.failure = state.failure
+
+    def toJSON(self):
+        data = dict(vars(self))
+        if self.timeline != None:
+            data["timeline"] = vars(self.timeline)
+        return json.dumps(data).encode()
+
+def loadResult(data):
+    "A RunResult from its toJSON()."
+    result = RunResult(None, None)
+    vars(result).update(json.loads(data))
+    if result.timeline != None:
+        timeline = Timeline(None, None)
+        vars(timeline).update(result.timeline)
+        # Timeline.changes compares rows and events as tuples
+        timeline.rows = [tuple(row) for row in timeline.rows]
+        timeline.events = [tuple(event) for event in timeline.events]
+        result.timeline = timeline
+    return result
+
+class ResultCache:
+    """RunResults of whole runs, in a DiskCache under their resultKey, so that a
+    command file that was run before doesn't need to be simulated again. The
+    directory can be shared between runs, processes and computers."""
+    def __init__(self, directory, maxBytes):
+        self.disk = DiskCache(directory, maxBytes)
+
+    def get(self, key, timeline=False):
+        "The RunResult stored under key, or None. With timeline, only one that has its Timeline."
+        data = self.disk.get(key)
+        if data == None:
+            return None
+        result = loadResult(data)
+        if timeline and result.timeline == None:
+            return None
+        return result
+
+    def put(self, key, result):
+        self.disk.put(key, result.toJSON())
+
+def resultCache(cacheDir, maxBytes):
+    "The ResultCache that goes with the checkpoints in cacheDir."
+    return ResultCache(os.path.join(cacheDir, "results"), maxBytes)
+
+def runResult(commandFile, engine, cache, results, full=False, commands=None, quiet=True, timeline=False, after=None):
+    """The RunResult of a command file, from results if it was run before with the same
+    commands and civ tables, and otherwise from running it, resuming from the checkpoints
+    in cache, after which it goes in results. Runs that print or are full are always simulated.
+    A BuildError is how the build came out, and goes in the RunResult; any other
+    exception, like from a cache that can't be read or written, is raised.
+    after is passed on to runCached."""
+    state = None
+    error = None
+    key = None
+    try:
+        if commands == None:
+            commands = open(commandFile).read().split("\n")
+        if results != None:
+            key = resultKey(commands, commandFile)
+            result = results.get(key, timeline) if quiet and not full else None
+            if result != None:
+                return result
+        state, keys = resumeCached(commandFile, engine, cache, full, commands, quiet, timeline)
+        runCached(state, keys, cache, after=after)
+    except BuildError as e:
+        error = str(e)
+        if not quiet:
+            print(error)
+    except RunFinished: # debugEnd()
+        pass
+    result = RunResult(state, error, timeline)
+    if key != None:
+        results.put(key, result)
+    return result
+
+def runTimeline(commandFile, engine, cache, results=None, quiet=True):
+    "Run a command file with a Recorder, resuming from cache, or look it up in results. Returns its Timeline."
+    return runResult(commandFile, engine, cache, results, quiet=quiet, timeline=True).timeline
+
+def watch(commandFile, engine, cache, results=None, interval=0.5):
+    """Run a command file, then again whenever it's saved, printing only what changed.
+    Unchanged blocks at the start come from the checkpoints in cache, and
+    commands that were run before come from results."""
+    stamp = None
+    before = None
+    while True:
+        try:
+            info = os.stat(commandFile)
+            newStamp = (info.st_mtime_ns, info.st_size)
+        except FileNotFoundError: # some editors save by replacing the file
+            newStamp = stamp
+        if newStamp != stamp:
+            stamp = newStamp
+            start = time.perf_counter()
+            timeline = runTimeline(commandFile, engine, cache, results, quiet=before != None)
+            took = " ({0:.2f}s)".format(time.perf_counter() - start)
+            if before == None:
+                print("Watching " + commandFile + " for changes" + took)
+            else:
+                print("\n".join(timeline.changes(before) or ["No change"]) + took)
+            sys.stdout.flush()
+            before = timeline
+        time.sleep(interval)
+
+def diffWorker(index, commandFile, engine, queue):
+    """Run a command file for boom.py diff in its own process, putting (index, rows, None)
+    on queue for each chunk of Sampler rows, and then (index, None, how it ended)."""
+    state = None
+    ending = None
+    try:
+        state = State(commandFile, engine, quiet=True)
+        state.sampler = Sampler(lambda rows: queue.put((index, rows, None)))
+        state.doCommands()
+    except Exception as e:
+        if state == None or not (state._debugEnd and str(e) == "Run finished."):
+            ending = "error: " + errorText(e)
+    if state != None:
+        state.sampler.record(state)
+        state.sampler.flush()
+        if state.failure != None:
+            ending = state.failure
+    queue.put((index, None, ending or "finished"))
+
+class Diff:
+    """Compares the Sampler rows of several runs second by second, as they come,
+    printing where they first differ, when each gets to each of pops units,
+    and every so many seconds how much more or less each has gathered than the first."""
+    def __init__(self, names, pops, every, out):
+        self.names = names
+        self.pops = pops
+        self.every = every
+        self.out = out
+        self.diverged = [False] * len(names)
+        self.popTimes = [[None] * len(pops) for name in names]
+        self.last = [None] * len(names) # latest row of each
+        self.endings = [None] * len(names) # how each run ended, once it has
+
+    def say(self, *args):
+        print(*args, file=self.out)
+        self.out.flush()
+
+    def second(self, time, rows):
+        "Compare the rows of one second, None for runs that have ended."
+        base = rows[0]
+        for i, row in enumerate(rows):
+            if i == 0 or self.diverged[i] or row == base:
+                continue
+            self.diverged[i] = True
+            if row == None or base == None:
+                what = "has ended" if row == None else "is still going"
+            else:
+                what = ", ".join(column + " " + describeNumbers(b, a) for column, a, b in zip(Sampler.columns[1:], base[1:], row[1:]) if a != b)
+            self.say(formatTime(time), self.names[i], "first differs from", self.names[0] + ":", what)
+        for i, row in enumerate(rows):
+            if row == None:
+                continue
+            self.last[i] = row
+            for k, pop in enumerate(self.pops):
+                if self.popTimes[i][k] == None and row[9] >= pop:
+                    self.popTimes[i][k] = time
+                    self.say(formatTime(time), self.names[i], "has", pop, "units" + (self.compared(time, self.popTimes[0][k]) if i != 0 else ""))
+        if time % self.every == 0 and time != 0:
+            parts = []
+            for name, row in zip(self.names, rows):
+                if row == None:
+                    continue
+                if base == None or row is base:
+                    parts.append(name + " " + "{0:.0f}f {1:.0f}w {2:.0f}s {3:.0f}m".format(*row[5:9]))
+                else:
+                    parts.append(name + " " + "{0:+.0f}f {1:+.0f}w {2:+.0f}s {3:+.0f}m".format(*[b - a for a, b in zip(base[5:9], row[5:9])]))
+            self.say(formatTime(time), "gathered:", "; ".join(parts))
+
+    def compared(self, time, baseTime):
+        "How a time compares with the first run's time of the same thing, or None."
+        if baseTime == None:
+            return ", " + self.names[0] + " not yet"
+        return ", {0:+d}s from {1}".format(time - baseTime, self.names[0])
+
+    def ended(self, index, ending):
+        self.endings[index] = ending
+        self.say(formatTime(self.last[index][0]) if self.last[index] != None else "", self.names[index], "ended:", ending)
+
+    def finish(self):
+        "Print a table of when each run got to each population, and how it ended."
+        width = max(len(name) for name in self.names) + 2
+        self.say("".ljust(10) + "".join(name.ljust(width) for name in self.names))
+        for k, pop in enumerate(self.pops):
+            self.say(("{0} units".format(pop)).ljust(10) + "".join((formatTime(times[k]) if times[k] != None else "never").ljust(width) for times in self.popTimes))
+        self.say("end".ljust(10) + "".join((formatTime(row[0]) if row != None else "").ljust(width) for row in self.last))
+        for i, resource in enumerate(["food", "wood", "stone", "metal"]):
+            self.say(resource.ljust(10) + "".join(("{0:.0f}".format(row[5 + i]) if row != None else "").ljust(width) for row in self.last))
+        for name, ending in zip(self.names, self.endings):
+            self.say(name + ":", ending)
+
+def describeNumbers(a, b):
+    "a vs b, with enough decimals to tell them apart."
+    for decimals in range(4):
+        if round(a, decimals) != round(b, decimals):
+            break
+    return "{0:.{2}f} vs {1:.{2}f}".format(a, b, decimals)
+
+def diffBuilds(commandFiles, engine="cohort", pops=(50, 100), every=60, out=sys.stdout):
+    """Simulate command files side by side, each in its own process, and print how
+    they differ with Diff as soon as all of them have got to each second."""
+    queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=diffWorker, args=(i, f, engine, queue), daemon=True) for i, f in enumerate(commandFiles)]
+    for worker in workers:
+        worker.start()
+    diff = Diff(commandFiles, pops, every, out)
+    pending = [deque() for f in commandFiles] # rows not compared yet
+    endings = [None] * len(commandFiles)
+    time = 0
+    while None in endings or any(pending):
+        index, rows, ending = queue.get()
+        if rows != None:
+            pending[index].extend(rows)
+        else:
+            endings[index] = ending
+        # every run has either got past this second or ended before it
+        while any(pending) and all(rows or ending != None for rows, ending in zip(pending, endings)):
+            diff.second(time, [rows.popleft() if rows else None for rows in pending])
+            for i, rows in enumerate(pending):
+                if not rows and endings[i] != None and diff.endings[i] == None:
+                    diff.ended(i, endings[i])
+            time += 1
+    for i, ending in enumerate(endings):
+        if diff.endings[i] == None:
+            diff.ended(i, ending)
+    for worker in workers:
+        worker.join()
+    diff.finish()
+
+def diffMain(argv):
+    parser = argparse.ArgumentParser(prog="boom.py diff", description="Simulate two or more command files side by side and show where they differ, how much more or less each gathers than the first, and when each gets to some populations.")
+    parser.add_argument("files", nargs="+", help="command files, the first is the one the others are compared with")
+    parser.add_argument("--pop", default="50,100,150,200", help="comma separated populations to report the time of")
+    parser.add_argument("--every", type=int, default=60, help="seconds between reports of what has been gathered")
+    parser.add_argument("--engine", choices=["tick", "event", "cohort"], default="cohort")
+    args = parser.parse_args(argv)
+    if len(args.files) < 2:
+        parser.error("give at least two command files")
+    diffBuilds(args.files, args.engine, [int(pop) for pop in args.pop.split(",")], args.every)
+
+class Problem:
+    "Something preflight found wrong with a line of a command file."
+    def __init__(self, lineno, time, message, doomed=True, popRoom=None):
+        self.lineno = lineno
+        self.time = time # the second it goes wrong at
+        self.message = message
+        self.doomed = doomed # whether the run is sure to fail there, if it gets that far
+        self.popRoom = popRoom # the most pop there can be room for by then, None if there's no telling
+
+    def __str__(self):
+        return "line {0} at {1}: {2}".format(self.lineno, formatTime(self.time), self.message)
+
+class EveryUpgrade:
+    "In place of State.upgrades, so that computeGatherRate gives the rates with every upgrade researched."
+    def __contains__(self, techName):
+        return True
+
+def gatherCeilings():
+    "The most food and wood per second any unit can gather, with every upgrade."
+    upgraded = types.SimpleNamespace(upgrades=EveryUpgrade())
+    # computeGatherRate only looks at the upgrades and the kind of unit
+    kinds = set(startingUnits) | set(civTable().costs)
+    rate = lambda gatherTypes: max(State.computeGatherRate(upgraded, g, kind) for g in gatherTypes for kind in kinds)
+    return rate(("farm", "berries", "chicken")), rate(("chop",))
+
+def callName(call):
+    "The name a call in a command line is to: build for self.build(...), len for len(...), None for anything else."
+    if isinstance(call.func, ast.Name):
+        return call.func.id
+    if isinstance(call.func, ast.Attribute) and isinstance(call.func.value, ast.Name) and call.func.value.id == "self":
+        return call.func.attr
+    return None
+
+def callArg(call, index, name):
+    "The expression given for a parameter of a call, by position or keyword, or None."
+    if index < len(call.args) and not any(isinstance(arg, ast.Starred) for arg in call.args[:index + 1]):
+        return call.args[index]
+    for keyword in call.keywords:
+        if keyword.arg == name:
+            return keyword.value
+    return None
+
+def constant(node, default=None):
+    "The value of a literal in a command line, default if it isn't given, or Ellipsis if it isn't a literal."
+    if node == None:
+        return default
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        return ...
+
+# calls in a command line that don't change the simulation
+harmlessCalls = set("len min max sum abs round int float str list tuple range sorted any all print".split())
+
+def preflight(lines, filename="<commands>"):
+    """Look for mistakes in a command file without simulating it. Returns a list of Problems.
+    It checks the lines against the civ's costs and the most a run could have built,
+    researched, trained and gathered by each time line, so it only finds what is sure to
+    go wrong whatever happens in the run: commands that raise, like selectBuilding of a
+    building that can't have been built yet, research at the wrong building or before the
+    techs it needs, or too many farmers at one place, and resources spent at a time when
+    they can't have been gathered yet. Time lines that go back in time are reported too,
+    although they don't fail (the block runs for a second). It stops looking at the
+    first line that does more than give commands, and at a stopwhen line."""
+    problems = []
+    trees = []
+    for lineno, command in enumerate(lines, 1):
+        command = command.split("#")[0]
+        try:
+            if command[:5] == "time ":
+                nums = command.split(" ")[1].split(":")
+                trees.append((lineno, int(nums[0]) * 60 + int(nums[1])))
+            elif command[:9] == "stopwhen ":
+                trees.append((lineno, parseCommand(command[9:].strip(), filename, lineno, "eval")))
+            elif command.strip() != "":
+                trees.append((lineno, parseCommand(command.strip(), filename, lineno)))
+        except (SyntaxError, ValueError, IndexError) as e:
+            problems.append(Problem(lineno, 0, "can't read this line: " + (e.msg if isinstance(e, SyntaxError) else command.strip())))
+    if problems != []: # the run fails before it starts
+        return problems
+    civ = civTable() # None once there is no telling
+    civs = civTables.values()
+    housePop = max(c.housePop for c in civs)
+    trickle = [max(c.trickle[i] for c in civs) for i in range(4)]
+    ceilings = gatherCeilings()
+    # the most buildings of each kind there can be, None for no telling. Farming builds farmsteads and fields as needed.
+    built = defaultdict(int, cc=1, farmstead=None, field=None)
+    newBuilt = [] # (kind, how many more) from the block so far, which can't be done before the next
+    researched = set() # techs that may have been researched
+    newResearched = set()
+    anyResearch = False # whether something was researched that there's no telling what
+    farmers = defaultdict(int) # the fewest farmers there are at each position
+    # (kind of building, resources, units, lineno, when it's done) of what was surely paid for, and can't have been refunded
+    paid = []
+    paying = {} # the same for the block so far, by kind of building
+    touched = set() # buildings given an order this block, which cancels and refunds what they were doing
+    blockTime = 0 # when the block's commands are given
+    timeLineno = None
+    checking = True
+
+    def problem(lineno, message, doomed=True):
+        if checking or not doomed:
+            houses = built["house"]
+            problems.append(Problem(lineno, blockTime, message, doomed, None if houses == None else 20 + housePop * houses))
+
+    def buildingKind(node):
+        "The kind of building a command's argument is, like cc or selectBuilding(\"barracks\"), or None."
+        if isinstance(node, ast.Name) and node.id == "cc":
+            return "cc"
+        if isinstance(node, ast.Call) and callName(node) == "selectBuilding":
+            kind = constant(callArg(node, 0, "kind"))
+            return kind if isinstance(kind, str) else None
+        return None
+
+    def fewestWorkers(node):
+        "The fewest units a selectWorkers(...) argument picks."
+        if not (isinstance(node, ast.Call) and callName(node) == "selectWorkers"):
+            return 0
+        kinds, action, num, pos = [constant(callArg(node, i, name)) for i, name in enumerate(("kinds", "action", "num", "pos"))]
+        if not isinstance(kinds, str) or action != None or pos != None or num is ...:
+            return 0
+        # the units there are from the start are never gone
+        n = len([k for k in startingUnits if k in kinds.split()])
+        return n if num == None else min(n, num)
+
+    def mostBuilt(call):
+        "How many buildings a build(...) can make, None for no telling."
+        if constant(callArg(call, 3, "repeating"), False) != False:
+            return None
+        workers = callArg(call, 0, "workers")
+        if isinstance(workers, ast.Call) and callName(workers) == "selectWorkers":
+            num = constant(callArg(workers, 2, "num"))
+            if isinstance(num, int):
+                # each worker places a new foundation if the last one is finished when they get there
+                return max(num, 0)
+        return None
+
+    def checkSelection(node):
+        nonlocal checking
+        if not (isinstance(node, ast.Call) and callName(node) == "selectBuilding"):
+            return
+        kind = buildingKind(node)
+        index = constant(callArg(node, 2, "index"))
+        most = built[kind] if kind != None else None
+        if most == None:
+            return
+        if isinstance(index, int) and index >= 1 and index > most:
+            problem(node.lineno, "selectBuilding({0!r}, index={1}), but there can be at most {2} {0} by then".format(kind, index, most))
+        elif most == 0:
+            problem(node.lineno, "selectBuilding({0!r}), but no {0} can have been built by then".format(kind))
+
+    def checkCommand(call, lineno):
+        "Check a line that is one command with literals and selectors as arguments."
+        nonlocal civ
+        name = callName(call)
+        arguments = call.args + [keyword.value for keyword in call.keywords]
+        for arg in arguments:
+            checkSelection(arg)
+        if not name in selfCommands:
+            if not name in harmlessCalls and not name in globals() and not hasattr(builtins, name):
+                problem(lineno, "there is no command " + name)
+            return
+        if name == "setCiv":
+            c = constant(callArg(call, 0, "civ"))
+            if isinstance(c, str) and resolveCiv(c) == None:
+                problem(lineno, "What civ is " + c + "?")
+            civ = civTable(resolveCiv(c)) if isinstance(c, str) and resolveCiv(c) != None else None
+        elif name == "research" or name == "train":
+            kind = buildingKind(callArg(call, 0, "building"))
+            thing = constant(callArg(call, 1, "techName" if name == "research" else "unitKind"))
+            queued = constant(callArg(call, 2 if name == "research" else 4, "queued"), False)
+            if queued != False:
+                return
+            if kind == None:
+                paying.clear()
+                forgetRefundable()
+                return
+            touched.add(kind)
+            paying.pop(kind, None)
+            if civ == None or not isinstance(thing, str):
+                return
+            cost = civ.costs.get(thing)
+            if name == "research":
+                if cost == None or len(cost) < 6:
+                    return problem(lineno, "{0} isn't a tech of the {1}".format(thing, civ.name))
+                if cost[5] != kind:
+                    return problem(lineno, "{0} is researched at the {1}, not the {2}".format(thing, cost[5], kind))
+                for before in civ.requires.get(thing, ()):
+                    if not before in researched and not anyResearch:
+                        return problem(lineno, "{0} needs {1} researched first".format(thing, before))
+                paying[kind] = (kind, cost[:4], 0, lineno, blockTime + cost[4] + 1)
+            else:
+                if cost == None:
+                    return problem(lineno, "the {0} can't train {1}".format(civ.name, thing))
+                count = constant(callArg(call, 2, "numUnits"))
+                if constant(callArg(call, 6, "maxBatching"), False) == False and isinstance(count, int):
+                    paying[kind] = (kind, [c * count for c in cost[:4]], count, lineno, blockTime + math.ceil(cost[4] * count**0.8) + 1)
+        elif name == "farm":
+            pos = constant(callArg(call, 1, "pos"))
+            if isinstance(pos, tuple) and len(pos) == 2:
+                # as farmHelper: the cc has room for 6 fields, a farmstead for 4, of 5 farmers each
+                room = 6 * 5 if pos == (0, 0) else 4 * 5
+                farmers[pos] += fewestWorkers(callArg(call, 0, "workers"))
+                if farmers[pos] > room:
+                    problem(lineno, "at least {0} farmers at {1}, which only has fields for {2}".format(farmers[pos], pos, room))
+
+    def forgetRefundable(kinds=None):
+        "Forget what was paid for at buildings of kinds, or any, that may still be doing it, since an order cancels and refunds it."
+        paid[:] = [p for p in paid if p[4] < blockTime or (kinds != None and not p[0] in kinds)]
+
+    def scan(tree, checked):
+        "What any line may do to the bounds. checked is whether checkCommand already looked at it."
+        nonlocal civ, anyResearch, checking
+        loop = any(isinstance(node, (ast.For, ast.While, ast.comprehension)) for node in ast.walk(tree))
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.Assign, ast.AugAssign, ast.AnnAssign, ast.NamedExpr, ast.Delete, ast.Import, ast.ImportFrom, ast.Global, ast.Nonlocal, ast.FunctionDef, ast.ClassDef, ast.Lambda)):
+                checking = False # it may change anything
+            if not isinstance(node, ast.Call):
+                continue
+            name = callName(node)
+            if name == None or not (name in selfCommands or name in harmlessCalls):
+                checking = False
+            elif name == "build":
+                kind = constant(callArg(node, 1, "kind"))
+                if isinstance(kind, str):
+                    newBuilt.append((kind, None if loop else mostBuilt(node)))
+                else:
+                    for k in list(built):
+                        newBuilt.append((k, None))
+                    built.default_factory = lambda: None
+            elif name == "research":
+                tech = constant(callArg(node, 1, "techName"))
+                if isinstance(tech, str) and not loop:
+                    newResearched.add(tech)
+                else:
+                    anyResearch = True
+            elif name == "setCiv" and not checked:
+                civ = None
+
+    def endBlock():
+        "Check what the block's commands surely spent, and count what it built and researched from the next block on."
+        forgetRefundable(touched)
+        paid.extend(paying.values())
+        houses = built["house"]
+        room = None if houses == None else 20 + housePop * houses
+        spent = [sum(p[1][i] for p in paid) for i in range(4)]
+        units = len(startingUnits) + sum(p[2] for p in paid)
+        most = [300 + trickle[i] * (blockTime + 1) for i in range(4)]
+        for i, ceiling in ((FOOD, ceilings[0]), (WOOD, ceilings[1])):
+            most[i] = math.inf if room == None else most[i] + room * ceiling * (blockTime + 1)
+        names = ["food", "wood", "stone", "metal"]
+        # blamed on the last line of this block that adds to it, if any: otherwise an earlier block already was
+        for i in range(4):
+            lineno = max((p[3] for p in paying.values() if p[1][i] > 0), default=None)
+            if spent[i] > most[i] and lineno != None:
+                problem(lineno, "{0:.0f} {1} surely spent by now, but there can't have been more than {2:.0f}".format(spent[i], names[i], most[i]))
+        lineno = max((p[3] for p in paying.values() if p[2] > 0), default=None)
+        if room != None and units > room and lineno != None:
+            problem(lineno, "{0} pop, but there can't be room for more than {1} by now".format(units, room))
+        for kind, count in newBuilt:
+            built[kind] = None if count == None or built[kind] == None else built[kind] + count
+        researched.update(newResearched)
+        newBuilt.clear()
+        newResearched.clear()
+        paying.clear()
+        touched.clear()
+
+    for lineno, tree in trees:
+        if isinstance(tree, int): # a time line
+            if checking:
+                endBlock()
+            if tree <= blockTime and timeLineno != None:
+                problem(lineno, "time {0} isn't after the time {1} on line {2}, so the block before runs for a second".format(formatTime(tree), formatTime(blockTime), timeLineno), doomed=False)
+            blockTime = max(tree, blockTime + 1)
+            timeLineno = lineno
+            continue
+        if isinstance(tree, ast.Expression): # a stopwhen line: the run may stop any time after
+            checking = False
+            continue
+        checked = False
+        if checking and len(tree.body) == 1 and isinstance(tree.body[0], ast.Expr) and isinstance(tree.body[0].value, ast.Call):
+            call = tree.body[0].value
+            plain = lambda node: constant(node) is not ... or buildingKind(node) != None or (isinstance(node, ast.Call) and callName(node) in ("selectWorkers", "previousWorkerSelection") and all(plain(arg) for arg in node.args + [k.value for k in node.keywords]))
+            if callName(call) != None and all(plain(arg) for arg in call.args + [k.value for k in call.keywords]):
+                checkCommand(call, lineno)
+                checked = True
+        if not checked and any(isinstance(node, ast.Call) and callName(node) in ("train", "research") for node in ast.walk(tree)):
+            # there's no telling which buildings it gives orders to
+            paying.clear()
+            forgetRefundable()
+        scan(tree, checked)
+    if checking:
+        endBlock()
+    return sorted(problems, key=lambda p: (p.time, p.lineno))
+
+class BatchJob:
+    "One run of a batch: a command file, with the template parameters filled in."
+    def __init__(self, filename, params):
+        self.filename = filename
+        self.params = params # map from placeholder name to the value it is replaced with
+
+    def commands(self):
+        text = open(self.filename).read()
+        return string.Template(text).substitute(self.params).split("\n")
+
+# Set in each batch worker process by initBatchWorker
+batchSettings = None
+
+def initBatchWorker(settings):
+    global batchSettings
+    batchSettings = settings
+
+workerCacheDirs = {} # (cacheDir, cacheSize) -> (DiskCache, ResultCache), in a worker process
+
+def workerCaches(cacheDir, cacheSize):
+    """The checkpoint and result caches of a worker process, or (None, None) without a
+    cacheDir. They are kept from job to job, so they don't look at the directory each time."""
+    if cacheDir == None:
+        return None, None
+    if (cacheDir, cacheSize) not in workerCacheDirs:
+        workerCacheDirs[(cacheDir, cacheSize)] = DiskCache(cacheDir, cacheSize), resultCache(cacheDir, cacheSize)
+    return workerCacheDirs[(cacheDir, cacheSize)]
+
+def runBatchJob(job):
+    "Run a BatchJob in a batch worker process. Returns its row of the results table."
+    engine, pops, names, cacheDir, cacheSize, full = batchSettings
+    cache, results = workerCaches(cacheDir, cacheSize)
+    try:
+        commands = job.commands()
+    except Exception as e: # a $ in the file that isn't a placeholder
+        result = RunResult(None, errorText(e))
     else:
-        costs["temple"] = [0, 300, 0, 0, 160]
-    # barracks
-    if civ in "ath car han ibe kus mac pto rom sel spa".split():
-        costs["barracks"] = [0, 200, 100, 0, 150]
-    elif civ == "per":
-        costs["barracks"] = [0, 160, 80, 0, 120]
-    elif civ in "bri gau".split():
-        costs["barracks"] = [0, 300, 0, 0, 120]
-
-    # house
-    if civ in "ath car han kus mac per rom sel spa".split():
-        costs["house"] = [0, 150, 0, 0, 50]
-        HOUSEPOP = 10
-    elif civ in "bri gau".split():
-        costs["house"] = [0, 75, 0, 0, 24]
-    elif civ == "pto":
-        costs["house"] = [0, 45, 0, 0, 45]
-    # Iberians have the same house type as Mauryas
-
-    if civ == "ath":
-        costs["II"] = [350, 350, 0, 0, 15]
-        costs["III"] = [0, 0, 525, 525, 30]
-    
-import sys
+        doomed = [p for p in preflight(commands, job.filename) if p.doomed]
+        if doomed != []: # sure to fail, so there's no need to simulate it
+            result = RunResult(None, None)
+            result.failure = "preflight: " + str(doomed[0])
+        else:
+            result = runResult(job.filename, engine, cache, results, full, commands)
+    failure = result.failure or ("error: " + result.error if result.error != None else "")
+    row = [job.filename] + [job.params.get(name, "") for name in names]
+    if result.resources == None:
+        return row + [""] * (len(pops) + 6) + [failure]
+    for pop in pops:
+        row.append(formatTime(result.popTimes[pop]) if pop < len(result.popTimes) else "")
+    row += ["{0:.0f}".format(r) for r in result.resources]
+    row.append(formatTime(result.end))
+    row.append(formatTime(result.surplusStep) if result.surplusStep != 0 else "")
+    row.append(failure)
+    return row
+
+def batchJobs(patterns, grid):
+    """Every combination of a build file matching one of the patterns with a
+    value for each parameter in grid, a map from name to list of values."""
+    filenames = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*.txt")
+        filenames += sorted(glob.glob(pattern))
+    jobs = []
+    for f in filenames:
+        # only vary the parameters the file has placeholders for
+        used = set()
+        for m in string.Template.pattern.finditer(open(f).read()):
+            used.add(m.group("named") or m.group("braced"))
+        names = [name for name in sorted(grid) if name in used]
+        for values in itertools.product(*[grid[name] for name in names]):
+            jobs.append(BatchJob(f, dict(zip(names, values))))
+    return jobs
+
+def runBatch(jobs, out, engine="cohort", pops=(100,), processes=None, cacheDir=None, cacheSize=200 * 2**20, full=False):
+    """Run jobs on a pool of worker processes, and write a results table as CSV to out.
+    Each worker loads the simulator once and then runs job after job."""
+    names = sorted(set(name for job in jobs for name in job.params))
+    writer = csv.writer(out)
+    writer.writerow(["file"] + names + ["pop" + str(pop) for pop in pops] + ["food", "wood", "stone", "metal", "end", "surplus", "failure"])
+    settings = (engine, pops, names, cacheDir, cacheSize, full)
+    with multiprocessing.Pool(processes, initBatchWorker, (settings,)) as pool:
+        for row in pool.imap(runBatchJob, jobs):
+            writer.writerow(row)
+            out.flush()
+
+def batchMain(argv):
+    parser = argparse.ArgumentParser(prog="boom.py batch", description="Simulate many build files, or variations of a template, in parallel and tabulate the results.")
+    parser.add_argument("files", nargs="+", help="build files, directories of them, or glob patterns")
+    parser.add_argument("--param", action="append", default=[], metavar="NAME=V1,V2,...", help="values to try for the placeholder $NAME in the build files. With several --param every combination is run.")
+    parser.add_argument("--pop", default="100", help="comma separated populations to report the time of")
+    parser.add_argument("--out", default="-", help="CSV file for the results, - for standard output")
+    parser.add_argument("--jobs", type=int, default=None, help="worker processes, default one per core")
+    parser.add_argument("--engine", choices=["tick", "event", "cohort"], default="cohort")
+    parser.add_argument("--full", action="store_true", help="don't resume runs from saved checkpoints")
+    parser.add_argument("--cache-dir", default=os.path.join(os.path.expanduser("~"), ".cache", "boom"))
+    parser.add_argument("--cache-size", type=int, default=200, help="megabytes of checkpoints to keep")
+    args = parser.parse_args(argv)
+    grid = {}
+    for param in args.param:
+        name, values = param.split("=", 1)
+        grid[name] = values.split(",")
+    jobs = batchJobs(args.files, grid)
+    pops = [int(pop) for pop in args.pop.split(",")]
+    out = sys.stdout if args.out == "-" else open(args.out, "w", newline="")
+    runBatch(jobs, out, args.engine, pops, args.jobs, args.cache_dir, args.cache_size * 2**20, args.full)
+    if out is not sys.stdout:
+        out.close()
+
+def parseValues(spec):
+    """Values for a search parameter: a comma separated list like 3,5,8 or True,False,
+    or a range like 3-8 or 05:00-07:00/15 (every 15 seconds)."""
+    if "," in spec or not "-" in spec:
+        return spec.split(",")
+    step = 1
+    if "/" in spec:
+        spec, step = spec.split("/")
+        step = int(step)
+    first, last = spec.split("-")
+    if ":" in first:
+        toSeconds = lambda t: int(t.split(":")[0]) * 60 + int(t.split(":")[1])
+        return ["{0:02d}:{1:02d}".format(t // 60, t % 60) for t in range(toSeconds(first), toSeconds(last) + 1, step)]
+    return [str(n) for n in range(int(first), int(last) + 1, step)]
+
+def evaluateCandidate(settings, job):
+    """Score a BatchJob for searchBuild, in a worker process. Returns (rank, value):
+    rank 0 got pop units out at time value, rank 1 was still short of them at the
+    cutoff time and was stopped there with -value units out, rank 2 failed or
+    ran out of commands first. Lower is better."""
+    engine, pop, cutoff, cacheDir, cacheSize = settings
+    cache, results = workerCaches(cacheDir, cacheSize)
+    state = None
+    key = None
+    # stop as soon as we know the answer
+    until = lambda state: len(state.popTimes) > pop or (cutoff != None and state.time >= cutoff)
+    try:
+        commands = job.commands()
+        for p in preflight(commands, job.filename):
+            # sure to fail before it can get to pop, and before the cutoff would stop it
+            if p.doomed and p.popRoom != None and p.popRoom < pop and (cutoff == None or p.time <= cutoff):
+                return (2, 0)
+        if results != None:
+            key = resultKey(commands, job.filename)
+            result = results.get(key)
+            score = scoreResult(result, pop, cutoff) if result != None else None
+            if score != None:
+                return score
+        state, keys = resumeCached(job.filename, engine, cache, False, commands, quiet=True)
+        runCached(state, keys, cache, until)
+    except Exception as e:
+        if state == None or not (state._debugEnd and str(e) == "Run finished."):
+            return (2, 0)
+    if state.finished and key != None: # it wasn't stopped early, so the result is the whole run's
+        results.put(key, RunResult(state, None))
+    if len(state.popTimes) > pop and state.failure == None:
+        return (0, state.popTimes[pop])
+    if state.failure == None and not state.finished:
+        return (1, -len(state.popTimes))
+    return (2, -len(state.popTimes))
+
+def scoreResult(result, pop, cutoff):
+    """The score evaluateCandidate would give the run with RunResult result, or None
+    if result is of a run that ended in an error, which might have been a crash."""
+    if result.error != None:
+        return None
+    if len(result.popTimes) > pop and (cutoff == None or result.popTimes[pop] <= cutoff):
+        # it would stop on the second it got there, unless it failed in that second too
+        if result.failure != None and result.end == result.popTimes[pop]:
+            return (2, -len(result.popTimes))
+        return (0, result.popTimes[pop])
+    if cutoff == None or result.end < cutoff or (result.failure != None and result.end == cutoff):
+        return (2, -len(result.popTimes))
+    # stopped at the cutoff with the units out by then
+    return (1, -bisect.bisect_right(result.popTimes, cutoff))
+
+def searchBuild(template, space, pop, seed=0, beamWidth=8, children=4, generations=None, budget=None, engine="cohort", processes=None, cacheDir=None, cacheSize=200 * 2**20):
+    """Beam search for the values of the template's placeholders that get pop units out earliest.
+    space maps each placeholder name to its possible values, in order. Each generation, every
+    candidate in the beam gets children mutations, which move one or two parameters to nearby or
+    random values, and the best beamWidth of everything tried so far become the next beam.
+    Stops after generations generations or budget seconds, whichever comes first.
+    Returns (best params, its score, number of generations run, candidates tried)."""
+    rng = random.Random(seed)
+    names = sorted(space)
+    scores = {} # tuple of value indexes -> score
+    def mutate(candidate):
+        candidate = list(candidate)
+        for i in range(rng.choice([1, 1, 2])):
+            k = rng.randrange(len(names))
+            n = len(space[names[k]])
+            if rng.random() < 0.7:
+                candidate[k] = min(max(candidate[k] + rng.choice([-2, -1, 1, 2]), 0), n - 1)
+            else:
+                candidate[k] = rng.randrange(n)
+        return tuple(candidate)
+    def job(candidate):
+        return BatchJob(template, {name: space[name][i] for name, i in zip(names, candidate)})
+    start = time.time()
+    beam = [tuple(len(space[name]) // 2 for name in names)]
+    while len(beam) < beamWidth:
+        beam.append(tuple(rng.randrange(len(space[name])) for name in names))
+    generation = 0
+    with multiprocessing.Pool(processes) as pool:
+        while generations == None or generation < generations:
+            if generation == 0:
+                new = beam
+            else:
+                new = [mutate(c) for c in beam for i in range(children)]
+            new = [c for c in dict.fromkeys(new) if c not in scores]
+            # candidates slower than the best so far are stopped there
+            best = min(scores.values(), default=(2, 0))
+            cutoff = best[1] if best[0] == 0 else None
+            settings = (engine, pop, cutoff, cacheDir, cacheSize)
+            results = pool.starmap(evaluateCandidate, [(settings, job(c)) for c in new])
+            for c, score in zip(new, results):
+                scores[c] = score
+            beam = sorted(scores, key=lambda c: (scores[c], c))[:beamWidth]
+            generation += 1
+            print("generation {0}: {1} tried, best {2}".format(generation, len(scores), describeScore(scores[beam[0]], pop)), job(beam[0]).params)
+            if budget != None and time.time() - start > budget:
+                break
+    return job(beam[0]).params, scores[beam[0]], generation, len(scores)
+
+def describeScore(score, pop):
+    if score[0] == 0:
+        return formatTime(score[1]) + " to " + str(pop) + " pop"
+    if score[0] == 1:
+        return "slower than the best, stopped at " + str(-score[1] - 1) + " pop"
+    return "failed"
+
+def searchMain(argv):
+    parser = argparse.ArgumentParser(prog="boom.py search", description="Search for the values of a build template's $placeholders that reach a population earliest without running out of resources or houses on the way. What happens after that doesn't count.")
+    parser.add_argument("template", help="build file with $name placeholders")
+    parser.add_argument("--param", action="append", default=[], metavar="NAME=VALUES", help="values to try for $NAME: a list like 3,5,8 or True,False, or a range like 3-8 or 05:00-07:00/15")
+    parser.add_argument("--pop", type=int, default=100, help="population to reach as early as possible")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--beam", type=int, default=8, help="candidates kept each generation")
+    parser.add_argument("--children", type=int, default=4, help="mutations of each candidate tried each generation")
+    parser.add_argument("--generations", type=int, default=None, help="stop after this many generations")
+    parser.add_argument("--budget", type=float, default=None, help="stop after the generation that takes the run over this many seconds")
+    parser.add_argument("--out", default=None, help="where to write the best build, default TEMPLATE.best.txt")
+    parser.add_argument("--jobs", type=int, default=None, help="worker processes, default one per core")
+    parser.add_argument("--engine", choices=["tick", "event", "cohort"], default="cohort")
+    parser.add_argument("--cache-dir", default=os.path.join(os.path.expanduser("~"), ".cache", "boom"))
+    parser.add_argument("--cache-size", type=int, default=200, help="megabytes of checkpoints to keep")
+    args = parser.parse_args(argv)
+    if args.generations == None and args.budget == None:
+        parser.error("give --generations or --budget")
+    space = {}
+    for param in args.param:
+        name, spec = param.split("=", 1)
+        space[name] = parseValues(spec)
+    params, score, generations, tried = searchBuild(args.template, space, args.pop, args.seed, args.beam, args.children, args.generations, args.budget, args.engine, args.jobs, args.cache_dir, args.cache_size * 2**20)
+    out = args.out if args.out != None else os.path.splitext(args.template)[0] + ".best.txt"
+    with open(out, "w") as f:
+        f.write("# found by boom.py search with --seed {0} --generations {1}: {2}\n".format(args.seed, generations, describeScore(score, args.pop)))
+        f.write("# " + " ".join("{0}={1}".format(name, params[name]) for name in sorted(params)) + "\n")
+        f.write("\n".join(BatchJob(args.template, params).commands()))
+    print("Tried {0} candidates in {1} generations. Best: {2}. Written to {3}".format(tried, generations, describeScore(score, args.pop), out))
+
+def timeLine(seconds):
+    "A command file line that runs the simulation until seconds."
+    return "time {0:02d}:{1:02d}".format(seconds // 60, seconds % 60)
+
+def withOrder(lines, order, at, marks=()):
+    """The lines of a command file with the command order given at second at, after
+    any commands already given then, and with time lines at the seconds in marks.
+    These split blocks without changing what happens, so that runs of the file
+    with order at different times can resume from the same checkpoints.
+    With order None, only the marks are put in."""
+    times = sorted(set(marks) | {at})
+    out = []
+    start = 0 # the second the commands in the current block are given at
+    tail = False # whether there are commands or a stopwhen after the last time line
+    def mark(until):
+        nonlocal start
+        for t in times:
+            if start < t < until:
+                if start == at and order != None:
+                    out.append(order)
+                out.append(timeLine(t))
+                start = t
+        if start == at and order != None:
+            out.append(order)
+    for line in lines:
+        command = line.split("#")[0]
+        if command[:5] == "time ":
+            nums = command.split(" ")[1].split(":")
+            stopTime = int(nums[0]) * 60 + int(nums[1])
+            mark(stopTime)
+            # a block runs for at least a second, even if its time line goes back in time
+            start = max(stopTime, start + 1)
+            tail = False
+        elif command.strip() != "":
+            tail = True
+        out.append(line)
+    if tail: # it runs for 5 more minutes after the last time line
+        last = start
+        mark(last + 300)
+        if start != last:
+            out.append(timeLine(last + 300))
+    return out
+
+def probeOrder(commandFile, lines, engine, cache, pop, deadline):
+    """Run the lines of a command file, resuming from cache, to see if it gets to
+    pop units by deadline, if pop isn't None, without failing. Returns
+    (whether it did, what happened, the second it resumed from)."""
+    state = None
+    # stop once it's too late
+    until = lambda state: pop != None and len(state.popTimes) <= pop and state.time > deadline
+    try:
+        state, keys = resumeCached(commandFile, engine, cache, commands=lines, quiet=True)
+        resumed = state.time
+        runCached(state, keys, None, until)
+    except Exception as e:
+        if state == None or not (state._debugEnd and str(e) == "Run finished."):
+            return False, "error: " + errorText(e), 0
+    if state.failure != None:
+        return False, state.failure + " at " + formatTime(state.time), resumed
+    if pop == None:
+        return True, "ends at " + formatTime(state.time), resumed
+    if len(state.popTimes) <= pop or state.popTimes[pop] > deadline:
+        return False, "not {0} units by {1}".format(pop, formatTime(deadline)), resumed
+    return True, "{0} units at {1}".format(pop, formatTime(state.popTimes[pop])), resumed
+
+def solveOrder(commandFile, order, pop=None, delay=0, after=0, engine="cohort", cache=None, grid=30, say=print):
+    """The earliest second from after on at which order can be added to a command
+    file without the run failing or, if pop is given, getting to pop units more than
+    delay seconds later. It gallops forward from after with doubling steps until
+    order fits, then bisects back, so it assumes that once order fits, it fits
+    from then on. Each try resumes from the checkpoint of the last grid second
+    before it. Returns the second, or None if there is none, and how many tries it took."""
+    parseCommand(order, "<order>", 1) # a syntax error should show up before any simulating
+    lines = open(commandFile).read().split("\n")
+    # a run without the order saves the checkpoints the tries resume from
+    state, keys = resumeCached(commandFile, engine, cache, commands=withOrder(lines, None, 0, range(grid, 24 * 3600, grid)), quiet=True)
+    try:
+        runCached(state, keys, cache)
+    except Exception as e:
+        if not (state._debugEnd and str(e) == "Run finished."):
+            raise
+    if state.failure != None:
+        raise Exception("The build fails without the order: " + state.failure)
+    end = state.time
+    deadline = None
+    if pop != None:
+        if len(state.popTimes) <= pop:
+            raise Exception("The build doesn't get to {0} units without the order".format(pop))
+        deadline = state.popTimes[pop] + delay
+        say("Without the order: {0} units at {1}, so the deadline is {2}".format(pop, formatTime(state.popTimes[pop]), formatTime(deadline)))
+    marks = range(grid, end, grid)
+    tries = 0
+    def fits(at):
+        nonlocal tries
+        tries += 1
+        ok, what, resumed = probeOrder(commandFile, withOrder(lines, order, at, marks), engine, cache, pop, deadline)
+        say("{0}: {1}, {2} (resumed from {3})".format(formatTime(at), "fits" if ok else "doesn't fit", what, formatTime(resumed)))
+        return ok
+    # gallop: the last second known not to fit, and the first known to fit
+    low, high = after - 1, None
+    step = 1
+    while high == None and low + step < end:
+        if fits(low + step):
+            high = low + step
+        else:
+            low += step
+            step *= 2
+    if high == None:
+        if low + 1 >= end or not fits(end - 1):
+            return None, tries
+        high = end - 1
+    while high - low > 1:
+        middle = (low + high) // 2
+        if fits(middle):
+            high = middle
+        else:
+            low = middle
+    return high, tries
+
+def solveMain(argv):
+    parser = argparse.ArgumentParser(prog="boom.py solve", description="Find the earliest time at which one more command can be added to a build without running out of resources or houses, or delaying a population by more than some seconds.")
+    parser.add_argument("commandfile")
+    parser.add_argument("order", help='the command to add, like \'build(selectWorkers("male", num=3), "barracks")\'')
+    parser.add_argument("--pop", type=int, default=None, help="population the order shouldn't delay by more than --delay")
+    parser.add_argument("--delay", type=int, default=0, help="seconds the order may delay getting to --pop")
+    parser.add_argument("--after", default="00:00", help="earliest time to try, like 03:00")
+    parser.add_argument("--grid", type=int, default=30, help="seconds between the checkpoints tries resume from")
+    parser.add_argument("--out", default=None, help="also write the build with the order added to this file")
+    parser.add_argument("--engine", choices=["tick", "event", "cohort"], default="cohort")
+    parser.add_argument("--cache-dir", default=os.path.join(os.path.expanduser("~"), ".cache", "boom"))
+    parser.add_argument("--cache-size", type=int, default=200, help="megabytes of checkpoints to keep")
+    args = parser.parse_args(argv)
+    after = int(args.after.split(":")[0]) * 60 + int(args.after.split(":")[1])
+    cache = DiskCache(args.cache_dir, args.cache_size * 2**20)
+    try:
+        at, tries = solveOrder(args.commandfile, args.order, args.pop, args.delay, after, args.engine, cache, args.grid)
+    except Exception as e:
+        print(e)
+        sys.exit(1)
+    if at == None:
+        print("The order doesn't fit anywhere from {0} on. Tried {1} times.".format(formatTime(after), tries))
+        sys.exit(1)
+    print("Earliest: {0}. Tried {1} times.".format(formatTime(at), tries))
+    if args.out != None:
+        with open(args.out, "w") as f:
+            f.write("\n".join(withOrder(open(args.commandfile).read().split("\n"), args.order, at)))
+
+class NoisyState(State):
+    "A State whose run differs from the plan by a Noise, for boom.py robust."
+    def __init__(self, commandFile, engine, commands, noise, quiet=False):
+        self.noise = noise
+        super().__init__(commandFile, engine, commands, quiet)
+
+    def buildTime(self, kind):
+        return super().buildTime(kind) * self.noise.build
+
+    def computeGatherRate(self, gatherType, kind):
+        return super().computeGatherRate(gatherType, kind) * self.noise.gather.get(gatherType, 1)
+
+    def giveCommands(self, block, stopTime):
+        "The commands are given late, except for the first block, which sets up the map."
+        if block.code != None and self.nextBlock > 1:
+            late = min(self.noise.late(), stopTime - self.time - 1)
+            if late > 0 and not self.runSteps(None, self.time + late):
+                return False
+        return super().giveCommands(block, stopTime)
+
+def runReplica(index):
+    """Run one replica for boom.py robust in a worker process: the plan itself if index
+    is None, otherwise with Noise and command delays drawn from the seed and index.
+    Returns (the time it got to each of pops, or None, how it failed or None)."""
+    commandFile, lines, engine, pops, seed, spreads, lateness = batchSettings
+    state = None
+    failure = None
+    try:
+        if index == None:
+            state = State(commandFile, engine, lines, quiet=True)
+        else:
+            state = NoisyState(commandFile, engine, lines, Noise(random.Random("{0}:{1}".format(seed, index)), *spreads, lateness), quiet=True)
+        state.doCommands()
+    except Exception as e:
+        if state == None or not (state._debugEnd and str(e) == "Run finished."):
+            failure = "error: " + errorText(e)
+            # which command it was, as the noise can make any of them go wrong
+            cause = e.error if isinstance(e, BuildError) else e
+            linenos = [frame.lineno for frame in traceback.extract_tb(cause.__traceback__) if frame.filename == commandFile]
+            if linenos != []:
+                failure = "error on line {0}: {1}".format(linenos[-1], errorText(e))
+    if state != None and state.failure != None:
+        failure = state.failure
+    return [state.popTimes[pop] if state != None and pop < len(state.popTimes) else None for pop in pops], failure
+
+def robustRuns(commandFile, replicas, pops, seed=0, spreads=(0.1, 0.1), lateness=3, engine="cohort", processes=None):
+    """Run the plan and replicas noisy replicas of a command file on a pool of worker
+    processes. spreads are the standard deviations of the Noise factors on gather
+    rates and building, and commands are up to lateness seconds late.
+    Returns the runReplica result of the plan and a list of them for the replicas."""
+    lines = open(commandFile).read().split("\n")
+    settings = (commandFile, lines, engine, pops, seed, spreads, lateness)
+    with multiprocessing.Pool(processes, initBatchWorker, (settings,)) as pool:
+        results = pool.map(runReplica, [None] + list(range(replicas)), chunksize=max(1, replicas // (8 * (processes or os.cpu_count() or 1))))
+    return results[0], results[1:]
 
-if __name__== "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python3 boom.py <commandfile>")
-        quit()
-    filename = sys.argv[1]
-    state = State(filename)
-    cc = state.cc
+def describeReplicas(plan, results, pops):
+    "Lines telling how the replicas got on, compared with the plan."
+    lines = []
+    n = len(results)
+    for k, pop in enumerate(pops):
+        planned = formatTime(plan[0][k]) if plan[0][k] != None else "never"
+        # the ones that never got there come last
+        times = sorted((times[k] for times, failure in results), key=lambda t: (t == None, t))
+        at = lambda p: times[max(0, math.ceil(n * p / 100) - 1)]
+        describe = lambda t: formatTime(t) if t != None else "never"
+        reached = sum(1 for t in times if t != None)
+        lines.append("{0} units (planned {1}): {2:.0f}% got there; 10% by {3}, half by {4}, 90% by {5}".format(pop, planned, 100 * reached / n, describe(at(10)), describe(at(50)), describe(at(90))))
+    failures = defaultdict(int)
+    for times, failure in results:
+        failures[failure] += 1
+    lines.append("The plan " + (plan[1] if plan[1] != None else "doesn't fail"))
+    for failure in sorted(failures, key=lambda f: (f == None, -failures[f], f or "")):
+        lines.append("{0:5.1f}% {1}".format(100 * failures[failure] / n, failure if failure != None else "didn't fail"))
+    return lines
+
+def robustMain(argv):
+    parser = argparse.ArgumentParser(prog="boom.py robust", description="Run a build many times with gather rates and building times a bit off and commands a bit late, as in a real game, to see how much that changes when it gets to some populations and how often it fails.")
+    parser.add_argument("commandfile")
+    parser.add_argument("--replicas", type=int, default=200, help="how many noisy runs")
+    parser.add_argument("--seed", type=int, default=0, help="the same seed always gives the same noise")
+    parser.add_argument("--gather", type=float, default=0.1, help="standard deviation of the gather rates, as a fraction of them")
+    parser.add_argument("--build", type=float, default=0.1, help="standard deviation of building times, as a fraction of them")
+    parser.add_argument("--late", type=int, default=3, help="most seconds the commands after a time line are given late")
+    parser.add_argument("--pop", default="50,100", help="comma separated populations to report the times of")
+    parser.add_argument("--jobs", type=int, default=None, help="worker processes, default one per core")
+    parser.add_argument("--engine", choices=["tick", "event", "cohort"], default="cohort")
+    args = parser.parse_args(argv)
+    pops = [int(pop) for pop in args.pop.split(",")]
+    plan, results = robustRuns(args.commandfile, args.replicas, pops, args.seed, (args.gather, args.build), args.late, args.engine, args.jobs)
+    print("\n".join(describeReplicas(plan, results, pops)))
+
+def syntheticBuild(minutes=30, pop=300, buildings=5, forests=20):
+    """Command lines for a made-up game that gets to about pop units and keeps
+    them busy until minutes, with up to buildings barracks training men to chop
+    at forests forest patches. Every 15 seconds it adds a house or barracks if
+    there's the wood and the room, so it never runs out of resources or houses."""
+    lines = ["setSummaryPeriod(60)"]
+    spots = []
+    for i in range(forests):
+        spots.append((10 + i % 10, i // 10))
+        lines.append("addForest({0}, {1}, {2})".format(spots[-1][0], spots[-1][1], 600000 // forests + 500))
+    lines.append("addBerries(-5, 0, 2000)")
+    lines.append("addChicken(0, 0, 400)")
+    lines.append('chop(selectWorkers("male"))')
+    lines.append('berries(selectWorkers("female"))')
+    lines.append('chicken(selectWorkers("horse"))')
+    # a farmstead for the farmers after the cc's fields are full
+    lines.append('build(selectWorkers("elephant"), "farmstead", pos=(0, 2))')
+    lines.append('chop(selectWorkers("elephant"), queued=True)')
+    lines.append('train(cc, "female", 5, repeating=True, maxBatching=True)')
+    # two of every three groups of women farm, the rest chop
+    schedule = [(0, ((-5, 0), "berries"))]
+    for n in range(14, pop, 8):
+        schedule.append((n, (None, "farm") if n // 8 % 3 != 0 else (spots[n // 8 % forests], "chop")))
+    lines.append("setWaypointSchedule(cc, {0!r})".format(schedule))
+    barracks = 'len(self.buildingLists["barracks"]) + len(self.foundationLists["barracks"])'
+    for t in range(15, minutes * 60, 15):
+        lines.append("time " + formatTime(t))
+        spot = t // 15 % 20
+        lines.append('(build(selectWorkers("male female", "chop", num=2), "house", pos=(5, {0})), chop(previousWorkerSelection(), queued=True)) if self.resources[1] >= 200 and self.maxPop - self.pop < 15 and self.maxPop < {1} else None'.format(spot, pop))
+        lines.append('(build(selectWorkers("male female", "chop", num=3), "barracks", pos=(3, {0})), chop(previousWorkerSelection(), queued=True)) if self.resources[1] >= 500 and self.pop > 40 and {1} < {2} else None'.format(spot, barracks, buildings))
+        lines.append('[(train(b, "male", 2, repeating=True, maxBatching=True), setWaypoint(b, {0!r}, "chop")) for b in self.buildingLists["barracks"] if not b.actionQueue]'.format(spots[spot % forests]))
+    lines.append("time " + formatTime(minutes * 60))
+    return lines
+
+def footprint(obj, seen):
+    "Bytes taken by obj and everything it refers to that isn't in seen, a set of ids, which they are added to."
+    size = 0
+    stack = [obj]
+    while stack != []:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, (type, types.ModuleType, types.FunctionType)):
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        stack += gc.get_referents(o)
+    return size
+
+def actorFootprints(state):
+    """Map from "units", "buildings" and "foundations" to how many a State has and the
+    bytes they take with their action queues. What is shared with the rest of the
+    State, like resources and carry cycles, isn't counted."""
+    units = list(state.workers)
+    buildings = [b for kind in state.buildingLists.values() for b in kind]
+    foundations = [f for kind in state.foundationLists.values() for f in kind]
+    shared = [state, state.activity, state.buildingActivity, state.civ] + state.forestList + state.berriesList + state.chickenList + list(carryCycles.values())
+    seen = set(id(x) for x in units + buildings + foundations + shared)
+    result = {}
+    for group, actors in (("units", units), ("buildings", buildings), ("foundations", foundations)):
+        size = 0
+        for actor in actors:
+            seen.discard(id(actor))
+            size += footprint(actor, seen)
+        result[group] = (len(actors), size)
+    return result
+
+def memoryMain(argv):
+    parser = argparse.ArgumentParser(prog="boom.py memory", description="Run a made-up late game, or a command file, and report how much memory the units, buildings and foundations take.")
+    parser.add_argument("commandfile", nargs="?", help="command file to run instead of the made-up game")
+    parser.add_argument("--minutes", type=int, default=30)
+    parser.add_argument("--pop", type=int, default=300)
+    parser.add_argument("--buildings", type=int, default=5, help="barracks in the made-up game")
+    parser.add_argument("--forests", type=int, default=20, help="forest patches in the made-up game")
+    parser.add_argument("--engine", choices=["tick", "event", "cohort"], default="tick")
+    args = parser.parse_args(argv)
+    if args.commandfile != None:
+        state = State(args.commandfile, args.engine, quiet=True)
+        name = args.commandfile
+    else:
+        state = State("<synthetic>", args.engine, syntheticBuild(args.minutes, args.pop, args.buildings, args.forests), quiet=True)
+        name = "made-up {0} pop game to {1}".format(args.pop, formatTime(args.minutes * 60))
+    tracemalloc.start()
+    try:
+        state.doCommands()
+    except Exception as e:
+        if not (state._debugEnd and str(e) == "Run finished."):
+            raise
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("{0}, {1} engine: {2}/{3} pop at {4}".format(name, args.engine, state.pop, state.maxPop, formatTime(state.time)))
+    for group, (count, size) in actorFootprints(state).items():
+        print("{0:12s}{1:6d} {2:10d} bytes {3:8.0f} bytes each".format(group, count, size, size / max(count, 1)))
+    print("peak memory while running: {0:.1f} MB".format(peak / 2**20))
+
+class Profiler:
+    """Times and counts the calls of the phases of a State's steps, and of act() for
+    each kind of Action. It works by replacing those methods while it's installed,
+    so when there is no Profiler, nothing is timed and it costs nothing."""
+    # State methods, then EventEngine methods, that are timed
+    statePhases = ["step", "summary", "checkSurplus", "execCommands", "actWorkers", "actBuildings", "checkOK"]
+    enginePhases = ["tick", "skipQuiet", "settleAll", "resync", "prepare", "actOnce", "dropOff"]
+
+    def __init__(self):
+        self.times = defaultdict(float) # phase or action class name -> seconds
+        self.calls = defaultdict(int)
+        self.acts = [] # (Action class, its own act) for the classes we replaced act in
+        self.wall = 0
+
+    def timed(self, key, function):
+        times, calls, clock = self.times, self.calls, time.perf_counter
+        def timedFunction(*args):
+            start = clock()
+            try:
+                return function(*args)
+            finally:
+                times[key] += clock() - start
+                calls[key] += 1
+        return timedFunction
+
+    def install(self, state):
+        "Time the State's phases, and every Action's act() until uninstall()."
+        for name in self.statePhases:
+            setattr(state, name, self.timed(name, getattr(state, name)))
+        if state.engine != "tick":
+            for name in self.enginePhases:
+                setattr(state.eventEngine, name, self.timed(name, getattr(state.eventEngine, name)))
+        classes = [Action]
+        for cls in classes:
+            classes += cls.__subclasses__()
+            if "act" in cls.__dict__:
+                self.acts.append((cls, cls.act))
+                times, calls, clock = self.times, self.calls, time.perf_counter
+                def act(action, state, actor, act=cls.act):
+                    start = clock()
+                    try:
+                        return act(action, state, actor)
+                    finally:
+                        key = type(action).__name__ + ".act"
+                        times[key] += clock() - start
+                        calls[key] += 1
+                cls.act = act
+        self.wall = time.perf_counter()
+
+    def uninstall(self):
+        self.wall = time.perf_counter() - self.wall
+        for cls, act in self.acts:
+            cls.act = act
+        self.acts = []
+
+    def report(self):
+        "The times as a dict that can be saved as JSON."
+        return {"wallSeconds": self.wall, "phases": {key: {"calls": self.calls[key], "seconds": self.times[key]} for key in sorted(self.times, key=self.times.get, reverse=True)}}
+
+    def lines(self):
+        "The times as a table. A phase's time includes the phases it calls."
+        lines = ["{0:22s}{1:>10s}{2:>10s}{3:>12s}{4:>8s}".format("phase", "calls", "seconds", "us per call", "% run")]
+        for key, r in self.report()["phases"].items():
+            lines.append("{0:22s}{1:10d}{2:10.3f}{3:12.2f}{4:8.1f}".format(key, r["calls"], r["seconds"], r["seconds"] / r["calls"] * 1e6, r["seconds"] / self.wall * 100))
+        lines.append("{0:22s}{1:>10s}{2:10.3f}".format("whole run", "", self.wall))
+        return lines
+
+# (minutes, pop, barracks, forest patches) of the made-up games boom.py bench runs
+benchCases = [(5, 20, 1, 1), (10, 50, 2, 10), (20, 100, 5, 20), (30, 200, 10, 50), (30, 300, 5, 20), (60, 300, 20, 200)]
+
+def percentile(values, p):
+    "The value p percent of the sorted values are at or below."
+    values = sorted(values)
+    return values[max(0, math.ceil(len(values) * p / 100) - 1)]
+
+def runBench(case, engine, repeat=1):
+    """Run syntheticBuild(*case) on an engine. Returns a dict of how fast it went,
+    from the fastest of repeat runs, and how much memory it took."""
+    lines = syntheticBuild(*case)
+    best = None
+    for i in range(repeat):
+        state = State("<synthetic>", engine, lines, quiet=True)
+        # time every second the engine simulates
+        stepTimes = []
+        owner, name = (state, "step") if engine == "tick" else (state.eventEngine, "tick")
+        step = getattr(owner, name)
+        def timedStep(*args):
+            start = time.perf_counter()
+            result = step(*args)
+            stepTimes.append(time.perf_counter() - start)
+            return result
+        setattr(owner, name, timedStep)
+        start = time.perf_counter()
+        state.doCommands()
+        wall = time.perf_counter() - start
+        if best == None or wall < best[0]:
+            best = wall, stepTimes, state
+    wall, stepTimes, state = best
+    # again for the memory, as tracing it slows everything down
+    state = State("<synthetic>", engine, lines, quiet=True)
+    tracemalloc.start()
     state.doCommands()
-    
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    minutes, pop, buildings, forests = case
+    return {"minutes": minutes, "pop": pop, "buildings": buildings, "forests": forests, "engine": engine,
+            "simSeconds": state.time, "wallSeconds": wall, "simPerWall": state.time / wall, "steps": len(stepTimes),
+            "stepP50": percentile(stepTimes, 50), "stepP90": percentile(stepTimes, 90), "stepP99": percentile(stepTimes, 99), "stepMax": max(stepTimes),
+            "peakBytes": peak, "endPop": state.pop, "endResources": [round(r) for r in state.resources], "failure": state.failure}
+
+def compareBench(results, baseline, threshold):
+    """Lines saying how results compare to baseline, results of an earlier run, and whether
+    any case got slower or bigger than threshold, a fraction, allows. Returns (lines, passed)."""
+    lines = []
+    passed = True
+    for key, r in results.items():
+        b = baseline.get(key)
+        if b == None:
+            lines.append("{0}: not in the baseline".format(key))
+            continue
+        speed = r["simPerWall"] / b["simPerWall"] - 1
+        memory = r["peakBytes"] / b["peakBytes"] - 1
+        ok = speed >= -threshold and memory <= threshold
+        passed = passed and ok
+        note = "" if (r["endPop"], r["endResources"]) == (b["endPop"], b["endResources"]) else ", ends differently"
+        lines.append("{0}: speed {1:+.1%}, peak memory {2:+.1%}{3} {4}".format(key, speed, memory, note, "ok" if ok else "FAIL"))
+    return lines, passed
+
+def benchMain(argv):
+    parser = argparse.ArgumentParser(prog="boom.py bench", description="Time the simulator on made-up games of different sizes, and compare with an earlier run.")
+    parser.add_argument("--engine", default="tick,event,cohort", help="comma separated engines to run each game on")
+    parser.add_argument("--case", action="append", default=[], metavar="MINUTES,POP,BARRACKS,FORESTS", help="a game to run instead of the usual ones; can be given several times")
+    parser.add_argument("--repeat", type=int, default=3, help="run each game this many times and keep the fastest")
+    parser.add_argument("--out", default=None, help="JSON file to save the results in")
+    parser.add_argument("--baseline", default=None, help="JSON file saved by an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=10, help="percent slower, or more peak memory, than the baseline that counts as a failure")
+    args = parser.parse_args(argv)
+    cases = [tuple(int(n) for n in case.split(",")) for case in args.case] or benchCases
+    results = {}
+    print("{0:22s}{1:>8s}{2:>14s}{3:>9s}{4:>9s}{5:>9s}{6:>9s}{7:>9s}{8:>6s}".format("game", "engine", "game s/real s", "p50 ms", "p90 ms", "p99 ms", "max ms", "peak MB", "pop"))
+    for case in cases:
+        for engine in args.engine.split(","):
+            r = runBench(case, engine, args.repeat)
+            key = "{0}min-{1}pop-{2}barracks-{3}forests/{4}".format(*(case + (engine,)))
+            results[key] = r
+            print("{0:22s}{1:>8s}{2:14.0f}{3:9.3f}{4:9.3f}{5:9.3f}{6:9.3f}{7:9.2f}{8:6d}".format("{0}m {1}p {2}b {3}f".format(*case), engine, r["simPerWall"],
+                r["stepP50"] * 1000, r["stepP90"] * 1000, r["stepP99"] * 1000, r["stepMax"] * 1000, r["peakBytes"] / 2**20, r["endPop"]))
+            sys.stdout.flush()
+    if args.out != None:
+        with open(args.out, "w") as f:
+            json.dump({"engineVersion": engineVersion(), "python": sys.version, "results": results}, f, indent=1)
+    if args.baseline != None:
+        lines, passed = compareBench(results, json.load(open(args.baseline))["results"], args.threshold / 100)
+        print("\n".join(lines))
+        print("PASS" if passed else "FAIL")
+        if not passed:
+            sys.exit(1)
+
+class OverBudget(BaseException):
+    """Raised in a serve worker when a run takes longer than its time budget. Not an
+    Exception, so that runResult doesn't keep it in the ResultCache as how the build came out."""
+
+def outOfTime(signum, frame):
+    raise OverBudget()
+
+# Set in each serve worker process by initServeWorker: the queue streamed runs put their summaries and events on
+serveProgress = None
+
+def initServeWorker(settings, progress):
+    global serveProgress
+    initBatchWorker(settings)
+    # not in batchSettings, as a checkpoint copies tuples in globals, and a queue can't be
+    serveProgress = progress
+
+class TimelineSender:
+    """Sends the summaries and events of a serve run as they are recorded, merged in
+    time order as JSON lines, by calling send with each list of new lines."""
+    def __init__(self, send):
+        self.send = send
+        self.rows = 0 # summaries sent so far
+        self.events = 0 # events sent so far
+
+    def sendRecorded(self, state):
+        "Send what the State's Recorder has that nothing recorded later can come before."
+        recorder = state.recorder
+        rows = [tuple(column[i] for column in recorder.rows) for i in range(self.rows, len(recorder.rows[0]))]
+        events = [tuple(recorder.strings[value] if 1 <= j <= 3 else value for j, value in enumerate(event))
+                  for event in zip(*(column[self.events:] for column in recorder.events))]
+        # the rest of this second can still record summaries and events, so they wait
+        self.sendItems(rows, events, state.time)
+
+    def sendItems(self, rows, events, before=None):
+        """Send summary rows and events, each in time order and not sent yet, up to
+        but not including second before, or all of them if it is None."""
+        if before != None:
+            rows = list(itertools.takewhile(lambda row: row[0] < before, rows))
+            events = list(itertools.takewhile(lambda event: event[0] < before, events))
+        self.rows += len(rows)
+        self.events += len(events)
+        rowNames = [name for name, typecode in Recorder.columns]
+        eventNames = [name for name, typecode in Recorder.eventColumns]
+        items = [(row[0], 0, {"summary": dict(zip(rowNames, row))}) for row in rows]
+        items += [(event[0], 1, {"event": dict(zip(eventNames, event))}) for event in events]
+        # summaries and events are each in time order already, so the sort is a merge
+        items.sort(key=lambda item: item[:2])
+        if items != []:
+            self.send([json.dumps(item[2]) for item in items])
+
+def serveRun(request):
+    """Simulate a build for serve, in a serve worker process. request is (lines, engine,
+    timeline, budget, stream), budget being the most seconds it may take. Returns the
+    RunResult's toJSON(), which the shared ResultCache keeps for the next time. If stream
+    isn't None, the summaries and events are put on the server's progress queue as
+    (stream, JSON lines) while it runs, with (stream, None) at the end, and left out of
+    what it returns."""
+    lines, engine, timeline, budget, stream = request
+    cacheDir, cacheSize = batchSettings
+    cache, results = workerCaches(cacheDir, cacheSize)
+    sender = TimelineSender(lambda lines: serveProgress.put((stream, lines))) if stream != None else None
+    try:
+        signal.signal(signal.SIGALRM, outOfTime)
+        signal.setitimer(signal.ITIMER_REAL, budget)
+        try:
+            result = runResult("<request>", engine, cache, results, commands=lines, timeline=timeline, after=sender.sendRecorded if sender != None else None)
+        except OverBudget:
+            result = RunResult(None, "OverBudget: took longer than {0:g} seconds".format(budget), timeline)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        if sender != None:
+            # all of it if the result was kept from before, and otherwise the last second's
+            sender.sendItems(result.timeline.rows[sender.rows:], result.timeline.events[sender.events:])
+            result.timeline = None
+        return result.toJSON()
+    finally:
+        if sender != None: # however it went, so the server stops waiting for more
+            serveProgress.put((stream, None))
+
+def serverClasses():
+    """BuildServer and ServeHandler, the HTTP server of boom.py serve and its request
+    handler. They are made when serve starts, as http.server takes longer to import
+    than a short build takes to simulate."""
+    import http.server
+
+    class Stream:
+        "The JSON lines of the summaries and events a streamed run has sent so far."
+        def __init__(self):
+            self.lines = []
+            self.done = False # whether that's all of them
+
+    class BuildServer(http.server.ThreadingHTTPServer):
+        """The HTTP server of boom.py serve. Each request is handled on a thread, which
+        hands the simulation to a pool of worker processes forked once at the start, with
+        the civ tables already loaded, and waits for it. Requests for a build that is
+        already being simulated wait for that run instead of starting another."""
+        daemon_threads = True
+
+        def __init__(self, address, processes=None, cacheDir=None, cacheSize=200 * 2**20, budget=60, quiet=False):
+            super().__init__(address, ServeHandler)
+            civTable() # loaded before the fork, so no worker reads civs.json
+            self.processes = processes or os.cpu_count()
+            # (stream, JSON lines) from the workers, for streamed runs
+            self.progress = multiprocessing.Queue()
+            self.pool = multiprocessing.Pool(self.processes, initServeWorker, ((cacheDir, cacheSize), self.progress))
+            self.budget = budget # default seconds a run may take
+            self.quiet = quiet # don't log requests
+            self.running = {} # map from (resultKey, timeline, stream, engine, budget) to (AsyncResult, Stream or None) of its run
+            self.streams = {} # map from the number of a streamed run that is going to its Stream
+            self.lock = threading.Lock()
+            self.changed = threading.Condition(self.lock) # notified when a stream gets more lines
+            self.runs = 0 # simulations handed to the pool, for /status
+            self.coalesced = 0 # requests that waited for another one's run
+            threading.Thread(target=self.pump, daemon=True).start()
+
+        def start(self, lines, engine, timeline, budget, stream=False):
+            """Start running lines, a list of command lines, unless the same run is going
+            already. Returns its key and (AsyncResult, Stream), for result() and streamed();
+            the Stream is None unless stream. Raises a BuildError if a line can't be read."""
+            # the engine and budget decide whether the run finishes in time, so they are part of it too
+            key = (resultKey(lines, "<request>"), timeline, stream, engine, budget)
+            with self.lock:
+                run = self.running.get(key)
+                if run != None:
+                    self.coalesced += 1
+                    return key, run
+                number = None
+                if stream:
+                    number = self.runs
+                    self.streams[number] = Stream()
+                self.runs += 1
+                run = self.running[key] = (self.pool.apply_async(serveRun, ((lines, engine, timeline, budget, number),)), self.streams.get(number))
+            return key, run
+
+        def result(self, key, run):
+            "The RunResult of a run from start(), once it is over."
+            try:
+                return loadResult(run[0].get())
+            finally:
+                with self.lock:
+                    if self.running.get(key) is run:
+                        del self.running[key]
+
+        def streamed(self, run):
+            "The lists of JSON lines of the summaries and events of a streamed run from start(), as they come."
+            stream = run[1]
+            sent = 0
+            while True:
+                with self.changed:
+                    while len(stream.lines) == sent and not stream.done:
+                        self.changed.wait()
+                    lines = stream.lines[sent:]
+                    done = stream.done
+                sent += len(lines)
+                if lines != []:
+                    yield lines
+                if done:
+                    return
+
+        def pump(self):
+            "Hand out the lines workers put on the progress queue to the streams they are for, on a thread of its own."
+            while True:
+                number, lines = self.progress.get()
+                with self.changed:
+                    if lines == None:
+                        self.streams.pop(number).done = True
+                    else:
+                        self.streams[number].lines += lines
+                    self.changed.notify_all()
+
+        def server_close(self):
+            super().server_close()
+            self.pool.terminate()
+            self.pool.join()
+
+    class ServeHandler(http.server.BaseHTTPRequestHandler):
+        """POST /run with a JSON object: "build", the text of a command file, and optionally
+        "civ", "engine", "budget" (seconds) and "timeline" (true to get every summary and
+        event as well). Answers with the RunResult as JSON, or with "stream" true, with JSON
+        lines sent as the run goes: each summary and event in time order, then {"result": ...}
+        without the timeline once it is over. A build with a line that can't be read gets
+        a 400, like any other bad request.
+        GET /status tells how many workers there are and what they have done."""
+        protocol_version = "HTTP/1.1"
+
+        def reply(self, status, data, contentType="application/json"):
+            self.send_response(status)
+            self.send_header("Content-Type", contentType)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def fail(self, status, message):
+            self.reply(status, json.dumps({"error": message}).encode())
+
+        def sendChunk(self, lines):
+            data = ("\n".join(lines) + "\n").encode()
+            self.wfile.write("{0:x}\r\n".format(len(data)).encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path != "/status":
+                return self.fail(404, "use POST /run or GET /status")
+            server = self.server
+            with server.lock:
+                status = {"workers": server.processes, "runs": server.runs, "coalesced": server.coalesced, "running": len(server.running)}
+            self.reply(200, json.dumps(status).encode())
+
+        def do_POST(self):
+            if self.path != "/run":
+                return self.fail(404, "use POST /run or GET /status")
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                lines = request["build"].split("\n")
+                engine = request.get("engine", "cohort")
+                if not engine in ("tick", "event", "cohort"):
+                    raise ValueError("engine must be tick, event or cohort")
+                civ = request.get("civ")
+                if civ != None:
+                    if resolveCiv(civ) == None:
+                        raise ValueError("What civ is " + civ + "?")
+                    # before the build's own commands, so its setCiv still wins
+                    lines = ["setCiv({0!r})".format(civ)] + lines
+                budget = float(request.get("budget", self.server.budget))
+                stream = bool(request.get("stream", False))
+                timeline = stream or bool(request.get("timeline", False))
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                return self.fail(400, "bad request: " + str(e))
+            try:
+                key, run = self.server.start(lines, engine, timeline, budget, stream)
+            except BuildError as e: # the build can't be read, so there's nothing to run
+                return self.fail(400, "bad build: " + str(e))
+            if not stream:
+                try:
+                    result = self.server.result(key, run)
+                except Exception as e: # the worker itself went wrong, not the build
+                    return self.fail(500, errorText(e))
+                return self.reply(200, result.toJSON())
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for lines in self.server.streamed(run):
+                    self.sendChunk(lines)
+            finally:
+                # even if the client has gone, so that later requests don't join the run
+                try:
+                    last = {"result": json.loads(self.server.result(key, run).toJSON())}
+                except Exception as e: # too late for a 500
+                    last = {"error": errorText(e)}
+            self.sendChunk([json.dumps(last)])
+            self.wfile.write(b"0\r\n\r\n")
+
+        def log_message(self, format, *args):
+            if not self.server.quiet:
+                super().log_message(format, *args)
+
+    return BuildServer, ServeHandler
+
+def serveMain(argv):
+    parser = argparse.ArgumentParser(prog="boom.py serve", description="Simulate builds sent over HTTP as JSON, on a pool of warm worker processes.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on; the default only takes requests from this computer")
+    parser.add_argument("--port", type=int, default=8037)
+    parser.add_argument("--jobs", type=int, default=None, help="worker processes, default one per core")
+    parser.add_argument("--budget", type=float, default=60, help="seconds a run may take before it is stopped, unless the request gives its own")
+    parser.add_argument("--cache-dir", default=os.path.join(os.path.expanduser("~"), ".cache", "boom"))
+    parser.add_argument("--cache-size", type=int, default=200, help="megabytes of checkpoints and results to keep")
+    parser.add_argument("--quiet", action="store_true", help="don't log each request")
+    args = parser.parse_args(argv)
+    BuildServer, ServeHandler = serverClasses()
+    server = BuildServer((args.host, args.port), args.jobs, args.cache_dir, args.cache_size * 2**20, args.budget, args.quiet)
+    # stop the workers too when killed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("Serving on http://{0}:{1}/run".format(*server.server_address[:2]), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def checkMain(argv):
+    parser = argparse.ArgumentParser(prog="boom.py check", description="Look for mistakes in build files without simulating them. Exits with 1 if a run of one is sure to fail.")
+    parser.add_argument("files", nargs="+")
+    args = parser.parse_args(argv)
+    doomed = False
+    for filename in args.files:
+        for p in preflight(open(filename).read().split("\n"), filename):
+            print("{0}:{1}: at {2}: {3}{4}".format(filename, p.lineno, formatTime(p.time), p.message, "" if p.doomed else " (it still runs)"))
+            doomed = doomed or p.doomed
+    sys.exit(1 if doomed else 0)
+
+# other things boom.py can do, as in python3 boom.py batch ...
+subcommands = {"batch": batchMain, "search": searchMain, "memory": memoryMain, "bench": benchMain, "diff": diffMain, "solve": solveMain, "robust": robustMain, "inspect": inspectMain, "serve": serveMain, "check": checkMain}
+
+if __name__== "__main__" and len(sys.argv) > 1 and sys.argv[1] in subcommands:
+    subcommands[sys.argv[1]](sys.argv[2:])
+elif __name__== "__main__":
+    parser = argparse.ArgumentParser(description="Simulate a 0ad build order.")
+    parser.add_argument("commandfile")
+    parser.add_argument("--engine", choices=["tick", "event", "cohort"], default="tick", help="tick simulates every unit every second; event skips the seconds where a unit has nothing to do; cohort is event, with gatherers that drop off together handled as a group. All give the same output.")
+    parser.add_argument("--full", action="store_true", help="replay the whole command file, instead of resuming from where it last changed")
+    parser.add_argument("--cache-dir", default=os.path.join(os.path.expanduser("~"), ".cache", "boom"), help="where to keep checkpoints for resuming")
+    parser.add_argument("--cache-size", type=int, default=200, help="megabytes of checkpoints to keep")
+    parser.add_argument("--quiet", action="store_true", help="don't print anything")
+    parser.add_argument("--record", metavar="FILE", help="also write the summaries to FILE (.csv, .jsonl or .bin), and what happened when to FILE with .events before the extension")
+    parser.add_argument("--profile", action="store_true", help="time each phase of the simulation and each kind of action, and print the times at the end. Replays the whole file.")
+    parser.add_argument("--profile-json", metavar="FILE", help="like --profile, and also save the times to FILE as JSON")
+    parser.add_argument("--trace", metavar="FILE", help="also write a trace to FILE, for boom.py inspect FILE --at 09:40 to show everything at any second. Replays the whole file.")
+    parser.add_argument("--trace-every", type=int, default=10, help="seconds between the keyframes of the trace: fewer makes it bigger and looking in it faster")
+    parser.add_argument("--watch", action="store_true", help="keep running: simulate again whenever the command file is saved, and print only what changed since the last time")
+    parser.add_argument("--interval", type=float, default=0.5, help="seconds between checks of the command file for --watch")
+    args = parser.parse_args()
+    if args.watch:
+        try:
+            if args.full:
+                watch(args.commandfile, args.engine, None, None, args.interval)
+            else:
+                watch(args.commandfile, args.engine, DiskCache(args.cache_dir, args.cache_size * 2**20), resultCache(args.cache_dir, args.cache_size * 2**20), args.interval)
+        except KeyboardInterrupt:
+            sys.exit(0)
+    profiler = Profiler() if args.profile or args.profile_json != None else None
+    # a profile should see the whole run, and its timers can't go in a checkpoint
+    cache = DiskCache(args.cache_dir, args.cache_size * 2**20) if profiler == None else None
+    if args.trace != None:
+        if profiler != None:
+            parser.error("use --trace and --profile one at a time")
+        # a trace starts at the start
+        state = State(args.commandfile, args.engine, traceLines(open(args.commandfile).read().split("\n"), args.trace_every), args.quiet, args.record != None)
+    else:
+        state, keys = resumeCached(args.commandfile, args.engine, cache, args.full, quiet=args.quiet, record=args.record != None)
+    if profiler != None:
+        profiler.install(state)
+    try:
+        if args.trace != None:
+            runTraced(state, args.commandfile, args.trace)
+        else:
+            runCached(state, keys, cache)
+    finally:
+        if profiler != None:
+            profiler.uninstall()
+            print("\n".join(profiler.lines()), file=sys.stderr)
+            if args.profile_json != None:
+                with open(args.profile_json, "w") as f:
+                    json.dump(profiler.report(), f, indent=1)
+        if args.record != None:
+            base, ext = os.path.splitext(args.record)
+            state.recorder.write(args.record)
+            state.recorder.write(base + ".events" + ext, events=True)
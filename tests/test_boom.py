@@ -0,0 +1,545 @@
+import ast
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import boom
+
+MAURYA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "builds", "maurya1.txt")
+
+def commandLines(filename):
+    return open(filename).read().split("\n")
+
+def finish(state, run=None):
+    "Run state to the end, or do run(), and return what it printed."
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        try:
+            run() if run != None else state.doCommands()
+        except Exception as e:
+            if str(e) != "Run finished.": # debugEnd()
+                raise
+    return out.getvalue()
+
+def output(commands, engine="tick", record=False):
+    "(what a run of the command lines prints, its State)"
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        state = boom.State("<test>", engine, commands, record=record)
+    return out.getvalue() + finish(state), state
+
+ENGINES = ("tick", "event", "cohort")
+
+def recorded(state, directory):
+    "The bytes of the summaries and events a run with a Recorder wrote, as binary columns and CSV."
+    files = []
+    for ext in (".bin", ".csv"):
+        path = os.path.join(directory, state.engine + ext)
+        state.recorder.write(path)
+        state.recorder.write(path + ".events" + ext, events=True)
+        files += [open(path, "rb").read(), open(path + ".events" + ext, "rb").read()]
+    return files
+
+class TestEngines(unittest.TestCase):
+    def assertSameRuns(self, lines):
+        with tempfile.TemporaryDirectory() as directory:
+            runs = {}
+            for engine in ENGINES:
+                printed, state = output(lines, engine, record=True)
+                runs[engine] = [printed] + recorded(state, directory)
+            for engine in ENGINES[1:]:
+                self.assertEqual(runs[engine], runs["tick"], engine)
+
+    def test_maurya1(self):
+        self.assertSameRuns(commandLines(MAURYA))
+
+    def test_synthetic(self):
+        self.assertSameRuns(boom.syntheticBuild(minutes=12, pop=120, buildings=3, forests=8))
+
+    def test_summary_every_second(self):
+        lines = boom.syntheticBuild(minutes=8, pop=80, buildings=2, forests=4)
+        self.assertSameRuns(["setSummaryPeriod(1)" if line == "setSummaryPeriod(60)" else line for line in lines])
+
+class TestCheckpoint(unittest.TestCase):
+    def test_forks_carry_on_like_the_run(self):
+        lines = commandLines(MAURYA)
+        with tempfile.TemporaryDirectory() as directory:
+            for engine in ENGINES:
+                plain, planned = output(lines, engine, record=True)
+                expected = recorded(planned, directory)
+                for time in (28, 300, 416):
+                    state = boom.State(MAURYA, engine, boom.withOrder(lines, None, 0, [time]), record=True)
+                    before = finish(state, lambda: state.doCommands(time))
+                    self.assertEqual(state.time, time)
+                    checkpoint = state.checkpoint()
+                    for i in range(2):
+                        fork = checkpoint.fork()
+                        self.assertEqual(before + finish(fork), plain, "{0} fork {1} at {2}".format(engine, i, time))
+                        self.assertEqual(recorded(fork, directory), expected)
+                    # and the State itself carries on as if nothing happened
+                    self.assertEqual(before + finish(state), plain)
+
+    def test_fork_with_other_commands(self):
+        lines = commandLines(MAURYA)
+        edited = lines[:lines.index("time 08:00") + 1] + ['build(selectWorkers("male", "chop", num=2), "house", (10, 2))'] + lines[lines.index("time 08:00") + 1:]
+        plain = output(edited)[0]
+        state = boom.State(MAURYA, "tick", lines)
+        before = finish(state, lambda: state.doCommands(400))
+        fork = state.fork()
+        fork.setCommands(edited)
+        self.assertEqual(before + finish(fork), plain)
+
+class TestResume(unittest.TestCase):
+    def test_resume_after_edit_matches_full(self):
+        lines = commandLines(MAURYA)
+        edited = lines[:lines.index("time 08:00") + 1] + ['build(selectWorkers("male", "chop", num=2), "house", (10, 2))'] + lines[lines.index("time 08:00") + 1:]
+        with tempfile.TemporaryDirectory() as directory:
+            cache = boom.DiskCache(directory, 2**30)
+            for engine in ENGINES:
+                full = boom.runResult(MAURYA, engine, None, None, full=True, commands=edited, timeline=True)
+                boom.runResult(MAURYA, engine, cache, None, commands=lines, timeline=True)
+                state, keys = boom.resumeCached(MAURYA, engine, cache, commands=edited, quiet=True, record=True)
+                self.assertEqual(state.time, 8 * 60) # from the checkpoint before the edit
+                finish(state, lambda: boom.runCached(state, keys, cache))
+                self.assertEqual(boom.RunResult(state, None, True).toJSON(), full.toJSON(), engine)
+
+class TestDiskCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = boom.DiskCache(directory, 10000)
+            for i in range(10):
+                cache.put(str(i), b"x" * 1000)
+                os.utime(cache.path(str(i)), (i, i))
+            self.assertEqual(len(os.listdir(directory)), 10)
+            self.assertEqual(cache.get("0"), b"x" * 1000) # now the most recently used
+            cache.put("10", b"x" * 1000)
+            self.assertEqual(sorted(os.listdir(directory), key=int), ["0"] + [str(i) for i in range(3, 11)])
+            self.assertEqual(cache.total, 9000)
+
+class FullDisk(boom.DiskCache):
+    def put(self, key, data):
+        raise OSError(28, "No space left on device")
+
+class TestRunResult(unittest.TestCase):
+    def test_build_errors_are_kept(self):
+        lines = commandLines(MAURYA)
+        broken = lines[:lines.index("time 08:00") + 1] + ["undefinedCommand()"] + lines[lines.index("time 08:00") + 1:]
+        with tempfile.TemporaryDirectory() as directory:
+            results = boom.resultCache(directory, 2**30)
+            result = boom.runResult(MAURYA, "cohort", None, results, commands=broken)
+            self.assertTrue(result.error.startswith("NameError"), result.error)
+            self.assertEqual(result.end, 8 * 60)
+            self.assertEqual(results.get(boom.resultKey(broken, MAURYA)).error, result.error)
+
+    def test_unreadable_lines_are_kept(self):
+        lines = commandLines(MAURYA)
+        with tempfile.TemporaryDirectory() as directory:
+            results = boom.resultCache(directory, 2**30)
+            for line, error in (("build(", "SyntaxError"), ("time 8:xx", "ValueError")):
+                broken = lines[:lines.index("time 08:00") + 1] + [line] + lines[lines.index("time 08:00") + 1:]
+                result = boom.runResult(MAURYA, "cohort", None, results, commands=broken)
+                self.assertTrue(result.error.startswith(error + ": "), result.error)
+                self.assertEqual(result.end, 0)
+                with self.assertRaises(boom.BuildError):
+                    boom.resultKey(broken, MAURYA)
+
+    def test_debug_end_is_not_an_error(self):
+        result = boom.runResult(MAURYA, "tick", None, None, commands=["debugEnd()"] + commandLines(MAURYA))
+        self.assertEqual((result.error, result.failure, result.end), (None, None, 720))
+
+    def test_cache_errors_are_raised(self):
+        lines = commandLines(MAURYA)
+        with tempfile.TemporaryDirectory() as directory:
+            results = boom.resultCache(directory, 2**30)
+            with self.assertRaises(OSError):
+                boom.runResult(MAURYA, "cohort", FullDisk(directory, 2**30), results, commands=lines)
+            # and it isn't kept as how the build came out
+            self.assertEqual(results.get(boom.resultKey(lines, MAURYA)), None)
+            results.disk = FullDisk(results.disk.directory, 2**30)
+            with self.assertRaises(OSError):
+                boom.runResult(MAURYA, "cohort", None, results, commands=lines)
+
+class TestSearch(unittest.TestCase):
+    def test_until_stops_on_the_second(self):
+        lines = commandLines(MAURYA)
+        for engine in ENGINES:
+            state, keys = boom.resumeCached(MAURYA, engine, None, commands=lines, quiet=True)
+            finish(state, lambda: boom.runCached(state, keys, None, lambda s: s.time >= 100))
+            self.assertEqual(state.time, 100, engine)
+            self.assertTrue(state.stoppedEarly and not state.finished, engine)
+
+    def test_cached_results_score_like_runs(self):
+        lines = commandLines(MAURYA)
+        result = boom.runResult(MAURYA, "cohort", None, None, commands=lines)
+        for pop, cutoff in ((15, None), (15, 47), (15, 46), (25, 400), (1000, None), (1000, 500)):
+            run = boom.evaluateCandidate(("cohort", pop, cutoff, None, 0), boom.BatchJob(MAURYA, {}))
+            self.assertEqual(boom.scoreResult(result, pop, cutoff), run, "pop {0} by {1}".format(pop, cutoff))
+
+class TestCommands(unittest.TestCase):
+    def test_trailing_stopwhen(self):
+        lines = commandLines(MAURYA) + ["stopwhen self.time >= 725"]
+        for engine in ENGINES:
+            printed, state = output(lines, engine)
+            self.assertEqual((state.time, state.failure), (725, "hit stop condition: self.time >= 725"), engine)
+            self.assertEqual(output(boom.withOrder(lines, None, 0, range(7, 3600, 7)), engine)[0], printed, engine)
+
+class TestServe(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        BuildServer, ServeHandler = boom.serverClasses()
+        cls.server = BuildServer(("127.0.0.1", 0), 2, cls.directory.name, 2**30, quiet=True)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = "http://127.0.0.1:{0}/run".format(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.directory.cleanup()
+
+    def post(self, request):
+        "(HTTP status, text of the reply) of POST /run"
+        try:
+            with urllib.request.urlopen(self.url, json.dumps(request).encode()) as reply:
+                return reply.status, reply.read().decode()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read().decode()
+
+    def test_bad_requests(self):
+        status, text = self.post({"build": "time 00:10\nbuild(\n"})
+        self.assertEqual(status, 400)
+        self.assertTrue(json.loads(text)["error"].startswith("bad build: SyntaxError: "), text)
+        self.assertEqual(self.post({"build": "", "engine": "warp"})[0], 400)
+        self.assertEqual(self.post({"civ": "mau"})[0], 400)
+
+    def test_result_is_the_run(self):
+        lines = commandLines(MAURYA)
+        status, text = self.post({"build": "\n".join(lines), "engine": "event"})
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(text), json.loads(boom.runResult("<request>", "tick", None, None, commands=lines).toJSON()))
+
+    def test_stream(self):
+        lines = boom.syntheticBuild(minutes=10, pop=100, buildings=2, forests=4)
+        full = boom.runResult("<request>", "tick", None, None, commands=lines, timeline=True)
+        expected = []
+        boom.TimelineSender(expected.extend).sendItems(full.timeline.rows, full.timeline.events)
+        full.timeline = None
+        expected.append(json.dumps({"result": json.loads(full.toJSON())}))
+        # the second time it comes from the ResultCache
+        for i in range(2):
+            status, text = self.post({"build": "\n".join(lines), "engine": "cohort", "stream": True})
+            self.assertEqual(status, 200)
+            self.assertEqual(text.split("\n"), expected + [""], "run {0}".format(i))
+
+    def test_same_runs_are_coalesced(self):
+        lines = boom.syntheticBuild(minutes=6, pop=60, buildings=1, forests=2)
+        first = self.server.start(lines, "cohort", False, 30)
+        self.assertIs(self.server.start(lines, "cohort", False, 30)[1], first[1])
+        # a run with another budget might not finish when this one does
+        other = self.server.start(lines, "cohort", False, 10)
+        self.assertIsNot(other[1], first[1])
+        self.assertEqual(self.server.result(*first).toJSON(), self.server.result(*other).toJSON())
+        self.assertIsNot(self.server.start(lines, "cohort", False, 30)[1], first[1])
+
+    def test_budget(self):
+        lines = boom.syntheticBuild(minutes=30, pop=300, buildings=3, forests=8)
+        status, text = self.post({"build": "\n".join(lines), "engine": "tick", "budget": 0.05})
+        self.assertEqual(status, 200)
+        self.assertTrue(json.loads(text)["error"].startswith("OverBudget"), text)
+        # and that isn't kept as how the build came out
+        status, text = self.post({"build": "\n".join(lines), "engine": "cohort"})
+        self.assertEqual((json.loads(text)["error"], json.loads(text)["end"]), (None, 1800))
+
+class TestPreflight(unittest.TestCase):
+    # a build that makes each check go off, and what it says about it
+    cases = [
+        (["build("], "can't read this line: '(' was never closed"),
+        (['build(selectWorkers("male", num=1), "barracks", (10, 10))', "time 01:00", 'train(selectBuilding("barracks", index=2), "male", 1)'],
+         "selectBuilding('barracks', index=2), but there can be at most 1 barracks by then"),
+        (['train(selectBuilding("barracks"), "male", 1)'], "selectBuilding('barracks'), but no barracks can have been built by then"),
+        (['fly(selectWorkers("male"))'], "there is no command fly"),
+        (['setCiv("Martians")'], "What civ is Martians?"),
+        (['research(cc, "up_warp")'], "up_warp isn't a tech of the mau"),
+        (['research(cc, "up_chop1")'], "up_chop1 is researched at the storehouse, not the cc"),
+        (['build(selectWorkers("male", num=1), "storehouse", (10, 0))', "time 01:00", 'research(selectBuilding("storehouse"), "up_chop2")'],
+         "up_chop2 needs up_chop1 researched first"),
+        (['train(cc, "dragon", 1)'], "the mau can't train dragon"),
+        (['farm(selectWorkers("male female"), (5, 5))'] * 3, "at least 24 farmers at (5, 5), which only has fields for 20"),
+        (['train(cc, "champ", 4)'], "400 metal surely spent by now, but there can't have been more than 300"),
+        (["time 10:00", 'train(cc, "female", 15)'], "25 pop, but there can't be room for more than 20 by now"),
+        (["time 01:00", "time 00:30"], "time 000:30 isn't after the time 001:00 on line 1, so the block before runs for a second"),
+    ]
+
+    def test_each_check(self):
+        for lines, message in self.cases:
+            problems = boom.preflight(lines)
+            self.assertIn(message, [p.message for p in problems], lines)
+            # the last line is the one to blame, and only a time line going back doesn't fail
+            problem = [p for p in problems if p.message == message][0]
+            self.assertEqual((problem.lineno, problem.doomed), (len(lines), not message.startswith("time ")), message)
+
+    def test_maurya1(self):
+        lines = commandLines(MAURYA)
+        # its time lines do go back once, on line 114, which is all there is to say about it
+        self.assertEqual([(p.lineno, p.doomed) for p in boom.preflight(lines, MAURYA)], [(114, False)])
+        self.assertEqual(output(lines)[1].failure, None)
+
+    def test_builds_that_run_fine(self):
+        for minutes, pop in ((8, 80), (30, 300)):
+            lines = boom.syntheticBuild(minutes=minutes, pop=pop, buildings=3, forests=8)
+            self.assertEqual([str(p) for p in boom.preflight(lines)], [])
+            self.assertEqual(boom.runResult("<synthetic>", "cohort", None, None, commands=lines).failure, None)
+
+def buildOrder(lines):
+    "The BuildOrder of a command file whose lines are each one command with literals, selectors or cc as arguments."
+    order = boom.BuildOrder()
+    selectors = {"selectWorkers": boom.Workers, "previousWorkerSelection": boom.PreviousWorkers, "selectBuilding": boom.OneBuilding}
+    def value(node):
+        if isinstance(node, ast.Name) and node.id == "cc":
+            return boom.OneBuilding("cc")
+        if isinstance(node, ast.Call):
+            return selectors[node.func.id](*[value(arg) for arg in node.args], **{k.arg: value(k.value) for k in node.keywords})
+        return ast.literal_eval(node)
+    for line in lines:
+        command = line.split("#")[0].strip()
+        if command.startswith("time "):
+            order.at(command[5:])
+        elif command != "":
+            call = ast.parse(command).body[0].value
+            getattr(order, call.func.id)(*[value(arg) for arg in call.args], **{k.arg: value(k.value) for k in call.keywords})
+    return order
+
+class TestBuildOrder(unittest.TestCase):
+    def test_same_as_the_command_file(self):
+        lines = commandLines(MAURYA)
+        for engine in ENGINES:
+            printed = output(lines, engine)[0]
+            state = boom.State(None, engine, order=buildOrder(lines))
+            self.assertEqual(finish(state), printed, engine)
+            self.assertEqual(buildOrder(lines).run(engine=engine).toJSON(), boom.runResult(MAURYA, engine, None, None, commands=lines, timeline=True).toJSON(), engine)
+
+    def test_selectors(self):
+        lines = commandLines(MAURYA) + ['train(selectBuilding("barracks", (10, 10), 1), "male", 2)', 'chop(selectWorkers("male", "chop", num=3), pos=(11, 0))',
+                                         'walk(previousWorkerSelection(), (10, 0), queued=True)', 'train(cc, "female", 1)', "time 13:00"]
+        for engine in ENGINES:
+            self.assertEqual(buildOrder(lines).run(engine=engine).toJSON(), boom.runResult(MAURYA, engine, None, None, commands=lines, timeline=True).toJSON(), engine)
+        self.assertEqual(repr(boom.Workers("female", "farm", num=3)), "Workers('female', 'farm', 3, None)")
+        self.assertEqual(repr(boom.OneBuilding("barracks", index=2)), "OneBuilding('barracks', None, 2)")
+
+    def test_stop_when(self):
+        order = buildOrder(commandLines(MAURYA)).stopWhen(lambda state: state.time >= 725, "five seconds in")
+        result = order.run(engine="cohort")
+        self.assertEqual((result.end, result.failure), (725, "hit stop condition: five seconds in"))
+
+    def test_errors(self):
+        with self.assertRaises(AttributeError):
+            boom.BuildOrder().fly(boom.Workers("male"))
+        lines = ['train(selectBuilding("barracks"), "male", 1)']
+        self.assertEqual(buildOrder(lines).run().error, boom.runResult("<commands>", "cohort", None, None, commands=lines).error)
+
+class TestRobust(unittest.TestCase):
+    pops = [50, 100, 200]
+
+    def test_seed_gives_the_same_replicas(self):
+        runs = [boom.robustRuns(MAURYA, 8, self.pops, seed=seed, engine="cohort", processes=2) for seed in (1, 1, 2)]
+        self.assertEqual(runs[0], runs[1])
+        self.assertNotEqual(runs[0][1], runs[2][1])
+
+    def test_no_noise_is_the_plan(self):
+        plan, replicas = boom.robustRuns(MAURYA, 4, self.pops, spreads=(0, 0), lateness=0, engine="cohort", processes=2)
+        result = boom.runResult(MAURYA, "cohort", None, None)
+        self.assertEqual(plan, ([result.popTimes[pop] for pop in self.pops], None))
+        self.assertEqual(replicas, [plan] * 4)
+
+class TestBudget(unittest.TestCase):
+    def test_curve(self):
+        budget = boom.Budget(10)
+        budget.record(10, [100, 50, 0, 0])
+        budget.record(11, [80, 60, 0, 0])
+        budget.record(13, [120, 40, 0, 0]) # 12 was skipped, so it's 11's
+        curves = budget.spendable([90, 70, 0, 0], 15) # and 14 is 13's
+        self.assertEqual([list(curve) for curve in curves[:2]], [[80, 80, 80, 90, 90, 90], [40, 40, 40, 40, 40, 70]])
+        self.assertEqual([budget.earliest(curves, cost) for cost in ([80, 0, 0, 0], [85, 0, 0, 0], [85, 70, 0, 0], [91, 0, 0, 0], [0, 0, 0, 0])], [10, 13, 15, None, 10])
+
+    def test_build(self):
+        # pto get a food a second without gathering, and 4 women cost 200 food at 00:20
+        lines = ['setCiv("pto")', "reportBudget()", "time 00:20", 'train(cc, "female", 4)', "time 01:00"]
+        printed = output(lines)[0]
+        for engine in ENGINES:
+            text, state = output(lines, engine)
+            self.assertEqual(text, printed, engine)
+            curves = state.spendable()
+            self.assertEqual(list(curves[0]), [max(121, 100 + t) for t in range(61)], engine)
+            self.assertEqual([list(curve) for curve in curves[1:]], [[300] * 61] * 3, engine)
+            self.assertEqual([state.budget.earliest(curves, cost) for cost in ([121, 0, 0, 0], [130, 0, 0, 0], [0, 0, 0, 301])], [0, 30, None], engine)
+        self.assertIn("  001:00 160f 300w 300s 300m", printed)
+
+class TestWithOrder(unittest.TestCase):
+    def test_marks_dont_change_the_run(self):
+        lines = commandLines(MAURYA)
+        plain = output(lines)[0]
+        for every in (2, 7, 30):
+            marked = boom.withOrder(lines, None, 0, range(every, 3600, every))
+            self.assertEqual(output(marked)[0], plain, "marks every {0} seconds".format(every))
+
+def exactFields(obj):
+    "(name, repr) of the fields of an object with __slots__ that are plain values, without the event engine's."
+    fields = []
+    for cls in type(obj).__mro__:
+        for name in getattr(cls, "__slots__", ()):
+            value = getattr(obj, name, None)
+            if name in boom.engineFields or isinstance(value, boom.ActionQueue):
+                continue
+            if isinstance(value, (int, float, str, type(None))) or isinstance(value, (list, tuple)) and all(isinstance(v, (int, float, str)) for v in value):
+                fields.append((name, repr(value)))
+    return fields
+
+def exactState(state):
+    "Everything about a State, with floats in full, so that two States can be compared exactly."
+    actors = [(exactFields(actor), [exactFields(a) for a in actor.actionQueue]) for actor in state.workers]
+    for kind in sorted(state.buildingLists):
+        actors += [(exactFields(building), [exactFields(a) for a in building.actionQueue]) for building in state.buildingLists[kind]]
+    foundations = [exactFields(f) for kind in sorted(state.foundationLists) for f in state.foundationLists[kind]]
+    return (state.time, repr(state.resources), state.pop, state.maxPop, state.failure, list(state.upgrades),
+        repr(state.forestList), repr(state.berriesList), repr(state.chickenList), actors, foundations)
+
+class TestTrace(unittest.TestCase):
+    def test_trace_doesnt_change_the_run(self):
+        lines = commandLines(MAURYA)
+        plain = output(lines)[0]
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "run.trace")
+            for every in (2, 10):
+                state = boom.State(MAURYA, "tick", boom.traceLines(lines, every))
+                traced = finish(state, lambda: boom.runTraced(state, MAURYA, filename))
+                self.assertEqual(traced, plain, "keyframes every {0} seconds".format(every))
+
+    def test_inspect_matches_the_run(self):
+        lines = commandLines(MAURYA)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "run.trace")
+            state = boom.State(MAURYA, "tick", boom.traceLines(lines, 10), quiet=True)
+            finish(state, lambda: boom.runTraced(state, MAURYA, filename))
+            trace = boom.Trace(filename)
+            for time in (0, 95, 416, 417, 440, 719):
+                direct = boom.State(MAURYA, "tick", boom.withOrder(lines, None, 0, [time]), quiet=True)
+                finish(direct, lambda: direct.doCommands(time))
+                self.assertEqual(boom.describeState(trace.state(time)), boom.describeState(direct), "at {0}".format(time))
+
+    def test_frames_are_the_run(self):
+        "A frame replayed from a keyframe is exactly the State of a run stopped there, on either side of keyframes."
+        lines = commandLines(MAURYA)
+        direct = {}
+        with tempfile.TemporaryDirectory() as directory:
+            for engine in ENGINES:
+                filename = os.path.join(directory, engine + ".trace")
+                state = boom.State(MAURYA, engine, boom.traceLines(lines, 10), quiet=True)
+                finish(state, lambda: boom.runTraced(state, MAURYA, filename))
+                trace = boom.Trace(filename)
+                keyframes = trace.times[1:-1:6]
+                self.assertGreater(len(keyframes), 5)
+                times = [0, 1] + [time + offset for time in keyframes for offset in (-1, 0, 1, 5)] + [trace.end - 1, trace.end]
+                for time in times:
+                    if time not in direct:
+                        run = boom.State(MAURYA, "tick", boom.withOrder(lines, None, 0, [time]), quiet=True)
+                        finish(run, lambda: run.doCommands(time))
+                        direct[time] = exactState(run)
+                    self.assertEqual(exactState(trace.state(time)), direct[time], "{0} at {1}".format(engine, time))
+
+def setCivBefore(civ):
+    """(costs, house pop) of a civ as setCiv set them before they were moved to civs.json:
+    the Mauryan numbers, with what the other civs change put on top."""
+    costs = {"horse": [100, 50, 0, 0, 15], "sheep": [50, 0, 0, 0, 40], "male": [50, 50, 0, 0, 10], "female": [50, 0, 0, 0, 8],
+        "trader": [100, 0, 0, 80, 15], "champ": [150, 80, 0, 100, 25], "elephant": [100, 0, 0, 0, 11],
+        "house": [0, 75, 0, 0, 30], "storehouse": [0, 100, 0, 0, 40], "farmstead": [0, 100, 0, 0, 45], "field": [0, 100, 0, 0, 50],
+        "dock": [0, 200, 0, 0, 150], "cc": [0, 300, 300, 250, 500], "corral": [0, 100, 0, 0, 50], "barracks": [0, 300, 0, 0, 150],
+        "temple": [0, 0, 150, 0, 100], "market": [0, 300, 0, 0, 150], "blacksmith": [0, 200, 0, 0, 120], "tower": [0, 100, 100, 0, 150],
+        "elephantstable": [0, 200, 200, 0, 180], "arsenal": [0, 300, 0, 0, 180], "palace": [0, 0, 200, 200, 200], "castle": [0, 300, 600, 0, 450],
+        "up_chop1": [0, 200, 0, 100, 40, "storehouse"], "up_chop2": [0, 400, 0, 200, 50, "storehouse"], "up_chop3": [0, 600, 0, 300, 60, "storehouse"],
+        "up_stone1": [200, 0, 100, 0, 40, "storehouse"], "up_stone2": [300, 0, 200, 0, 50, "storehouse"], "up_stone3": [400, 0, 300, 0, 60, "storehouse"],
+        "up_metal1": [200, 0, 0, 100, 40, "storehouse"], "up_metal2": [300, 0, 0, 200, 50, "storehouse"], "up_metal3": [400, 0, 0, 300, 60, "storehouse"],
+        "up_gather": [0, 100, 0, 0, 40, "farmstead"], "up_farm1": [0, 200, 0, 100, 40, "farmstead"], "up_farm2": [0, 300, 0, 100, 50, "farmstead"],
+        "up_farm3": [0, 400, 0, 100, 60, "farmstead"], "up_trade1": [0, 150, 0, 150, 40, "market"], "up_trade2": [0, 300, 0, 300, 40, "market"],
+        "II": [500, 500, 0, 0, 30], "III": [0, 0, 750, 750, 60]}
+    housePop = 5
+    if civ == "mau":
+        return costs, housePop
+    if civ in "bri gau".split():
+        costs["temple"] = [0, 0, 300, 0, 200]
+    else:
+        costs["temple"] = [0, 300, 0, 0, 160]
+    if civ in "ath car han ibe kus mac pto rom sel spa".split():
+        costs["barracks"] = [0, 200, 100, 0, 150]
+    elif civ == "per":
+        costs["barracks"] = [0, 160, 80, 0, 120]
+    elif civ in "bri gau".split():
+        costs["barracks"] = [0, 300, 0, 0, 120]
+    if civ in "ath car han kus mac per rom sel spa".split():
+        costs["house"] = [0, 150, 0, 0, 50]
+        housePop = 10
+    elif civ in "bri gau".split():
+        costs["house"] = [0, 75, 0, 0, 24]
+    elif civ == "pto":
+        costs["house"] = [0, 45, 0, 0, 45]
+    if civ == "ath":
+        costs["II"] = [350, 350, 0, 0, 15]
+        costs["III"] = [0, 0, 525, 525, 30]
+    return costs, housePop
+
+class TestCivs(unittest.TestCase):
+    civs = "ath bri car gau han ibe kus mac mau per pto rom sel spa".split()
+
+    def test_tables_are_the_old_numbers(self):
+        boom.civTable()
+        self.assertEqual(sorted(boom.civTables), self.civs)
+        for civ in self.civs:
+            table = boom.civTable(civ)
+            costs, housePop = setCivBefore(civ)
+            self.assertEqual(dict(table.costs), {kind: tuple(cost) for kind, cost in costs.items()}, civ)
+            self.assertEqual(table.housePop, housePop, civ)
+            self.assertEqual(table.trickle, (1, 0, 0, 0) if civ == "pto" else (0, 0, 0, 0), civ)
+        self.assertEqual(boom.civTable().name, "mau")
+        self.assertEqual(boom.resolveCiv("Ptolemies"), "pto")
+
+    def test_trickle_is_income_per_second(self):
+        for engine in ENGINES:
+            state = boom.State("<test>", engine, ['setCiv("pto")', "time 00:10"], quiet=True)
+            start = list(state.resources)
+            state.doCommands()
+            self.assertEqual(state.time, 10)
+            self.assertEqual(state.income, [1, 0, 0, 0], engine)
+            self.assertEqual(state.resources, [start[0] + 10] + start[1:], engine)
+            state = boom.State("<test>", engine, ['setCiv("mau")', "time 00:10"], quiet=True)
+            start = list(state.resources)
+            state.doCommands()
+            self.assertEqual((state.income, state.resources), ([0, 0, 0, 0], start), engine)
+
+class TestMemory(unittest.TestCase):
+    # bytes each, with the actions they have queued. With a __dict__ in every
+    # actor and action, units took about 570 and buildings 590.
+    bounds = {"units": 450, "buildings": 450, "foundations": 300}
+
+    def test_actors_stay_small(self):
+        lines = boom.syntheticBuild(minutes=10, pop=100, buildings=2, forests=8)
+        for engine in ENGINES:
+            state = boom.State("<test>", engine, lines, quiet=True)
+            state.doCommands()
+            footprints = boom.actorFootprints(state)
+            self.assertGreater(footprints["units"][0], 80)
+            for group, (count, size) in footprints.items():
+                self.assertLessEqual(size, self.bounds[group] * count, "{0} on {1}: {2:.0f} bytes each".format(group, engine, size / max(count, 1)))
+            actors = state.workers + [b for kind in state.buildingLists.values() for b in kind] + [f for kind in state.foundationLists.values() for f in kind]
+            for obj in actors + [a for actor in actors if hasattr(actor, "actionQueue") for a in actor.actionQueue]:
+                self.assertFalse(hasattr(obj, "__dict__"), type(obj).__name__ + " has a __dict__")
+
+if __name__ == "__main__":
+    unittest.main()